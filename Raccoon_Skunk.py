@@ -24,6 +24,57 @@ ERROR_LOG="error.txt"
 # DATA_FILE="/media/pi/RACCOON5/RAC129Results.txt"
 # ERROR_LOG="/media/pi/RACCOON5/error.txt"
 
+# When the data file is flushed to the disk: after every "record", at most
+# every LOG_FLUSH_INTERVAL milliseconds ("interval"), or at the end of every
+# "block". Queued records are always flushed on exit.
+LOG_FLUSH_POLICY="interval"
+LOG_FLUSH_INTERVAL=1000
+# Format of DATA_FILE: "csv" for comma separated lines, or "binary" for compact
+# fixed-width records. Convert a binary file to the same lines with:
+# python -m puzzlebox.binlog DATA_FILE CSV_FILE
+# With "sqlite" the records are inserted into DATABASE_FILE instead, one
+# transaction per flush; print the accuracy of every block with:
+# python -m puzzlebox.eventdb DATABASE_FILE
+LOG_FORMAT="csv"
+DATABASE_FILE=FOLDER + "events_" + ID + ".sqlite"
+# Split DATA_FILE into one file per day, from noon to noon (e.g.
+# 06282018_COY1031P_2018-06-28.txt). The files of past days are gzipped in the
+# background and listed with their record counts in DATA_FILE + ".manifest";
+# print it with: python -m puzzlebox.segments DATA_FILE
+SEGMENT_DATA=True
+
+# Memory in megabytes for images and sounds preloaded from FOLDER
+ASSET_CACHE_SIZE=64
+
+# When changed parameters are saved to CONFIG_FILE: at the end of every "trial"
+# or only at the end of every "block" (and when the animal leaves or the
+# reward maximum is reached). Unchanged parameters are never written.
+PARAM_WRITE_POLICY="block"
+
+# Journal of the session state, written after every trial so a restart can
+# continue the session exactly. It is started over with a full snapshot every
+# JOURNAL_SNAPSHOT_EVERY trials and whenever the parameters are saved.
+JOURNAL_FILE=CONFIG_FILE + ".journal"
+JOURNAL_SNAPSHOT_EVERY=100
+# Histograms of how long the stages of a trial take are printed and appended
+# to LATENCY_FILE on SIGUSR1 (kill -USR1 <pid>) and on exit
+LATENCY_FILE=FOLDER + "latency.txt"
+# With --profile (or PROFILE=True) the stacks of all threads are sampled every
+# PROFILE_INTERVAL seconds, and written to FOLDER on exit as collapsed stacks
+# for a flame graph (e.g. flamegraph.pl profile_*.folded > profile.svg)
+PROFILE=False
+PROFILE_INTERVAL=0.01
+# Unix socket serving a read-only JSON snapshot of the session state; query it
+# with: python -m puzzlebox.control CONTROL_SOCKET (set to "" to disable)
+CONTROL_SOCKET="/tmp/puzzlebox_" + ID + ".sock"
+# The counters are also published in a memory-mapped file for monitors; read
+# it with: python -m puzzlebox.shm SHM_FILE (set to "" to disable)
+SHM_FILE="/dev/shm/puzzlebox_" + ID
+# Seed of the random trial selection, or None for a new one every session. It
+# is written at the start of the session in the data file, so the session can
+# be replayed with: python -m puzzlebox.sim.replay
+SEED=None
+
 # Pin numbers
 PIN_IR_IN=18
 PIN_IR_POWER=4
@@ -36,17 +87,50 @@ PIN_JOY_LEFT=5
 PIN_LED_RIGHT=1
 PIN_LED_LEFT=2
 
+# Seconds between samples of the IR sensor. The sensor is only powered while
+# it is sampled (about 60 ms), so a longer interval saves power but notices
+# arrivals and departures later.
+IR_SAMPLE_INTERVAL=0.2
+# Samples in a row that must agree before an arrival or departure is accepted
+IR_CONFIRM_SAMPLES=1
+# The display task handles pygame events at least every DISPLAY_INTERVAL
+# seconds, so the window stays responsive while nothing is drawn
+DISPLAY_INTERVAL=1.0
+# Seconds the feeder motor may turn without the snap switch coming round,
+# before it is stopped as jammed
+FEEDER_JAM_TIMEOUT=10
+
 # Import necessary libraries
 import subprocess, tempfile # For getting the time
+import io                   # For building the configuration file in memory
 import pygame               # For full screen and sound
 import RPi.GPIO as GPIO     # Input output pin controls
-import time                 # For delays
 import datetime             # For processing time stamps
 import collections          # Needed for making an ordered dictionary
 import random               # For randomization and shuffling
 import os                   # For interacting with the filesystem
 import sys                  # For checking the operating system
 import traceback            # For logging when the program crashes
+import asyncio              # For running input, feeding, timers and display side by side
+from puzzlebox import clock # For time stamps and delays (simulated by puzzlebox.sim)
+from puzzlebox.datalog import DataLogger # For writing the data file in the background
+from puzzlebox.segments import SegmentedLogger # For the daily data files
+from puzzlebox.eventdb import EventLogger # For LOG_FORMAT "sqlite"
+from puzzlebox.binlog import BinaryLog, ledMask, sessionLine # For the data file format
+from puzzlebox.assets import AssetCache  # For preloading images and sounds
+from puzzlebox.persist import atomicWrite, ChangeTracker # For saving parameters safely
+from puzzlebox.journal import Journal, fileHash # For recovering the session after a crash
+from puzzlebox.trials import compileTrials, trialName, ANSWER_NAMES, LED_NAMES # For checking trials up front
+from puzzlebox.criteria import createCriterion, PASSED, FAILED # For deciding when a block is passed
+from puzzlebox.scheduler import Scheduler # For sleeping until the next deadline
+from puzzlebox.engine import InputChannel, AsyncTimers, runWithTasks # For the session tasks
+from puzzlebox.feeder import Feeder # For turning the feeder motor in the background
+from puzzlebox.timing import TrialTimes # For stimulus onset and reaction times
+from puzzlebox.latency import Latencies, installDumpSignal, removeDumpSignal # For timing the trial stages
+from puzzlebox.profiler import SamplingProfiler # For the --profile mode
+from puzzlebox.control import StateServer # For the control socket
+from puzzlebox.shm import SharedCounters # For the shared memory counters
+from puzzlebox.presence import PresenceTracker # For sampling the IR sensor in the background
 
 # JH: Class for keeping track of the LED status
 class LEDS:
@@ -58,21 +142,25 @@ class LEDS:
     def turnLeftOn(self):
         self.left=True
         GPIO.output(PIN_LED_LEFT, 1)
+        trialTimes.stimulus()
 
         
     def turnRightOn(self):
         self.right=True
         GPIO.output(PIN_LED_RIGHT, 1)
+        trialTimes.stimulus()
 
         
     def turnLeftOff(self):
         self.left=False
         GPIO.output(PIN_LED_LEFT, 0)
+        trialTimes.stimulus()
 
         
     def turnRightOff(self):
         self.right=False
         GPIO.output(PIN_LED_RIGHT, 0)
+        trialTimes.stimulus()
 
 
     def turnBothOn(self):
@@ -110,6 +198,11 @@ class LEDS:
         else:
             result+="Off"
         return result
+
+
+    def mask(self):
+        # Bitmask of the LEDs for the binary data file
+        return ledMask(self.left, self.right)
     
 
 # JH: Class added for reading parameters
@@ -126,6 +219,12 @@ class Parameter:
 ######################### SETUP ###############################
 
 OPPOSITE_ANSWERS={"R":"L", "L":"R", "X":"X"}
+# Published in SHM_FILE after the positional parameters; the answer and LED
+# configuration of the current trial are character codes (0 before a trial)
+SHM_EXTRAS=['answer', 'led_config', 'leds', 'present']
+# Counters written to the data file between the times and the LEDs
+LOG_COUNTERS=['curr_test', 'curr_block', 'trial_cnt', 'failed_current_trial',
+              'failed_trials', 'failed_blocks']
 LEGAL_ANSWERS=["L", "R", "E", "I"]
 
 # Global variables
@@ -133,6 +232,8 @@ LEGAL_ANSWERS=["L", "R", "E", "I"]
 # JH: Used for interacting with the touch screen.
 # They are defined global because they are used in a callback function
 listen = 0
+# Counts the waits for a push, so a press can tell whether its wait is over
+pushWaits = 0
 push = None
 prev_push = None
 p = None
@@ -145,40 +246,146 @@ timeoutState="stopped"
 # functions separately
 positionalParameters = []
 namedParameters = collections.OrderedDict()
+settingNames = []
 par = None
+# Keeps track of the parameters that changed since they were last saved
+paramChanges = ChangeTracker()
+journal=None
 screen=None
-
-# The size of the sliding window for the consecutive block experiment
-slidingWindow=None
+dataLogger=None
+# Packs the records when LOG_FORMAT is "binary"
+binaryLog=None
+assets=None
+profiler=None
+stateServer=None
+sharedCounters=None
+# The answer and LED configuration of the current trial, for SHM_FILE
+trialAnswer=""
+trialLedConfig=""
+# Chooses the trials of random and shuffle tests; seeded in main()
+rng=random.Random()
+
+# Decides when a block is passed or failed; keeps the sliding window for the
+# consecutive block experiment
+criterion=None
 prevAnswer = "X"
 
+# Compiled trials for every test, and the current shuffled order of trials
+trialTables = dict()
+shuffledTrials = []
+
+# Timers for timeouts; they run in their own task on the event loop (see
+# session())
+scheduler = Scheduler()
+
+# The session runs as asyncio tasks (see session()). The GPIO callbacks post
+# their edges to the input task through inputChannel.
+inputChannel = InputChannel()
+# Set whenever push may have changed, to wake up pushWait()
+pushChanged = None
+# Turns the feeder motor on its own thread
+feeder = None
+# Samples the IR sensor on its own thread and keeps the animal's presence
+presence = None
+# Set when the presence changes
+presenceChanged = None
+# Images for the display task to show
+displayQueue = None
+# Runs the scheduler timers on the event loop
+timers = None
+# Time of the last accepted button press, used to report press-to-reward latency
+pushTime = None
+# Monotonic timestamps of the current trial, for the reaction time column
+trialTimes = TrialTimes()
+# How long the stages of a trial take, in nanoseconds (see dumpLatencies())
+latencies = Latencies(["edge_to_pushed", "pushed_to_wake", "feed", "log",
+                       "write_param"])
+# When pushed() woke up pushWait(), for the pushed_to_wake latency
+wakeTime = None
+
 
 ######################## FUNCTIONS #################################    
 
-def pushed(channel): #interrupt detection function
+def gpioEdge(channel): #interrupt detection function
+    # Runs on the GPIO thread; note the time and hand over to the input task
+    inputChannel.post(channel, clock.monotonicNs())
+
+
+def presenceEdge(present):
+    # Runs on the presence tracker thread; hand over to the input task
+    inputChannel.post(PIN_IR_IN, present)
+
+
+async def inputTask():
+    # Handles the button edges and presence changes on the event loop. Every
+    # button edge is debounced in a task of its own, so the presence changes
+    # are never held up behind a debounce.
+    debounces = set()
+    try:
+        while True:
+            channel, value = await inputChannel.get()
+            if channel == PIN_IR_IN:
+                irChanged(value)
+            else:
+                task = asyncio.create_task(pushed(channel, value))
+                debounces.add(task) #keep a reference until it is done
+                task.add_done_callback(debounces.discard)
+    finally:
+        for task in debounces:
+            task.cancel()
+
+
+async def pushed(channel, edgeTime):
     global listen    
     global push
     global prev_push
+    global pushTime
+    global wakeTime
+    latencies["edge_to_pushed"].record(clock.monotonicNs() - edgeTime)
     prev_push=push
     if listen == 1: #Only do the following if we are listening...
         print("trigger detected...", flush = True)        
+        wait = pushWaits #the wait this press belongs to
+        accepted = False
         if(channel==PIN_JOY_LEFT):
-            time.sleep(0.01)            
-            if GPIO.input(PIN_JOY_LEFT) == 0: #make sure it's a push and not a release
+            await asyncio.sleep(0.01)            
+            # The wait may have ended during the debounce, e.g. the animal left
+            if listen == 1 and pushWaits == wait and GPIO.input(PIN_JOY_LEFT) == 0: #make sure it's a push and not a release
                 push = "L"
                 listen = 0 #turn off listening for interrupts        
+                accepted = True
                 #print("Left button pushed " + push)
         if(channel==PIN_JOY_RIGHT):
-            time.sleep(0.01)            
-            if GPIO.input(PIN_JOY_RIGHT) == 0: #make sure it's a push and not a release            
+            await asyncio.sleep(0.01)            
+            if listen == 1 and pushWaits == wait and GPIO.input(PIN_JOY_RIGHT) == 0: #make sure it's a push and not a release            
                 push = "R"
                 listen = 0 #turn off listening for interrupts        
+                accepted = True
                 #print("Right button pushed " + push)
+        if accepted:
+            pushTime = edgeTime
+            trialTimes.pushed(edgeTime)
+            wakeTime = clock.monotonicNs()
+            pushChanged.set() #wake up pushWait()
+
+
+def irChanged(present):
+    presenceChanged.set()
+    publishCounters()
+    if listen == 1 and not present:
+        pushChanged.set() #wake up pushWait() to record the departure
 
 
 def showImg(img): #Show an image full screen (or not full screen)
+    if displayQueue is not None:
+        displayQueue.put_nowait(img) #drawn by the display task
+    else:
+        drawImg(img)
+
+
+def drawImg(img):
     global screen
-    img1 = pygame.image.load(FOLDER + img)
+    img1 = assets.image(img)
     screen.blit(img1, (0,0))
     pygame.display.flip()
     pygame.event.pump()
@@ -193,8 +400,7 @@ def customBoolCast(string):
         return bool(string)
     
 def playSound(wav):
-    wavFile = FOLDER + wav 
-    beep = pygame.mixer.Sound(wavFile)
+    beep = assets.sound(wav)
     beep.play()
 
     
@@ -202,8 +408,10 @@ def playSound(wav):
 def resetParams():
     global positionalParameters
     global namedParameters
+    global settingNames
     positionalParameters = []
     namedParameters = collections.OrderedDict()
+    settingNames = []
 
     
 # JH: Code for new parameters
@@ -216,34 +424,28 @@ def addNamedParam(name, default, exp, parType=str):
     namedParameters[name] = Parameter(name, default, exp, parType, False)
 
 
-def checkIR(): #For periodic checking of the IR sensor
-    #print("Checking IR...", flush = True)
-    present = 1    
-    p.ChangeDutyCycle(50) #start pulses
-    GPIO.output(PIN_IR_POWER,1) #turn sensor on  
-    time.sleep(0.03)
-    checkcount = 0
-    present2 = GPIO.input(PIN_IR_IN)
-    while checkcount < 3:
-        present = GPIO.input(PIN_IR_IN)
-        if present == present2:
-            checkcount += 1
-        else:
-            checkcount = 0
-        present2 = present
-        time.sleep (0.01)
-    p.ChangeDutyCycle(0)   #stop LED pulses
-    GPIO.output(PIN_IR_POWER,0) #turn sensor off
-    #print("Checked IR... ", present, flush = True)
-    return present #return the bit unaltered if using a break beam    
-    #return not present #reverse the bit if using reflective sensor
+# Named parameters that hold a single setting, rather than a list of trials.
+# They are optional in the configuration file and kept in par like the
+# positional parameters.
+def addSetting(name, default, exp, parType=str):
+    addNamedParam(name, default, exp, parType)
+    namedParameters[name].value = str(default)
+    settingNames.append(name)
+
+
+def parseValue(parameter, word):
+    if parameter.parType == bool:
+        return customBoolCast(word)
+    return parameter.parType(word)
+
 
-    
 def getParams():  #open the parameters file and get data
     global par  
     global tests
     global testDict
-    global slidingWindow
+    global trialTables
+    global shuffledTrials
+    global criterion
 
     resetParams()
     addParam("entry_reward", 2, "Maximum entry rewards")
@@ -303,6 +505,16 @@ def getParams():  #open the parameters file and get data
                   "list of answers for that test as: test1=L-L, R-R\n"
                   "The special names \"rand,\"  and \"shuffle\"\n"
                   "can be used for random trial selection from the entire list.")
+    addSetting("block_criterion", "",
+               "How blocks are passed: \"fixed\" (block_suc_thresh successful\n"
+               "trials out of trials_in_block), \"sliding\" (block_suc_thresh of the\n"
+               "last trials_in_block trials), \"streak\" (block_suc_thresh successful\n"
+               "trials in a row) or \"binomial\" (more successful trials out of\n"
+               "trials_in_block than expected by chance, see criterion_alpha).\n"
+               "Leave empty to use consecutive_block to choose between fixed and sliding.")
+    addSetting("criterion_alpha", 0.05,
+               "Largest chance of passing a block by guessing, for the binomial criterion.",
+               float)
     imgExp=("The lists of trials associated with each test. Each trial is an\n"
             "answer-led pair, where the first character determines the correct\n"
             "answer (“R” for right, “L” for left, “E” for either, “I” for\n"
@@ -361,6 +573,8 @@ def getParams():  #open the parameters file and get data
     
     # Read named parameters
     par["previous_shuffle"] = []
+    for name in settingNames:
+        par[name] = namedParameters[name].default
     tests = []
     testDict = dict()
     for i in range(lineIndex, len(lines)):
@@ -379,47 +593,81 @@ def getParams():  #open the parameters file and get data
         elif key == "previous_shuffle":
             par["previous_shuffle"] = values.split(",")
             par["previous_shuffle"] = [x.strip() for x in par["previous_shuffle"]]
+        elif key in settingNames:
+            par[key] = parseValue(namedParameters[key], values)
         else:
             if len(testDict) == 0:
                 namedParameters[key].exp=imgExp
             testDict[key] = values.split(",")
             testDict[key] = [x.strip() for x in testDict[key]]
-    slidingWindow=[0]*par['trials_in_block']
+
+    # Check and compile the trials now, rather than failing in the middle of
+    # a session
+    try:
+        trialTables = {key: compileTrials(trials, LEGAL_ANSWERS)
+                       for key, trials in testDict.items()}
+        shuffledTrials = list(compileTrials([t for t in par["previous_shuffle"] if t], LEGAL_ANSWERS))
+    except ValueError as err:
+        print("ERROR: Invalid trial in configuration file:", err)
+        exit()
+    for test in tests:
+        if test not in trialTables or len(trialTables[test]) == 0:
+            print("ERROR: No trials defined for test", test, "in configuration file.")
+            exit()
+    try:
+        criterion = makeCriterion()
+    except ValueError as err:
+        print("ERROR:", err)
+        exit()
+    paramChanges.markSaved(par)
     return par
 
     
-def feedIt():
+async def feedIt(timePushed=None):
     """
-    Turn motor to administer food.
+    Turn motor to administer food. If the feed is a reward for a button press,
+    pass the time of the press to report the press-to-reward latency. Returns
+    once the feeder has fed.
     """
-    print("feeding")    
-    GPIO.output(PIN_MOTOR_RIGHT,0) 
-    GPIO.output(PIN_MOTOR_LEFT,1) #Turn left
-    while GPIO.input(PIN_MOTOR_SNAP)== 0: #wait for switch
-        time.sleep(0.1)
-    while GPIO.input(PIN_MOTOR_SNAP) == 1: #wait for switch
-        time.sleep(0.05)
-    GPIO.output(PIN_MOTOR_RIGHT,0)
-    GPIO.output(PIN_MOTOR_LEFT,0)
+    start = clock.monotonicNs()
+    fed = await asyncio.wrap_future(feeder.request(timePushed))
+    latencies["feed"].record(clock.monotonicNs() - start)
+    if fed and timePushed is not None:
+        trialTimes.fed(*feeder.lastFeedNs)
 
     
 def logIt(AnimalID, event, time1, time2, push, correct): 
     print("LOGGING...")          
     global par
-    #Build a data line and write it to memory
-    dList = [AnimalID,event,time1,time2, par['curr_test'], par['curr_block'], 
-             par['trial_cnt'], par['failed_current_trial'], par['failed_trials'],
-             par['failed_blocks'], leds, push, correct, par['rew_cnt']]     
-    global dLine         
-    dLine  = ','.join(map(str, dList)) #transform list into a comma delinates string of values
-    dataText = open(DATA_FILE, 'a')  #open for appending  
-    dataText.write(dLine + "\n") 
-    dataText.close()
+    start = clock.monotonicNs()
+    if binaryLog:
+        # The same fields, packed; see puzzlebox.binlog
+        dataLogger.write(binaryLog.record(event, time1, time2,
+                                          [par[name] for name in LOG_COUNTERS],
+                                          leds.mask(), push, correct,
+                                          par['rew_cnt'], clock.monotonicNs(),
+                                          trialTimes.values()), time1)
+    elif LOG_FORMAT == "sqlite":
+        # A row of the events table; see puzzlebox.eventdb
+        dataLogger.write([event, time1, time2] + [par[name] for name in LOG_COUNTERS] +
+                         [leds.mask(), push, correct, par['rew_cnt'],
+                          trialTimes.reactionText()])
+    else:
+        #Build a data line and write it to memory
+        dList = ([AnimalID,event,time1,time2] + [par[name] for name in LOG_COUNTERS] +
+                 [leds, push, correct, par['rew_cnt'], trialTimes.reactionText()])
+        global dLine         
+        dLine  = ','.join(map(str, dList)) #transform list into a comma delinates string of values
+        dataLogger.write(dLine, time1) #appended to DATA_FILE (or the segment of time1) by the logger thread
+    trialTimes.clear() #the push and feed times belong to this record only
+    latencies["log"].record(clock.monotonicNs() - start)
     print("LOGGING DONE")
 
 
 def logError(): 
     print("WRITING ERROR LOG...")          
+    if dataLogger:
+        dataLogger.flush() #make sure the records leading up to the crash are saved
     dataText = open(ERROR_LOG, 'w')  #open for appending  
     dataText.write(traceback.format_exc()) 
     dataText.close()
@@ -430,47 +678,50 @@ def logError():
 def pushInit():
     global push    
     global listen
+    global pushWaits
     prev_push=push
+    pushWaits += 1
     push = 0    
-    GPIO.output(PIN_IR_POWER,1) #turn sensor on 
-    p.ChangeDutyCycle(50) #start pulses    
-    time.sleep(0.05) #sensor warm up  
+    # Discard wake-ups left over from a previous wait
+    pushChanged.clear()
     listen = 1 #respond to button push interrupts
 
 
-def pushPoll():
+async def pushPoll():
     global push    
     global listen    
-    #print("push = ", push, " IR: ", GPIO.input(PIN_IR_IN))        
+    global wakeTime
+    #print("push = ", push, " IR: ", presence.present)        
     if push != 0:
         listen = 0 #stop listening to interrupts    
         return False
-    if GPIO.input(PIN_IR_IN) == 0: #check the IR sensor to mak
-        if checkIR() == 0:
-            listen = 0
-            push = "D"
-            return False
-        
-    # JH: Lines added for animation
-    time.sleep(0.02)
+    if not presence.present: #the animal left
+        listen = 0
+        push = "D"
+        return False
+    # Sleep until pushed() reports a press or irChanged() a departure
+    await pushChanged.wait()
+    pushChanged.clear()
+    if wakeTime is not None:
+        latencies["pushed_to_wake"].record(clock.monotonicNs() - wakeTime)
+        wakeTime = None
     return True
 
     
-def pushExit():
-    p.ChangeDutyCycle(0)         #stop pulses   
-    GPIO.output(PIN_IR_POWER,0) #turn sensor off
-
-
-def pushWait(): #Monitor buttons and presence/absence
+async def pushWait(): #Monitor buttons and presence/absence
     #print("push wait....", flush = True)       
     pushInit()
-    while pushPoll(): pass #this will monitor IR senor and the buttons
+    while await pushPoll(): pass #this will monitor the presence and the buttons
     print("push = ", push)
-    p.ChangeDutyCycle(0)         #stop pulses   
-    GPIO.output(PIN_IR_POWER,0) #turn sensor off
 
 
-def timeout(length):
+async def outOfRewardWait():
+    # The wait for a push or departure once the reward maximum is reached. It
+    # is kept apart from pushWait() for the replay (see puzzlebox.sim.replay).
+    await pushWait()
+
+
+async def timeout(length):
     """
     Timeout that happens when a Raccoon fails one of the trials. While in 
     timeout, the system won't respond to the Raccoon using the touch screen, but
@@ -478,27 +729,39 @@ def timeout(length):
     has left the touch screen, the device won't respond or record Raccoons 
     entering or leaving the system untill the timeout is over.
     """
-    global push
     global timeoutState
     timeoutState="started"
-    timeStart = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    timeStart = clock.now().strftime('%Y-%m-%d %H:%M:%S')
     print("Starting timeout of:", length, "seconds.")
     pygame.event.pump()
-    for t in range(length):
-        time.sleep(1)
-        if push == "X":
-            pass
-        elif not checkIR():
-            timeEnd = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            logIt(ID, "D", timeStart, timeEnd,"N","E") 
-            push = "X"
-        pygame.event.pump()
+
+    async def checkDeparture(): #logs a departure during the timeout
+        global push
+        while push != "X":
+            presenceChanged.clear()
+            if not presence.present:
+                timeEnd = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+                logIt(ID, "D", timeStart, timeEnd,"N","E") 
+                push = "X"
+            else:
+                await presenceChanged.wait()
+
+    departures = None
+    if length > 0:
+        departures = asyncio.ensure_future(checkDeparture())
+    try:
+        await timers.sleep("timeout", length)
+    finally:
+        if departures:
+            departures.cancel()
     timeoutState="stopped"
     
 
 # JH: Changed how parameters are written
 def writeCurrentParams():
-    with open(CONFIG_FILE, 'w') as pFile:
+    # Build the file in memory and replace the old file in one go, so a power
+    # cut can't leave a truncated configuration file behind
+    with io.StringIO() as pFile:
         for par in positionalParameters:
             if isinstance(par.value, int):
                 pFile.write(str(par.value).zfill(3))
@@ -518,10 +781,16 @@ def writeCurrentParams():
             pFile.write("=")
             pFile.write(par.value)
             pFile.write("\n")
+        atomicWrite(CONFIG_FILE, pFile.getvalue())
 
             
 # JH: Changed how parameters are written
 def writeParam():
+    start = clock.monotonicNs()
+    changed = paramChanges.changed(par)
+    if not changed:
+        return
+    print("Saving parameters:", ", ".join(changed))
     for posPar, value in zip(positionalParameters, par.values()):
         posPar.value = value
         
@@ -532,35 +801,147 @@ def writeParam():
         if i != len(par["previous_shuffle"]) - 1:
             shuffledStr += ","
     namedParameters["previous_shuffle"].value = shuffledStr
+    for name in settingNames:
+        namedParameters[name].value = str(par[name])
 
     writeCurrentParams()
+    paramChanges.markSaved(par)
+    if journal:
+        journal.snapshot(sessionState(), fileHash(CONFIG_FILE))
+    latencies["write_param"].record(clock.monotonicNs() - start)
+
+
+def stateSnapshot():
+    # Runs on the control socket thread. It only copies the state and takes no
+    # locks, so a monitor polling the socket does not hold up the trials.
+    since = feeder.sinceLastFeed() if feeder else None
+    endOfLastFeed = None
+    if since is not None:
+        endOfLastFeed = (clock.now() - datetime.timedelta(seconds=since)).strftime('%Y-%m-%d %H:%M:%S')
+    return {"id": ID,
+            "time": clock.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "par": dict(par) if par else None,
+            "leds": {"left": leds.left, "right": leds.right, "text": str(leds)},
+            "push": push,
+            "listen": listen,
+            "present": presence.present if presence else None,
+            "feeder": {"isFeeding": feeder.feeding if feeder else False,
+                       "endOfLastFeed": endOfLastFeed,
+                       "stats": feeder.stats() if feeder else None},
+            "latency": latencies.summary()}
+
+
+def publishCounters():
+    # Copy the counters to SHM_FILE for monitors (see puzzlebox.shm)
+    if sharedCounters:
+        values = [par[parameter.name] for parameter in positionalParameters]
+        values.extend((ord(trialAnswer) if trialAnswer else 0,
+                       ord(trialLedConfig) if trialLedConfig else 0,
+                       leds.mask(),
+                       (1 if presence.present else 0) if presence else -1))
+        sharedCounters.publish(values)
+
+
+def dumpLatencies():
+    # Print the latency histograms and append them to LATENCY_FILE
+    latencies.dump(LATENCY_FILE, id=ID)
+
+
+def makeCriterion():
+    # The block criterion selected in the configuration file
+    name = par['block_criterion']
+    if not name:
+        name = "sliding" if par['consecutive_block'] else "fixed"
+    return createCriterion(name, par['trials_in_block'], par['block_suc_thresh'],
+                           par['criterion_alpha'])
+
+
+def sessionState():
+    # Everything needed to continue the session after a restart
+    return {"par": par,
+            "session": {"criterion": criterion.state(), "prevAnswer": prevAnswer}}
+
+
+def restoreSession(state):
+    # Continue the session saved in the journal
+    global prevAnswer
+    global shuffledTrials
+    par.update(state["par"])
+    shuffledTrials = list(compileTrials([t for t in par["previous_shuffle"] if t], LEGAL_ANSWERS))
+    if "criterion" in state["session"]:
+        criterion.restore(state["session"]["criterion"])
+    prevAnswer = state["session"]["prevAnswer"]
+    print("Session restored from journal", JOURNAL_FILE, flush=True)
+
+
+def saveParams(boundary):
+    # Save changed parameters at the end of a "trial" or "block", depending on
+    # PARAM_WRITE_POLICY
+    if boundary == "block" or PARAM_WRITE_POLICY == "trial":
+        writeParam()
 
 
 def cleanup():
+    global profiler
+    global stateServer
+    global sharedCounters
     print("Cleanup")
+    if sharedCounters:
+        sharedCounters.close()
+        sharedCounters = None
+    if stateServer:
+        stateServer.stop()
+        stateServer = None
+    dumpLatencies()
+    if profiler:
+        profiler.stop()
+        profilePath = (FOLDER + "profile_" + ID +
+                       clock.now().strftime('_%Y%m%d_%H%M%S') + ".folded")
+        try:
+            profiler.write(profilePath)
+            print("Profile written to", profilePath, profiler.stats())
+        except OSError as err:
+            print("ERROR: Could not write profile", profilePath, ":", err)
+        profiler = None
+    if dataLogger:
+        dataLogger.close() #write all queued records
+    if journal:
+        journal.close()
+    if assets:
+        print("Asset cache:", assets.stats())
+    if feeder:
+        feeder.stop() #finish the current feed
+        print("Feeder:", feeder.stats())
+    if presence:
+        presence.stop()
+        print("IR sensor:", presence.stats())
     leds.turnBothOff()
     pygame.quit()
     p.stop()
     GPIO.remove_event_detect(PIN_JOY_LEFT)
     GPIO.remove_event_detect(PIN_JOY_RIGHT)
-    GPIO.remove_event_detect(PIN_IR_IN) 
     GPIO.cleanup()
 
 
-def waitForAnimal():
+async def waitForAnimal():
     global push
     quitgame=0
-    while checkIR() == 0 and quitgame==0:
+    while not presence.present and quitgame==0:
         #print("no animal")
+        presenceChanged.clear()
         for event in pygame.event.get():
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     quitgame = 1 #If a keyboard input is detected, then set the flag to quit the game
-        time.sleep(.5)    
+        # Wake up on an arrival, or after half a second to check the keyboard
+        try:
+            await asyncio.wait_for(presenceChanged.wait(), .5)
+        except asyncio.TimeoutError:
+            pass
     if quitgame == 0: 
         print("animal detected") 
-        #timeStart = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') #get the time of initial detection
-        timeNow = datetime.datetime.now() #.strftime('%Y-%m-%d %H:%M:%S') #get the time of initial detection
+        #timeStart = clock.now().strftime('%Y-%m-%d %H:%M:%S') #get the time of initial detection
+        timeNow = clock.now() #.strftime('%Y-%m-%d %H:%M:%S') #get the time of initial detection
         dayNow = timeNow -  datetime.timedelta(hours=12) #subtract 12 hours when defining the day
         dayNow = dayNow.day
         timeStart = timeNow.strftime('%Y-%m-%d %H:%M:%S')
@@ -588,21 +969,21 @@ def waitForAnimal():
     return quitgame
                     
 
-def training():
+async def training():
     global push
     print("Training mode...")
     # get the time of initial detection
-    timeStart = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    timeStart = clock.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Feed immediately if there are entry rewards remaining and it's a new entry
     if par['entry_reward'] > par['entry_cnt'] and push == "X":
-        feedIt()
+        await feedIt()
         print("Providing entry reward") 
         par['entry_cnt'] += 1  # advance count for entry rewards
         par['rew_cnt'] += 1   # advance total daily reward count
         logIt(ID, "E", timeStart, timeStart,"N","X") #log data for entry reward        
         push = "E"
-        time.sleep(1) #wait for a bit after reward
+        await asyncio.sleep(1) #wait for a bit after reward
         
     if par['push_reward_e'] > par['push_cnt_e']:
         # JH: Turn on LEDs for which there is still reward remaining
@@ -614,20 +995,20 @@ def training():
         either_reward = par['push_reward_e'] - par['push_reward_r'] - par['push_reward_l']
         either_claimed = par['push_cnt_e'] - par['push_cnt_r'] - par['push_cnt_l']
             
-        pushWait() #wait for button push or animal departure
+        await pushWait() #wait for button push or animal departure
         # get the time of initial detection     
-        timeEnd = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') 
+        timeEnd = clock.now().strftime('%Y-%m-%d %H:%M:%S') 
         if push != "D":
             if push == "R":
                 if par['push_reward_r'] > par['push_cnt_r']:
-                    feedIt()
+                    await feedIt(pushTime)
                     print("reward R") 
                     par['push_cnt_e'] += 1  #advance count for entry rewards
                     par['rew_cnt'] += 1   #advance total daily reward count
                     par['push_cnt_r'] += 1 #advance right push count    
                     logIt(ID, "P", timeStart, timeEnd,push,"R") #log data for push reward
                 elif either_claimed < either_reward:
-                    feedIt()
+                    await feedIt(pushTime)
                     print("reward E") 
                     par['push_cnt_e'] += 1
                     par['rew_cnt'] += 1
@@ -637,14 +1018,14 @@ def training():
                     logIt(ID, "X", timeStart, timeEnd,push,"L") #log data for failed  reward        
             elif push == "L":     
                 if par['push_reward_l'] > par['push_cnt_l']:
-                    feedIt()
+                    await feedIt(pushTime)
                     print("reward L") 
                     par['push_cnt_e'] += 1  #advance count for entry rewards
                     par['rew_cnt'] += 1   #advance total daily reward count
                     par['push_cnt_l'] += 1 #advance right push count    
                     logIt(ID, "P", timeStart, timeEnd,push,"L") #log data for push reward
                 elif either_claimed < either_reward:
-                    feedIt()
+                    await feedIt(pushTime)
                     print("reward E") 
                     par['push_cnt_e'] += 1
                     par['rew_cnt'] += 1
@@ -663,13 +1044,14 @@ def training():
 
 
 def endBlock():
-    global slidingWindow
     print("Block ended")
     par['trial_cnt'] = 0
     par['curr_block'] += 1
     par['failed_trials'] = 0
     par['trial_suc_cnt'] = 0
-    slidingWindow=[0]*par['trials_in_block']
+    criterion.reset()
+    dataLogger.blockEnd()
+    saveParams("block")
     
 
 def blockSuccess():
@@ -682,72 +1064,78 @@ def blockSuccess():
             par['curr_test'] = par['loop_test']
 
 
-def blockFail():
+async def blockFail():
     print("Block failed")
     par['failed_blocks']+=1
     if par['failed_blocks'] >= par['max_failed_blocks'] and par['max_failed_blocks'] > 0:
         leds.turnBothOff()
-        timeout(int(par['failed_blocks_timout']*60))
+        await timeout(int(par['failed_blocks_timout']*60))
         par['failed_blocks']=0
         playSound("beep_hi.wav")
 
         
-def testing():
+async def testing():
     global push
     global prevAnswer
+    global shuffledTrials
+    global trialAnswer
+    global trialLedConfig
     
     print("Testing mode...")
     test_index = par['curr_test']
     if par['curr_test'] > len(tests) or test_index==0:
         return
     test = tests[test_index-1]    #subtract 1 because the count starts with zero
+    # The trials were compiled and checked by getParams(), so selecting one
+    # is just a lookup in the table for this test
+    table = trialTables[test]
     if test.startswith("random"):
         #choose an image from the list at random
-        answer = random.choice(testDict[test]) 
+        trial = rng.choice(table) 
     elif test.startswith("shuffle"):
         print("Shuffled tests list:", par["previous_shuffle"])
-        reshuffle=((par['trial_cnt'] % len(testDict[test]) == 0) and
+        reshuffle=((par['trial_cnt'] % len(table) == 0) and
                    (par['failed_current_trial'] == 0))
-        if reshuffle or len(par["previous_shuffle"])==0:
+        if reshuffle or len(shuffledTrials)==0:
             print("Shuffling tests")
-            par["previous_shuffle"] = testDict[test]
-            random.shuffle(par["previous_shuffle"])
-            answer = par["previous_shuffle"][0]
+            shuffledTrials = list(table)
+            rng.shuffle(shuffledTrials)
+            par["previous_shuffle"] = list(map(trialName, shuffledTrials))
+            trial = shuffledTrials[0]
         else:
             print("Selecting next image")
-            answer = par["previous_shuffle"][par['trial_cnt'] % len(par["previous_shuffle"])]
+            trial = shuffledTrials[par['trial_cnt'] % len(shuffledTrials)]
     else:
-        lisOfAnswers = testDict[test]
-        answer = lisOfAnswers[par['trial_cnt'] % len(lisOfAnswers)] 
-    answer, ledConfig = answer.split('-')
+        trial = table[par['trial_cnt'] % len(table)] 
+    answer = ANSWER_NAMES[trial[0]]
+    ledConfig = LED_NAMES[trial[1]]
     print("Test:", test, " ", answer)
     if answer == "S":
         answer = prevAnswer
     elif answer == "O":
         answer = OPPOSITE_ANSWERS[prevAnswer]
-    if answer not in LEGAL_ANSWERS:
-        if answer == "X":
-            #raise Exception("Answers based on previous input (S or O) cannot "
-            #                "be used in the first trial.")
-            answer="I"
-        else:
-            raise Exception("Answer " + str(answer) + " not a legal answer. "
-                            "Ensure the answer is in: " + str(LEGAL_ANSWERS))
+    if answer == "X":
+        #raise Exception("Answers based on previous input (S or O) cannot "
+        #                "be used in the first trial.")
+        answer="I"
     #get the time of initial detection
     leds.setLEDs(ledConfig)
-    timeStart = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') 
-    pushWait() #wait for button push or animal departure
+    trialAnswer = answer
+    trialLedConfig = ledConfig
+    publishCounters()
+    timeStart = clock.now().strftime('%Y-%m-%d %H:%M:%S') 
+    await pushWait() #wait for button push or animal departure
     #get the time of initial detection    
-    timeEnd = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') 
+    timeEnd = clock.now().strftime('%Y-%m-%d %H:%M:%S') 
     if push != "D": #animal pushed a button    
         if push == answer or answer == "E" or answer == "I":
             #if the animal got it right..
-            feedIt()
+            await feedIt(pushTime)
             print("test reward")
             par['trial_suc_cnt'] += 1  #advance count of successful trials 
             par['rew_cnt'] += 1   #advance total daily reward count
             par['failed_current_trial']=0
-            slidingWindow[par['trial_cnt'] % par['trials_in_block']] = 1
+            criterion.record(par['trial_cnt'], True)
             logIt(ID, "S", timeStart, timeEnd,push,answer)
             if answer == "I":
                 prevAnswer=push
@@ -756,31 +1144,28 @@ def testing():
             playSound("beep_low.wav")                    
             par['failed_trials']+=1
             par['failed_current_trial']+=1
-            slidingWindow[par['trial_cnt'] % par['trials_in_block']] = 0
+            criterion.record(par['trial_cnt'], False)
             logIt(ID, "F", timeStart, timeEnd,push,answer)
             # Change to monitor departure.
             leds.turnBothOff()
-            timeout(par['fail_delay'])
+            await timeout(par['fail_delay'])
             if par['fail_trial_repeat'] >= par['failed_current_trial']:
                 par['trial_cnt']-=1
             else:
                 par['failed_current_trial']=0
             if par['failed_trials'] >= par['max_failed_trails'] and par['max_failed_trails'] > 0:
-                timeout(par['failed_trails_timeout'])
+                await timeout(par['failed_trails_timeout'])
                 par['failed_trials']=0
                 playSound("beep_hi.wav")
         # JH: Trial count should be updated after logging, so the
         # correct number is logged
         par['trial_cnt'] += 1
-        if par["consecutive_block"]:
-            if sum(slidingWindow) >= par['block_suc_thresh']:
-                blockSuccess()
-                endBlock()
-        elif par['trial_cnt'] >= par['trials_in_block']:
-            if par['trial_suc_cnt'] >= par['block_suc_thresh']:
-                blockSuccess()
-            else:
-                blockFail()
+        result = criterion.decide(par['trial_cnt'], par['trial_suc_cnt'])
+        if result == PASSED:
+            blockSuccess()
+            endBlock()
+        elif result == FAILED:
+            await blockFail()
             endBlock()
                   
     else: #animal departed
@@ -795,6 +1180,19 @@ def main():
     global prev_push
     global timeStart
     global screen
+    global dataLogger
+    global binaryLog
+    global assets
+    global journal
+    global feeder
+    global profiler
+    global stateServer
+    global sharedCounters
+    global presence
+
+    if PROFILE:
+        profiler = SamplingProfiler(PROFILE_INTERVAL)
+        profiler.start()
 
     # Setup GPIO interface to feeder, IR, etc.
     GPIO.setmode(GPIO.BCM)
@@ -813,12 +1211,41 @@ def main():
     
     GPIO.output(PIN_MOTOR_RIGHT, 0) #motor in standby
     GPIO.output(PIN_MOTOR_LEFT, 0) #motor in standby
+    feeder = Feeder(GPIO, PIN_MOTOR_LEFT, PIN_MOTOR_RIGHT, PIN_MOTOR_SNAP,
+                    jamTimeout=FEEDER_JAM_TIMEOUT)
+    feeder.start()
     GPIO.output(PIN_IR_POWER, 0)  #turn off the IR sensor
     
     #Set up interrupts for when we are listening for button pushes on the monitor
-    GPIO.add_event_detect(PIN_JOY_LEFT, GPIO.FALLING, callback=pushed, bouncetime=500)    
-    GPIO.add_event_detect(PIN_JOY_RIGHT, GPIO.FALLING, callback=pushed, bouncetime=500)  
+    GPIO.add_event_detect(PIN_JOY_LEFT, GPIO.FALLING, callback=gpioEdge, bouncetime=500)    
+    GPIO.add_event_detect(PIN_JOY_RIGHT, GPIO.FALLING, callback=gpioEdge, bouncetime=500)  
+
+    # Keep track of the animal's presence in the background
+    presence = PresenceTracker(GPIO, p, PIN_IR_IN, PIN_IR_POWER,
+                               IR_SAMPLE_INTERVAL, IR_CONFIRM_SAMPLES, presenceEdge)
+    presence.start()
     
+    # Start writing the data file in the background
+    if LOG_FORMAT == "sqlite":
+        dataLogger = EventLogger(DATABASE_FILE, ID, LOG_COUNTERS, LOG_FLUSH_POLICY,
+                                 LOG_FLUSH_INTERVAL)
+    elif SEGMENT_DATA:
+        dataLogger = SegmentedLogger(DATA_FILE, LOG_FLUSH_POLICY, LOG_FLUSH_INTERVAL)
+    else:
+        dataLogger = DataLogger(DATA_FILE, LOG_FLUSH_POLICY, LOG_FLUSH_INTERVAL)
+    # Seed the trial selection and start the session in the data file with
+    # the seed, so the session can be replayed
+    seed = SEED if SEED is not None else random.SystemRandom().randrange(1 << 32)
+    rng.seed(seed)
+    sessionStart = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+    if LOG_FORMAT == "binary":
+        binaryLog = BinaryLog(ID, LOG_COUNTERS)
+        dataLogger.writeHeader(binaryLog.header(sessionStart, seed))
+    elif LOG_FORMAT == "sqlite":
+        dataLogger.startSession(sessionStart, seed)
+    else:
+        dataLogger.writeHeader(sessionLine(ID, sessionStart, seed))
+
     # Start pygame
     pygame.mixer.pre_init(22050, -16, 1, 1024) #Tradeoff between speed and fidelity here
     pygame.mixer.init()
@@ -828,13 +1255,16 @@ def main():
     else:
         screen = pygame.display.set_mode((1280,768), pygame.FULLSCREEN)
 
+    # Decode the images and sounds up front, so trials don't wait on the disk
+    assets = AssetCache(FOLDER, ASSET_CACHE_SIZE*1024*1024)
+    assets.preload(["black.jpg", "beep_low.wav", "beep_hi.wav"])
+
     # JH: While the current code is designed for working with LEDs, rather than
     # a screen, we'll show an empty screen so we can interface with pygame.
     showImg("black.jpg")
     leds.turnBothOn()
 
     getParams() #initialize parameters, just to avoid 'par not defined' errors
-    quitgame = 0    # Used as a flag to signal a keystroke--which stops the program
     push = "D"      # Indicates animal not present (D = departed)
     prev_push = "D" # Indicates there was no animal at the previous step either
 
@@ -843,6 +1273,71 @@ def main():
     par['failed_blocks'] = 0
     par['failed_current_trial'] = 0
 
+    # If the previous run did not get to save its state, continue from the journal
+    journal = Journal(JOURNAL_FILE, JOURNAL_SNAPSHOT_EVERY)
+    configHash = fileHash(CONFIG_FILE)
+    state = journal.recover(configHash)
+    if state:
+        restoreSession(state)
+    journal.snapshot(sessionState(), configHash)
+
+    if SHM_FILE:
+        try:
+            sharedCounters = SharedCounters(SHM_FILE,
+                [parameter.name for parameter in positionalParameters] + SHM_EXTRAS)
+        except OSError as err:
+            print("WARNING: Could not publish the counters in", SHM_FILE, ":", err)
+        publishCounters()
+    if CONTROL_SOCKET:
+        stateServer = StateServer(CONTROL_SOCKET, stateSnapshot)
+        try:
+            stateServer.start()
+        except OSError as err:
+            print("WARNING: Could not open the control socket", CONTROL_SOCKET, ":", err)
+            stateServer = None
+
+    asyncio.run(session())
+    cleanup()
+
+
+async def session():
+    # Input, timers and display each run as a task next to the trials. The
+    # feeder and the data file have threads of their own.
+    global pushChanged
+    global presenceChanged
+    global displayQueue
+    global timers
+    pushChanged = asyncio.Event()
+    presenceChanged = asyncio.Event()
+    displayQueue = asyncio.Queue()
+    timers = AsyncTimers(scheduler)
+    inputChannel.start(asyncio.get_running_loop())
+    installDumpSignal(asyncio.get_running_loop(), dumpLatencies)
+    try:
+        await runWithTasks(trialLoop(), inputTask(), timers.run(),
+                           displayTask())
+    finally:
+        removeDumpSignal(asyncio.get_running_loop())
+        inputChannel.stop()
+        displayQueue = None
+
+
+async def displayTask():
+    # Draws the images passed to showImg() and keeps pygame's events handled
+    while True:
+        try:
+            img = await asyncio.wait_for(displayQueue.get(), DISPLAY_INTERVAL)
+        except asyncio.TimeoutError:
+            pygame.event.pump()
+        else:
+            drawImg(img)
+
+
+async def trialLoop():
+    global push
+    global prev_push
+    global timeStart
+    quitgame = 0    # Used as a flag to signal a keystroke--which stops the program
     while quitgame == 0:
         # If there is no animal, wait for an animal
         if push == "D":
@@ -852,32 +1347,35 @@ def main():
                 # parameters
                 writeParam()
                 prev_push = "D"
-            quitgame = waitForAnimal()
+            quitgame = await waitForAnimal()
         elif par['rew_cnt'] < par['rew_max'] and par['curr_test'] <= len(tests):
             if par['curr_test'] == 0: #Training mode - not testing yet
-                training()
+                await training()
             else:  #Testing mode
-                testing()                
+                await testing()                
+            saveParams("trial")
+            journal.record(sessionState())
+            publishCounters()
         else:  #do the following if the reward maximum has been reached
             leds.turnBothOff()
             while True:
                 print("Out of reward, waiting for animal to leave...", flush=True)
                  #get the time of initial detection
-                timeStart = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')    
-                pushWait() #wait for button push or animal departure
+                timeStart = clock.now().strftime('%Y-%m-%d %H:%M:%S')    
+                await outOfRewardWait() #wait for button push or animal departure
                 if push == "D":  
                     break      #break infinite loop if animal has left.                
                 playSound("beep_low.wav")
                 #get the time of initial detection
-                timeEnd = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                timeEnd = clock.now().strftime('%Y-%m-%d %H:%M:%S')
                 #log data for entry reward
                 logIt(ID, "M", timeStart, timeEnd,push,"N") 
             writeParam()   
-    cleanup()
 
 
 # JH: General good practice; allows this file to be imported without running it
 if __name__ == "__main__":
+    PROFILE = PROFILE or "--profile" in sys.argv[1:]
     try:
         main()
     except SystemExit:
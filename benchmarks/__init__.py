@@ -0,0 +1 @@
+# Benchmarks for the puzzle box code
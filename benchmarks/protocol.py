@@ -0,0 +1,285 @@
+# Accelerated-time benchmark of the training and testing protocol
+#Licensed under the MIT License#
+"""
+Runs Coyote.py and Raccoon_Skunk.py in the simulation (see puzzlebox.sim) with
+a simulated animal pushing the buttons, for a set of configurations that go
+through training(), testing(), blockSuccess()/blockFail() and the daily reward
+cap, and reports for each:
+
+    trials_per_wall_second  trials simulated per second of real time
+    cpu_us_per_trial        CPU time per trial
+    retained_blocks_per_trial
+                            memory blocks still allocated afterwards, per trial
+    log_bytes_per_trial     size of the records in the data file, per trial
+    press_to_reward         real time from a button edge to the feeder
+                            starting to reward it (p50/p99/max in us)
+
+A trial is one handled button push (data records P, X, S, F and M); the
+session header lines are not records. retained_blocks_per_trial is the growth
+of sys.getallocatedblocks() over the session, i.e. what the session keeps, not
+how many allocations it makes; --memory also traces the peak memory with
+tracemalloc in a second, slower run. The virtual clock does not
+move while the program computes, so press_to_reward is taken on the real
+clock: it is the time the code of the program takes from the GPIO callback
+to the motor, without the hardware.
+
+The results are written to a JSON file. Pass the file of an earlier version
+with --compare to see which scenarios got slower.
+
+Run with: python -m benchmarks.protocol [--output protocol.json]
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from puzzlebox import binlog, clock
+from puzzlebox.latency import Histogram
+from puzzlebox.sim import install, loadProgram, run
+from puzzlebox.sim.clock import VirtualClock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Noon to noon is one reward day, so a session from 12:30 stays in one day
+START = datetime.datetime(2020, 6, 1, 12, 30)
+DAYS = 0.9
+TRIAL_EVENTS = "PXSFM"
+INSTRUMENTED = ("training", "testing", "blockSuccess", "blockFail")
+
+# Parameters of the configuration file for the tests, by name
+TESTING = {"curr_test": 1, "rew_day": START.day, "rew_max": 5000,
+           "loop_test": 1, "trials_in_block": 12, "block_suc_thresh": 9,
+           "blocks_to_pass": 2, "fail_delay": 5}
+TRAINING = {"curr_test": 0, "rew_day": START.day, "rew_max": 5000,
+            "push_reward_e": 1000, "push_reward_r": 400, "push_reward_l": 400}
+REWARD_CAP = dict(TESTING, rew_max=20)
+
+SCENARIOS = [
+    {"name": "coyote_training", "program": "Coyote.py", "params": TRAINING,
+     "named": {"tests": "fixed1", "fixed1": "L-L, R-R"}},
+    {"name": "coyote_fixed", "program": "Coyote.py", "params": TESTING,
+     "named": {"tests": "fixed1, random1",
+               "fixed1": "L-L, R-R, E-B, I-N, S-B, O-N",
+               "random1": "L-L, R-R, L-R, R-L"}},
+    {"name": "coyote_shuffle_consecutive", "program": "Coyote.py",
+     "params": dict(TESTING, consecutive_block=True, fail_trial_repeat=2),
+     "named": {"tests": "shuffle1", "shuffle1": "L-L, R-R, L-R, R-L"}},
+    {"name": "coyote_reward_cap", "program": "Coyote.py", "params": REWARD_CAP,
+     "named": {"tests": "shuffle1", "shuffle1": "L-L, R-R"}},
+    {"name": "raccoon_training", "program": "Raccoon_Skunk.py",
+     "params": TRAINING,
+     "named": {"tests": "fixed1", "fixed1": "L-L, R-R"}},
+    {"name": "raccoon_shuffle_consecutive", "program": "Raccoon_Skunk.py",
+     "params": dict(TESTING, consecutive_block=True, fail_trial_repeat=2,
+                    max_failed_blocks=3, failed_blocks_timout=10),
+     "named": {"tests": "shuffle1, fixed1",
+               "shuffle1": "L-L, R-R, L-R, R-L",
+               "fixed1": "L-L, R-R, E-B, I-N, S-B, O-N"}},
+    {"name": "raccoon_reward_cap", "program": "Raccoon_Skunk.py",
+     "params": REWARD_CAP,
+     "named": {"tests": "shuffle1", "shuffle1": "L-L, R-R"}},
+]
+# How the simulated animal behaves
+ANIMAL = {"accuracy": 0.75, "visitGap": 1800.0, "visitLength": 1800.0,
+          "pushGap": 10.0}
+
+
+def makeConfig(program, path, params, named):
+    # Let the program write its default configuration, then change it the
+    # way the program itself writes configuration files
+    install(VirtualClock(START))
+    module = loadProgram(program, "benchmark_config")
+    module.CONFIG_FILE = path
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        try:
+            module.getParams()
+        except SystemExit:
+            pass
+        module.getParams()
+    remaining = dict(params)
+    for parameter in module.positionalParameters:
+        if parameter.name in remaining:
+            parameter.value = remaining.pop(parameter.name)
+    if remaining:
+        raise KeyError("Unknown parameters for " + program + ": " +
+                       ", ".join(remaining))
+    named = dict(named, previous_shuffle="")
+    for test in list(module.namedParameters):
+        if test not in named and test not in module.settingNames:
+            del module.namedParameters[test]  # The example tests
+    for name, value in named.items():
+        if name in module.namedParameters:
+            module.namedParameters[name].value = value
+        else:
+            module.namedParameters[name] = module.Parameter(name, value, "", str, False)
+    module.writeCurrentParams()
+    del sys.modules["benchmark_config"]
+
+
+def instrument(module, calls, blocks, pressToReward):
+    # Count the calls to the protocol functions, time the presses to their
+    # rewards, and note the allocated blocks just before the session starts
+    for name in INSTRUMENTED:
+        function = getattr(module, name)
+        if asyncio.iscoroutinefunction(function):
+            async def counted(*args, _function=function, _name=name):
+                calls[_name] += 1
+                return await _function(*args)
+        else:
+            def counted(*args, _function=function, _name=name):
+                calls[_name] += 1
+                return _function(*args)
+        setattr(module, name, counted)
+
+    # The edge time the program takes (virtual) and the real time of the
+    # last button edge
+    lastEdge = [None, 0]
+    gpioEdge = module.gpioEdge
+
+    def timedEdge(channel):
+        lastEdge[:] = clock.monotonicNs(), time.perf_counter_ns()
+        gpioEdge(channel)
+
+    class TimedFeeder(module.Feeder):
+        def _feed(self, requested, timePushed):
+            if (timePushed is not None and timePushed == lastEdge[0] and
+                    not self.tooSoon()):
+                pressToReward.record(time.perf_counter_ns() - lastEdge[1])
+            return super()._feed(requested, timePushed)
+
+    module.gpioEdge = timedEdge
+    module.Feeder = TimedFeeder
+    blocks.append(sys.getallocatedblocks())
+
+
+def runScenario(scenario, folder, seed, memory):
+    config = os.path.join(folder, "config.txt")
+    makeConfig(os.path.join(ROOT, scenario["program"]), config,
+               scenario["params"], scenario["named"])
+    calls = collections.Counter()
+    blocks = []
+    pressToReward = Histogram()
+    result = run(os.path.join(ROOT, scenario["program"]), config, DAYS,
+                 folder, seed, START, quiet=True,
+                 prepare=lambda module: instrument(module, calls, blocks,
+                                                   pressToReward),
+                 **ANIMAL)
+    blocksAfter = sys.getallocatedblocks()
+    events = collections.Counter()
+    logBytes = 0
+    with open(result["data_file"], "rb") as dataFile:
+        for line in dataFile:
+            if line.startswith(binlog.SESSION_PREFIX.encode("ascii")):
+                continue
+            events[line.split(b",", 2)[1].decode("ascii")] += 1
+            logBytes += len(line)
+    trials = sum(events[event] for event in TRIAL_EVENTS)
+    perTrial = max(trials, 1)
+    report = {"program": scenario["program"],
+              "box_days": DAYS,
+              "trials": trials,
+              "records": sum(events.values()),
+              "events": dict(sorted(events.items())),
+              "calls": {name: calls[name] for name in INSTRUMENTED},
+              "wall_seconds": result["wall_seconds"],
+              "cpu_seconds": result["cpu_seconds"],
+              "trials_per_wall_second": round(trials / result["wall_seconds"], 1),
+              "cpu_us_per_trial": round(result["cpu_seconds"] * 1e6 / perTrial, 1),
+              "retained_blocks_per_trial": round((blocksAfter - blocks[0]) / perTrial, 2),
+              "log_bytes": logBytes,
+              "log_bytes_per_trial": round(logBytes / perTrial, 1),
+              "press_to_reward": {name: value for name, value
+                                  in pressToReward.summary().items()
+                                  if name != "buckets"}}
+    if memory:
+        # The first run saved its progress to the configuration file, so
+        # start again from a fresh one
+        folder = os.path.join(folder, "memory")
+        config = os.path.join(folder, "config.txt")
+        os.makedirs(folder)
+        makeConfig(os.path.join(ROOT, scenario["program"]), config,
+                   scenario["params"], scenario["named"])
+        tracemalloc.start()
+        run(os.path.join(ROOT, scenario["program"]), config, DAYS, folder,
+            seed, START, quiet=True, **ANIMAL)
+        report["peak_kib"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+    return report
+
+
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    print()
+    print("%-30s %14s %14s %8s" % ("scenario", "before (us)", "after (us)", "change"))
+    for name, report in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]["cpu_us_per_trial"]
+        after = report["cpu_us_per_trial"]
+        print("%-30s %14.1f %14.1f %+7.0f%%" % (name, before, after,
+                                                (after / before - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.protocol",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="protocol.json",
+                        help="JSON file for the results")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="results of an earlier version to compare with")
+    parser.add_argument("--scenario", action="append",
+                        help="only run this scenario (repeatable)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--memory", action="store_true",
+                        help="also trace the peak memory (slower)")
+    args = parser.parse_args()
+
+    results = collections.OrderedDict()
+    print("%-30s %8s %12s %12s %18s %10s %12s" % ("scenario", "trials",
+                                                  "trials/s", "cpu us/trial",
+                                                  "retained blk/trial",
+                                                  "bytes/trial", "reward p50 us"))
+    for scenario in SCENARIOS:
+        if args.scenario and scenario["name"] not in args.scenario:
+            continue
+        with tempfile.TemporaryDirectory() as folder:
+            report = runScenario(scenario, folder, args.seed, args.memory)
+        results[scenario["name"]] = report
+        print("%-30s %8d %12.1f %12.1f %18.2f %10.1f %12.1f" % (
+            scenario["name"], report["trials"], report["trials_per_wall_second"],
+            report["cpu_us_per_trial"], report["retained_blocks_per_trial"],
+            report["log_bytes_per_trial"],
+            report["press_to_reward"]["p50_us"]), flush=True)
+
+    output = {"version": gitVersion(),
+              "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "seed": args.seed,
+              "animal": ANIMAL,
+              "scenarios": results}
+    with open(args.output, "w") as resultFile:
+        json.dump(output, resultFile, indent=2)
+    print("Results written to", args.output)
+    if args.compare:
+        with open(args.compare) as previousFile:
+            compare(results, json.load(previousFile)["scenarios"])
+
+
+if __name__ == "__main__":
+    main()
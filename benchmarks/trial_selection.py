@@ -0,0 +1,110 @@
+# Microbenchmark for trial selection in testing()
+#Licensed under the MIT License#
+"""
+Compares the per-trial cost of selecting a trial the way testing() used to
+(splitting "L-L" strings and checking the answer on every trial) with the
+lookup in the tables compiled by getParams().
+
+Run with: python -m benchmarks.trial_selection
+"""
+import random
+import time
+
+from puzzlebox.trials import compileTrials, trialName, ANSWER_NAMES, LED_NAMES
+
+OPPOSITE_ANSWERS={"R":"L", "L":"R", "X":"X"}
+LEGAL_ANSWERS=["L", "R", "E", "I"]
+
+TESTS = {
+    "fixed1": ["L-L", "R-R", "S-B", "O-N", "E-B", "I-N"],
+    "random1": ["L-L", "R-R", "L-R", "R-L"],
+    "shuffle1": ["L-L", "R-R", "L-L", "R-R", "E-B", "O-N"],
+}
+TRIALS = 200000
+
+
+def stringSelection(test, testDict, par, prevAnswer):
+    # Trial selection as done by testing() before the trials were compiled
+    if test.startswith("random"):
+        answer = random.choice(testDict[test])
+    elif test.startswith("shuffle"):
+        reshuffle=((par['trial_cnt'] % len(testDict[test]) == 0) and
+                   (par['failed_current_trial'] == 0))
+        if reshuffle or len(par["previous_shuffle"])==0:
+            par["previous_shuffle"] = testDict[test]
+            random.shuffle(par["previous_shuffle"])
+            answer = par["previous_shuffle"][0]
+        else:
+            answer = par["previous_shuffle"][par['trial_cnt'] % len(par["previous_shuffle"])]
+    else:
+        lisOfAnswers = testDict[test]
+        answer = lisOfAnswers[par['trial_cnt'] % len(lisOfAnswers)]
+    answer, ledConfig = answer.split('-')
+    if answer == "S":
+        answer = prevAnswer
+    elif answer == "O":
+        answer = OPPOSITE_ANSWERS[prevAnswer]
+    if answer not in LEGAL_ANSWERS:
+        if answer == "X":
+            answer="I"
+        else:
+            raise Exception("Answer " + str(answer) + " not a legal answer. "
+                            "Ensure the answer is in: " + str(LEGAL_ANSWERS))
+    return answer, ledConfig
+
+
+def tableSelection(test, trialTables, par, prevAnswer, shuffled):
+    # Trial selection as done by testing() with compiled tables
+    table = trialTables[test]
+    if test.startswith("random"):
+        trial = random.choice(table)
+    elif test.startswith("shuffle"):
+        reshuffle=((par['trial_cnt'] % len(table) == 0) and
+                   (par['failed_current_trial'] == 0))
+        if reshuffle or len(shuffled)==0:
+            shuffled[:] = table
+            random.shuffle(shuffled)
+            par["previous_shuffle"] = list(map(trialName, shuffled))
+            trial = shuffled[0]
+        else:
+            trial = shuffled[par['trial_cnt'] % len(shuffled)]
+    else:
+        trial = table[par['trial_cnt'] % len(table)]
+    answer = ANSWER_NAMES[trial[0]]
+    ledConfig = LED_NAMES[trial[1]]
+    if answer == "S":
+        answer = prevAnswer
+    elif answer == "O":
+        answer = OPPOSITE_ANSWERS[prevAnswer]
+    if answer == "X":
+        answer="I"
+    return answer, ledConfig
+
+
+def run(test, compiled):
+    random.seed(1)
+    par = {'trial_cnt': 0, 'failed_current_trial': 0, 'previous_shuffle': []}
+    testDict = {key: list(trials) for key, trials in TESTS.items()}
+    trialTables = {key: compileTrials(trials, LEGAL_ANSWERS)
+                   for key, trials in TESTS.items()}
+    shuffled = []
+    start = time.perf_counter_ns()
+    for i in range(TRIALS):
+        par['trial_cnt'] = i
+        if compiled:
+            tableSelection(test, trialTables, par, "L", shuffled)
+        else:
+            stringSelection(test, testDict, par, "L")
+    return (time.perf_counter_ns() - start) / TRIALS
+
+
+def main():
+    print("%-10s %12s %12s %8s" % ("test", "before (ns)", "after (ns)", "speedup"))
+    for test in TESTS:
+        before = min(run(test, False) for _ in range(3))
+        after = min(run(test, True) for _ in range(3))
+        print("%-10s %12.0f %12.0f %7.2fx" % (test, before, after, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# Puzzle box support library
+#Licensed under the MIT License#
+"""
+Code shared by the puzzle box control programs (Coyote.py and
+Raccoon_Skunk.py). The control programs import the modules they need
+directly, e.g. ``from puzzlebox.datalog import DataLogger``.
+"""
@@ -0,0 +1,238 @@
+# Indexed reading of puzzle box data files
+#Licensed under the MIT License#
+"""
+Reads the data files written by logIt() (e.g. 06282018_COY1031P.txt) without
+scanning them line by line. A data file is memory-mapped, and a sidecar index
+(the data file name plus INDEX_SUFFIX) lists the byte ranges of the runs of
+records with the same day, curr_test and curr_block. A query only reads the
+ranges it needs. The day of a record is the noon-to-noon day of its first time
+stamp (see dayOf()), like the days of startDay(), the segments of
+puzzlebox.segments and the day column of puzzlebox.eventdb, so a block that
+runs past midnight stays one run. A day is given by the date it starts on.
+
+The index is brought up to date whenever a file is opened: records appended
+since it was written are indexed and added to it, and it is rebuilt if the
+file was replaced or shortened. A line that is still being written (without
+its newline) is left for the next time.
+
+Daily segments compressed by puzzlebox.segments (FILE.gz) are read into
+memory instead of being mapped; their index describes the uncompressed data.
+
+    with DataFile("06282018_COY1031P.txt") as data:
+        for line in data.lines(date="2018-06-28", test=3, block=range(5, 10)):
+            ...
+
+Run with: python -m puzzlebox.archive FILE... [--date D] [--test T] [--block B]
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+from puzzlebox.persist import atomicWrite
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 2
+# Days start at noon, as in startDay()
+DAY_START = datetime.timedelta(hours=12)
+# The start of the file is hashed to notice a replaced file
+_HEAD_SIZE = 4096
+_DATE, _TEST, _BLOCK, _START, _END, _COUNT = range(6)
+
+
+def dayOf(moment):
+    """The date of the noon-to-noon day that moment (a datetime) is in."""
+    return (moment - DAY_START).date()
+
+
+def _matches(wanted, value):
+    # None matches everything; a range or collection any of its values
+    if wanted is None:
+        return True
+    if isinstance(wanted, (int, str)):
+        return wanted == value
+    return value in wanted
+
+
+def _dateText(date):
+    if date is None or isinstance(date, str):
+        return date
+    if isinstance(date, datetime.datetime):
+        return dayOf(date).isoformat()
+    if isinstance(date, datetime.date):
+        return date.strftime('%Y-%m-%d')
+    return {_dateText(day) for day in date}
+
+
+class DataFile:
+    """
+    A memory-mapped data file with its index. Keep it open for several
+    queries, and close it (or use it in a with statement) when done.
+    """
+    def __init__(self, path, saveIndex=True):
+        self.path = path
+        self.indexPath = path + INDEX_SUFFIX
+        self.saveIndex = saveIndex
+        self._file = open(path, "rb")
+        self._map = None
+        if path.endswith(".gz"):
+            # Bytes can be searched and sliced like the map
+            with gzip.GzipFile(fileobj=self._file) as gz:
+                self._map = gz.read()
+            self.size = len(self._map)
+        else:
+            self.size = os.fstat(self._file.fileno()).st_size
+            if self.size > 0:
+                self._map = mmap.mmap(self._file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        self.runs = []
+        self.indexed = 0
+        self.updated = self._updateIndex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+        self._file.close()
+
+    def _head(self, size):
+        # Hash of the start of the file, up to size bytes
+        return hashlib.sha1(self._map[:min(size, _HEAD_SIZE)]).hexdigest()
+
+    def _loadIndex(self):
+        # The saved runs, if they still describe the start of this file
+        try:
+            with open(self.indexPath) as indexFile:
+                index = json.load(indexFile)
+        except (OSError, ValueError):
+            return
+        if index.get("version") != INDEX_VERSION:
+            return
+        indexed = index["indexed"]
+        if indexed == 0 or indexed > self.size:
+            return
+        if self._map[indexed - 1] != ord("\n") or index["head"] != self._head(indexed):
+            return
+        self.runs = index["runs"]
+        self.indexed = indexed
+
+    def _updateIndex(self):
+        # Index the records after self.indexed; returns True if any were added
+        if self._map is not None:
+            self._loadIndex()
+        if self.indexed == self.size:
+            return False
+        position = self.indexed
+        runs = self.runs
+        data = self._map
+        while True:
+            end = data.find(b"\n", position)
+            if end < 0:
+                break
+            end += 1
+            fields = data[position:end].split(b",", 6)
+            try:
+                time1 = datetime.datetime.fromisoformat(fields[2].decode("ascii"))
+                key = (dayOf(time1).isoformat(), int(fields[4]), int(fields[5]))
+            except (IndexError, ValueError):
+                key = None  # Not a record; it is not indexed
+            if key is not None:
+                last = runs[-1] if runs else None
+                if (last is not None and last[_END] == position and
+                        (last[_DATE], last[_TEST], last[_BLOCK]) == key):
+                    last[_END] = end
+                    last[_COUNT] += 1
+                else:
+                    runs.append([key[0], key[1], key[2], position, end, 1])
+            position = end
+        if position == self.indexed:
+            return False
+        self.indexed = position
+        if self.saveIndex:
+            self._writeIndex()
+        return True
+
+    def _writeIndex(self):
+        index = {"version": INDEX_VERSION, "indexed": self.indexed,
+                 "head": self._head(self.indexed), "runs": self.runs}
+        try:
+            atomicWrite(self.indexPath, json.dumps(index, separators=(",", ":")))
+        except OSError as err:
+            # A read-only archive still works, it is just indexed every time
+            print("WARNING: Could not write index", self.indexPath, ":", err,
+                  file=sys.stderr)
+
+    def ranges(self, date=None, test=None, block=None):
+        """
+        The (start, end, count) byte ranges of the records that match. date
+        is a day, as the 'YYYY-mm-dd' string or date it starts on, or as a
+        datetime in it; test and block are numbers. Each can also be a
+        collection or range of them, or None for any.
+        """
+        date = _dateText(date)
+        return [(run[_START], run[_END], run[_COUNT]) for run in self.runs
+                if _matches(date, run[_DATE]) and _matches(test, run[_TEST])
+                and _matches(block, run[_BLOCK])]
+
+    def lines(self, date=None, test=None, block=None):
+        """The matching lines, without their newlines, in file order."""
+        for start, end, count in self.ranges(date, test, block):
+            for line in self._map[start:end].decode("utf-8").splitlines():
+                yield line
+
+    def records(self, date=None, test=None, block=None):
+        """The matching lines split into their comma separated fields."""
+        for line in self.lines(date, test, block):
+            yield line.split(",")
+
+    def keys(self):
+        """The (date, curr_test, curr_block) of every run, in file order."""
+        return [(run[_DATE], run[_TEST], run[_BLOCK]) for run in self.runs]
+
+
+def query(paths, date=None, test=None, block=None):
+    """The matching lines of several data files, one file after the other."""
+    for path in paths:
+        with DataFile(path) as data:
+            yield from data.lines(date, test, block)
+
+
+def _numbers(text):
+    # "5" or "5-9" (inclusive), as used on the command line
+    if text is None:
+        return None
+    first, _, last = text.partition("-")
+    if not last:
+        return int(first)
+    return range(int(first), int(last) + 1)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="python -m puzzlebox.archive",
+                                     description="Print the records of data "
+                                                 "files for a date, test and "
+                                                 "blocks, using their index.")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--date", help="the day starting at noon on this date, "
+                                       "e.g. 2018-06-28")
+    parser.add_argument("--test", help="curr_test, e.g. 3 or 1-3")
+    parser.add_argument("--block", help="curr_block, e.g. 5 or 5-9")
+    args = parser.parse_args(args)
+    for line in query(args.files, args.date, _numbers(args.test),
+                      _numbers(args.block)):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+# Preloaded images and sounds for the puzzle box
+#Licensed under the MIT License#
+"""
+Cache of decoded images and sounds, so showing a stimulus or playing feedback
+does not have to read and decode a file from the USB stick during a trial.
+"""
+import collections
+import os
+
+import pygame
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif")
+SOUND_EXTENSIONS = (".wav", ".ogg")
+
+
+class AssetCache:
+    """
+    Images and sounds from a folder, decoded once and kept in memory.
+
+    Images are converted to the display format, so the display has to be set
+    up before they are loaded. Once the cache holds more than maxBytes, the
+    least recently used assets are dropped; they are loaded again from disk
+    (counted as a miss) the next time they are needed.
+    """
+    def __init__(self, folder, maxBytes=64*1024*1024):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._assets = collections.OrderedDict()
+
+    def preload(self, first=()):
+        """
+        Load the images and sounds in the folder until the cache is full. The
+        assets named in first are loaded before all others. A file that cannot
+        be read is skipped with a warning; it is loaded when it is needed, as
+        without preloading.
+        """
+        names = sorted(os.listdir(self.folder))
+        names = [n for n in first if n in names] + [n for n in names if n not in first]
+        for name in names:
+            extension = os.path.splitext(name)[1].lower()
+            if extension in IMAGE_EXTENSIONS:
+                loader = self._loadImage
+            elif extension in SOUND_EXTENSIONS:
+                loader = self._loadSound
+            else:
+                continue
+            if name in self._assets:
+                continue
+            try:
+                # An image decodes to more than its file and a sound to about
+                # as much, so stop before decoding one that will not fit
+                if self.size + os.path.getsize(os.path.join(self.folder, name)) > self.maxBytes:
+                    break
+                asset, size = loader(name)
+            except (pygame.error, OSError) as err:
+                print("WARNING: Could not preload", name, ":", err, flush=True)
+                continue
+            if self.size + size > self.maxBytes:
+                break
+            self._store(name, asset, size)
+        print("Preloaded", len(self._assets), "assets,",
+              self.size // 1024, "kB", flush=True)
+
+    def image(self, name):
+        """Return the image surface for a file in the folder."""
+        return self._get(name, self._loadImage)
+
+    def sound(self, name):
+        """Return the pygame.mixer.Sound for a file in the folder."""
+        return self._get(name, self._loadSound)
+
+    def stats(self):
+        return {"assets": len(self._assets), "bytes": self.size,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def _get(self, name, loader):
+        entry = self._assets.get(name)
+        if entry is not None:
+            self.hits += 1
+            self._assets.move_to_end(name)
+            return entry[0]
+        self.misses += 1
+        asset, size = loader(name)
+        self._store(name, asset, size)
+        return asset
+
+    def _store(self, name, asset, size):
+        self._assets[name] = (asset, size)
+        self.size += size
+        # Always keep the newest asset, even if it is larger than the cache
+        while self.size > self.maxBytes and len(self._assets) > 1:
+            _, (_, oldSize) = self._assets.popitem(last=False)
+            self.size -= oldSize
+            self.evictions += 1
+
+    def _loadImage(self, name):
+        surface = pygame.image.load(os.path.join(self.folder, name)).convert()
+        return surface, surface.get_pitch() * surface.get_height()
+
+    def _loadSound(self, name):
+        sound = pygame.mixer.Sound(os.path.join(self.folder, name))
+        frequency, sampleFormat, channels = pygame.mixer.get_init()
+        samples = int(sound.get_length() * frequency)
+        return sound, samples * channels * abs(sampleFormat) // 8
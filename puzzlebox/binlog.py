@@ -0,0 +1,226 @@
+# Binary data log for the puzzle box
+#Licensed under the MIT License#
+"""
+Compact fixed-width records for the data file, as an alternative to the comma
+separated lines written by logIt(). A record holds the event code, the LED
+bitmask, the push and the correct answer as single bytes, a monotonic
+timestamp in nanoseconds, the two wall clock times as whole seconds, the
+counters and reward count as 32 bit integers and, since version 2, the trial
+timestamps of puzzlebox.timing in nanoseconds.
+
+Every session starts with a header: a zero byte and MAGIC, the format version
+and the length of a JSON description of the records (the animal ID, the
+names of the counters and the start time and random seed of the session).
+Records start with their event code, which is never a zero byte, so sessions
+appended to the same file can be told apart. CSV data files start every
+session with a line of the same information, see sessionLine().
+
+toCsv() converts a binary file back to exactly the lines logIt() would have
+written. Run with: python -m puzzlebox.binlog DATA_FILE [CSV_FILE]
+"""
+import datetime
+import json
+import struct
+import sys
+
+from puzzlebox.timing import reactionText
+
+MAGIC = b"\x00PZLOG"
+VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+# Version and length of the JSON description that follows
+_HEADER = struct.Struct("<HI")
+# Event, LEDs, push, correct, monotonic ns, time1, time2; then the counters
+_RECORD = "<cBccqII"
+_COUNTER = "i"
+# Onset, edge, feed start and feed end (version 2)
+_TIMES = "qqqq"
+
+# Starts the line at the start of a session in a CSV data file
+SESSION_PREFIX = "#session"
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_SECOND = datetime.timedelta(seconds=1)
+_LED_TEXT = ["Left: " + left + " Right: " + right
+             for right in ("Off", "On") for left in ("Off", "On")]
+
+
+def ledMask(left, right):
+    """The LED bitmask: bit 0 for the left LED, bit 1 for the right one."""
+    return bool(left) | bool(right) << 1
+
+
+def ledText(mask):
+    """The LEDs as written by str() of the LEDS class in the programs."""
+    return _LED_TEXT[mask]
+
+
+def _seconds(timeText):
+    # 'YYYY-mm-dd HH:MM:SS' as whole seconds since 1970, in local time
+    return (datetime.datetime.fromisoformat(timeText) - _EPOCH) // _SECOND
+
+
+def _timeText(seconds):
+    return (_EPOCH + datetime.timedelta(seconds=seconds)).isoformat(" ")
+
+
+def sessionLine(animalId, start, seed):
+    """
+    The line written at the start of a session in a CSV data file, e.g.
+    "#session,id=1031,start=2018-06-28 12:30:00,seed=12345". It has too few
+    fields to be read as a record.
+    """
+    return "%s,id=%s,start=%s,seed=%d" % (SESSION_PREFIX, animalId, start, seed)
+
+
+def parseSessionLine(line):
+    """
+    The id, start time and seed (an int) of a line made by sessionLine(), as
+    a dict, or None if the line is not one.
+    """
+    fields = line.rstrip("\r\n").split(",")
+    if fields[0] != SESSION_PREFIX:
+        return None
+    session = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+    if "seed" in session:
+        session["seed"] = int(session["seed"])
+    return session
+
+
+def _recordStruct(counters, version=VERSION):
+    times = _TIMES if version >= 2 else ""
+    return struct.Struct(_RECORD + _COUNTER * (len(counters) + 1) + times)
+
+
+class BinaryLog:
+    """
+    Packs records for one animal. counters names the parameters logged
+    between the times and the LEDs, in the order logIt() writes them.
+    """
+    def __init__(self, animalId, counters):
+        self.animalId = str(animalId)
+        self.counters = list(counters)
+        self._struct = _recordStruct(self.counters)
+        self.recordSize = self._struct.size
+
+    def header(self, start=None, seed=None):
+        """
+        The header to write at the start of every session; start is the
+        'YYYY-mm-dd HH:MM:SS' time the session started and seed the seed of
+        its random trial selection.
+        """
+        description = {"id": self.animalId, "counters": self.counters}
+        if start is not None:
+            description["start"] = start
+            description["seed"] = seed
+        description = json.dumps(description).encode("utf-8")
+        return MAGIC + _HEADER.pack(VERSION, len(description)) + description
+
+    def record(self, event, time1, time2, counts, leds, push, correct,
+               rewards, monotonicNs, times):
+        """
+        Pack a record. time1 and time2 are 'YYYY-mm-dd HH:MM:SS' strings,
+        counts the values of the counters, leds the LED bitmask and times the
+        values() of the puzzlebox.timing.TrialTimes.
+        """
+        return self._struct.pack(event.encode("ascii"), leds,
+                                 push.encode("ascii"), correct.encode("ascii"),
+                                 monotonicNs, _seconds(time1), _seconds(time2),
+                                 *counts, rewards, *times)
+
+
+def _readExactly(inFile, size):
+    data = inFile.read(size)
+    if len(data) != size:
+        raise ValueError("Binary log ends in the middle of a record")
+    return data
+
+
+def _readHeader(inFile):
+    if _readExactly(inFile, len(MAGIC) - 1) != MAGIC[1:]:
+        raise ValueError("Not a binary log header")
+    version, length = _HEADER.unpack(_readExactly(inFile, _HEADER.size))
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError("Binary log version " + str(version) +
+                         " is not supported (expected one of " +
+                         str(SUPPORTED_VERSIONS) + ")")
+    description = json.loads(_readExactly(inFile, length).decode("utf-8"))
+    description["version"] = version
+    return description
+
+
+def records(inFile, headers=False):
+    """
+    Yield (description, fields) for every record of a binary file opened for
+    reading bytes. fields is the tuple packed by BinaryLog.record(). With
+    headers, (description, None) is also yielded at the start of a session.
+    """
+    description = None
+    recordStruct = None
+    while True:
+        first = inFile.read(1)
+        if not first:
+            return
+        if first == b"\x00":
+            description = _readHeader(inFile)
+            recordStruct = _recordStruct(description["counters"],
+                                         description["version"])
+            if headers:
+                yield description, None
+            continue
+        if recordStruct is None:
+            raise ValueError("Binary log does not start with a header")
+        data = first + _readExactly(inFile, recordStruct.size - 1)
+        yield description, recordStruct.unpack(data)
+
+
+def csvLine(description, fields):
+    """The line logIt() writes for a record, without the newline."""
+    event, leds, push, correct, monotonicNs, time1, time2 = fields[:7]
+    rewardsAt = 7 + len(description["counters"])
+    values = [description["id"], event.decode("ascii"), _timeText(time1),
+              _timeText(time2)]
+    values.extend(map(str, fields[7:rewardsAt]))
+    values.extend((ledText(leds), push.decode("ascii"),
+                   correct.decode("ascii"), str(fields[rewardsAt])))
+    if description["version"] >= 2:
+        onset, edge = fields[rewardsAt + 1:rewardsAt + 3]
+        values.append(reactionText(onset, edge))
+    return ",".join(values)
+
+
+def toCsv(inFile, outFile):
+    """
+    Convert a binary log (opened for reading bytes) to CSV lines on outFile
+    (opened for writing text), one record at a time. Returns the number of
+    records.
+    """
+    count = 0
+    for description, fields in records(inFile, headers=True):
+        if fields is None:
+            if "start" in description:
+                outFile.write(sessionLine(description["id"], description["start"],
+                                          description["seed"]))
+                outFile.write("\n")
+            continue
+        outFile.write(csvLine(description, fields))
+        outFile.write("\n")
+        count += 1
+    return count
+
+
+def main(args):
+    if len(args) not in (1, 2):
+        print("Usage: python -m puzzlebox.binlog DATA_FILE [CSV_FILE]")
+        return 2
+    with open(args[0], "rb") as inFile:
+        if len(args) == 2:
+            with open(args[1], "w", newline="\n") as outFile:
+                toCsv(inFile, outFile)
+        else:
+            toCsv(inFile, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
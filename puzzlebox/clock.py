@@ -0,0 +1,95 @@
+# Clock for the puzzle box
+#Licensed under the MIT License#
+"""
+The timestamps, sleeps and background threads of the puzzle box go through
+this module, so the simulation (see puzzlebox.sim) can swap the real clock for
+a virtual one. With the real clock the functions below are the ones from the
+time, datetime and threading modules. Only the flush timer of the data logger
+and the sampling profiler always run on the real clock, as they do not affect
+the session.
+"""
+import datetime
+import threading
+import time
+
+
+class RealClock:
+    """The wall clock; waits block the calling thread for real."""
+    def monotonic(self):
+        return time.monotonic()
+
+    def monotonicNs(self):
+        return time.monotonic_ns()
+
+    def perfCounter(self):
+        return time.perf_counter()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def event(self):
+        return threading.Event()
+
+    def condition(self):
+        return threading.Condition()
+
+    def startThread(self, target, name):
+        """Start target on a daemon thread; returns an object with join()."""
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
+
+
+_clock = RealClock()
+
+
+def setClock(clock):
+    """Use clock from now on. Set it before the programs are started."""
+    global _clock
+    _clock = clock
+
+
+def getClock():
+    return _clock
+
+
+def monotonic():
+    """Seconds on a clock that never goes back, as time.monotonic()."""
+    return _clock.monotonic()
+
+
+def monotonicNs():
+    """monotonic() in whole nanoseconds, as time.monotonic_ns()."""
+    return _clock.monotonicNs()
+
+
+def perfCounter():
+    """High resolution seconds for measuring latencies, as time.perf_counter()."""
+    return _clock.perfCounter()
+
+
+def now():
+    """The local date and time, as datetime.datetime.now()."""
+    return _clock.now()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def event():
+    """A new threading.Event that waits on this clock."""
+    return _clock.event()
+
+
+def condition():
+    """A new threading.Condition that waits on this clock."""
+    return _clock.condition()
+
+
+def startThread(target, name):
+    """Run target on a background thread that waits on this clock."""
+    return _clock.startThread(target, name)
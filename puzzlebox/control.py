@@ -0,0 +1,93 @@
+# Live state of the puzzle box over a Unix socket
+#Licensed under the MIT License#
+"""
+A read-only control socket. Every connection to the Unix socket gets one JSON
+snapshot of the session (counters, LEDs, feeder, latencies), followed by a
+newline, and is closed. The server runs on a thread of its own and only
+copies the state, which is safe under the GIL, so the trial loop never waits
+for it.
+
+Query a running box with: python -m puzzlebox.control SOCKET
+"""
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+
+class _SnapshotHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            state = self.server.snapshot()
+        except Exception as err:
+            state = {"error": repr(err)}
+        data = json.dumps(state, default=str) + "\n"
+        self.request.sendall(data.encode("utf-8"))
+
+
+class StateServer:
+    """
+    Serves snapshot() as JSON on the Unix socket at path. snapshot is called
+    on the server thread, so it must only read the state.
+    """
+    def __init__(self, path, snapshot):
+        self.path = path
+        self.snapshot = snapshot
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start serving. Raises an OSError if the socket cannot be made, e.g.
+        its folder cannot be written.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            print("WARNING: Unix sockets are not available, no control socket",
+                  flush=True)
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left behind by a crashed run
+        self._server = socketserver.UnixStreamServer(self.path, _SnapshotHandler)
+        self._server.snapshot = self.snapshot
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="StateServer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def query(path, timeout=5):
+    """Read a snapshot from the control socket of a running box."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+def main(args):
+    if len(args) != 1:
+        print("Usage: python -m puzzlebox.control SOCKET")
+        return 2
+    print(json.dumps(query(args[0]), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+# Block criteria for the puzzle box
+#Licensed under the MIT License#
+"""
+Criteria that decide when a block of trials ends and whether it was passed.
+Every criterion keeps running statistics, so recording a trial and deciding
+on the block take constant time, whatever the size of the block or window.
+
+A criterion is told the outcome of every trial with record(), and is asked
+for a decision with decide() after the trial count has been advanced.
+decide() returns PASSED or FAILED when the block ends, or None if it goes on.
+"""
+import math
+
+PASSED = "passed"
+FAILED = "failed"
+
+
+class BlockCriterion:
+    """
+    Base class for the criteria. trialsInBlock is the block (or window) size
+    and threshold the number of successful trials needed to pass.
+    """
+    name = None
+
+    def __init__(self, trialsInBlock, threshold):
+        self.trialsInBlock = trialsInBlock
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        """Start a new block."""
+        pass
+
+    def record(self, trialIndex, success):
+        """Record the outcome of the trial with the given index in the block."""
+        pass
+
+    def decide(self, trialCount, successCount):
+        """
+        Decide on the block after trialCount trials, of which successCount
+        were successful.
+        """
+        raise NotImplementedError
+
+    def state(self):
+        """The running statistics, as a dict that can be stored as JSON."""
+        return {}
+
+    def restore(self, state):
+        """Continue from statistics returned by state()."""
+        pass
+
+
+class FixedBlock(BlockCriterion):
+    """
+    Blocks of trialsInBlock trials, passed when at least threshold of them
+    were successful.
+    """
+    name = "fixed"
+
+    def decide(self, trialCount, successCount):
+        if trialCount < self.trialsInBlock:
+            return None
+        return PASSED if successCount >= self.threshold else FAILED
+
+
+class SlidingWindow(BlockCriterion):
+    """
+    Passed as soon as threshold of the last trialsInBlock trials were
+    successful; never failed. Outcomes are kept in a ring buffer with a
+    running sum.
+    """
+    name = "sliding"
+
+    def reset(self):
+        self.window = [0] * self.trialsInBlock
+        self.total = 0
+
+    def record(self, trialIndex, success):
+        # A repeated trial keeps its index, so it replaces the failed attempt
+        slot = trialIndex % self.trialsInBlock
+        value = 1 if success else 0
+        self.total += value - self.window[slot]
+        self.window[slot] = value
+
+    def decide(self, trialCount, successCount):
+        return PASSED if self.total >= self.threshold else None
+
+    def state(self):
+        return {"window": list(self.window)}
+
+    def restore(self, state):
+        if len(state["window"]) == self.trialsInBlock:
+            self.window = list(state["window"])
+            self.total = sum(self.window)
+
+
+class Streak(BlockCriterion):
+    """Passed after threshold consecutive successful trials; never failed."""
+    name = "streak"
+
+    def reset(self):
+        self.streak = 0
+
+    def record(self, trialIndex, success):
+        self.streak = self.streak + 1 if success else 0
+
+    def decide(self, trialCount, successCount):
+        return PASSED if self.streak >= self.threshold else None
+
+    def state(self):
+        return {"streak": self.streak}
+
+    def restore(self, state):
+        self.streak = state["streak"]
+
+
+class Binomial(BlockCriterion):
+    """
+    Blocks of trialsInBlock trials, passed when the number of successful
+    trials is unlikely to be reached by choosing at random: the chance of at
+    least that many successes at the given chance level must be at most
+    alpha. The threshold is ignored; the number of successes needed is
+    worked out once, when the criterion is made. Raises a ValueError if no
+    block could ever pass, or every block would.
+    """
+    name = "binomial"
+
+    def __init__(self, trialsInBlock, threshold, alpha=0.05, chance=0.5):
+        self.alpha = alpha
+        self.chance = chance
+        self.needed = self.successesNeeded(trialsInBlock, alpha, chance)
+        if self.needed > trialsInBlock:
+            raise ValueError("Binomial criterion: no block of " + str(trialsInBlock) +
+                             " trials can pass, as even all successful is more "
+                             "likely than " + str(alpha) + " by chance. Increase "
+                             "trials_in_block or criterion_alpha.")
+        if self.needed == 0:
+            raise ValueError("Binomial criterion: every block passes with "
+                             "criterion_alpha " + str(alpha) + "; it must be "
+                             "below 1.")
+        super().__init__(trialsInBlock, threshold)
+
+    @staticmethod
+    def successesNeeded(trials, alpha, chance):
+        """Smallest number of successes with a chance of at most alpha."""
+        tail = 0.0
+        for successes in range(trials, -1, -1):
+            tail += (math.comb(trials, successes) * chance ** successes *
+                     (1 - chance) ** (trials - successes))
+            if tail > alpha:
+                return successes + 1
+        return 0
+
+    def decide(self, trialCount, successCount):
+        if trialCount < self.trialsInBlock:
+            return None
+        return PASSED if successCount >= self.needed else FAILED
+
+
+CRITERIA = {criterion.name: criterion
+            for criterion in (FixedBlock, SlidingWindow, Streak, Binomial)}
+
+
+def createCriterion(name, trialsInBlock, threshold, alpha=0.05):
+    """
+    Make the criterion with the given name. Raises a ValueError if there is
+    no such criterion, or no block could ever pass it.
+    """
+    if name not in CRITERIA:
+        raise ValueError("Block criterion " + repr(name) + " not known. "
+                         "Ensure it is in: " + str(list(CRITERIA)))
+    if trialsInBlock < 1:
+        raise ValueError("trials_in_block (" + str(trialsInBlock) + ") must be "
+                         "at least 1.")
+    if name in (FixedBlock.name, SlidingWindow.name) and threshold > trialsInBlock:
+        raise ValueError("Block criterion " + repr(name) + ": no block can pass, "
+                         "as block_suc_thresh (" + str(threshold) + ") is more "
+                         "than trials_in_block (" + str(trialsInBlock) + ").")
+    if name == Binomial.name:
+        return Binomial(trialsInBlock, threshold, alpha)
+    return CRITERIA[name](trialsInBlock, threshold)
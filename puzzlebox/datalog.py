@@ -0,0 +1,170 @@
+# Buffered data logging for the puzzle box
+#Licensed under the MIT License#
+"""
+Write-behind logger for the data file. Lines are put on a bounded queue by the
+trial loop and written by a background thread, which keeps the file open
+instead of opening and closing it for every event. Besides text lines it
+writes bytes as they are, for the binary format of puzzlebox.binlog. The
+writer can also be moved to another file, for the daily segments of
+puzzlebox.segments. Subclasses can store the records elsewhere, see
+puzzlebox.eventdb.
+"""
+import os
+import queue
+import threading
+import time
+
+# Flush policies: when written lines are flushed and synced to the disk
+FLUSH_RECORD = "record"      # After every line
+FLUSH_INTERVAL = "interval"  # At most every flushInterval milliseconds
+FLUSH_BLOCK = "block"        # At the end of every block (see blockEnd())
+FLUSH_POLICIES = (FLUSH_RECORD, FLUSH_INTERVAL, FLUSH_BLOCK)
+
+# Messages for the writer thread, next to the lines themselves
+_FLUSH = "flush"
+_BLOCK = "block"
+_REOPEN = "reopen"
+_STOP = "stop"
+
+
+class DataLogger:
+    """
+    Appends lines to a file from a background thread.
+
+    write() only blocks when maxQueued lines are waiting to be written. Errors
+    from the writer thread (e.g. a removed USB stick) are raised by the next
+    call to write(), so they still end up in the error log.
+    """
+    # The errors of writing that are passed on to write()
+    errors = (OSError,)
+
+    def __init__(self, path, policy=FLUSH_INTERVAL, flushInterval=1000,
+                 maxQueued=1000):
+        if policy not in FLUSH_POLICIES:
+            raise ValueError("Flush policy " + str(policy) + " not in: " +
+                             str(FLUSH_POLICIES))
+        self.path = path
+        self.policy = policy
+        self.flushInterval = flushInterval / 1000
+        self.error = None
+        self.closed = False
+        self._queue = queue.Queue(maxQueued)
+        self._file = self._open(path)
+        self._thread = threading.Thread(target=self._run, name="DataLogger",
+                                        daemon=True)
+        self._thread.start()
+
+    def write(self, line, timeText=None):
+        """
+        Queue a line (without the newline) for writing. Bytes, e.g. binary
+        records, are written without a newline. timeText is the
+        'YYYY-mm-dd HH:MM:SS' time of a record, for loggers that file the
+        records by their time (see puzzlebox.segments); it is not written.
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        self._queue.put(line)
+
+    def writeHeader(self, header):
+        """Write the line (or bytes) that starts a session."""
+        self.write(header)
+
+    def reopen(self, path, closed=None):
+        """
+        Write the lines queued so far to the current file, then close it and
+        append the next ones to path. closed(oldPath) is called from the
+        writer thread once the old file is synced and closed.
+        """
+        self._queue.put((_REOPEN, (path, closed)))
+
+    def blockEnd(self):
+        """Mark the end of a block; flushes the file with the block policy."""
+        if self.policy == FLUSH_BLOCK:
+            self._queue.put((_BLOCK, None))
+
+    def flush(self, timeout=5):
+        """Wait until all queued lines are written and synced to the disk."""
+        if self.closed or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait(timeout)
+
+    def close(self, timeout=5):
+        """Write all queued lines, then stop the writer and close the file."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._thread.is_alive():
+            self._queue.put((_STOP, None))
+            self._thread.join(timeout)
+
+    # Where the records go; a subclass can override these four
+    def _open(self, path):
+        return open(path, 'ab')
+
+    def _write(self, item):
+        if isinstance(item, str):
+            item = (item + "\n").encode()
+        self._file.write(item)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        self._file.close()
+
+    def _handle(self, item):
+        # Returns True when the lines written so far still need to be synced.
+        # Messages are tuples, anything else is a record.
+        if not isinstance(item, tuple):
+            self._write(item)
+            if self.policy == FLUSH_RECORD:
+                self._sync()
+                return False
+            return True
+        self._sync()
+        if item[0] == _STOP:
+            self._close()
+        elif item[0] == _REOPEN:
+            # Open the new file first, so the old one is kept if it fails
+            path, closed = item[1]
+            newFile = self._open(path)
+            self._close()
+            oldPath, self.path, self._file = self.path, path, newFile
+            if closed is not None:
+                closed(oldPath)
+        return False
+
+    def _run(self):
+        dirty = False
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                item = (_FLUSH, None)
+            else:
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = (_FLUSH, None)
+            try:
+                dirty = self._handle(item)
+            except self.errors as err:
+                print("ERROR: Could not write to", self.path, ":", err,
+                      flush=True)
+                self.error = err
+                dirty = False
+            if not dirty:
+                deadline = None
+            elif self.policy == FLUSH_INTERVAL and deadline is None:
+                deadline = time.monotonic() + self.flushInterval
+            if isinstance(item, tuple):
+                if item[0] in (_FLUSH, _BLOCK) and item[1] is not None:
+                    item[1].set()
+                if item[0] == _STOP:
+                    return
@@ -0,0 +1,94 @@
+# asyncio session engine for the puzzle box
+#Licensed under the MIT License#
+"""
+Building blocks for running a session as a set of asyncio tasks: one for
+input, one for the feeder, one for the timers and one for the display, next
+to the task that runs the trials. The GPIO library calls its callbacks on its
+own thread; InputChannel hands those events over to the event loop.
+"""
+import asyncio
+
+
+class InputChannel:
+    """
+    Passes events from other threads (e.g. GPIO callbacks) to a task on the
+    event loop. Events posted before start() are dropped.
+    """
+    def __init__(self):
+        self.loop = None
+        self._queue = None
+
+    def start(self, loop):
+        self.loop = loop
+        self._queue = asyncio.Queue()
+
+    def stop(self):
+        self.loop = None
+
+    def post(self, *event):
+        """Post an event; safe to call from any thread."""
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    async def get(self):
+        """Wait for the next event."""
+        return await self._queue.get()
+
+
+class AsyncTimers:
+    """
+    Runs the timers of a puzzlebox.scheduler.Scheduler from an asyncio task,
+    sleeping until the next deadline. Timers that are added while it sleeps
+    wake it up.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._changed = asyncio.Event()
+        scheduler.onChange = self._changed.set
+
+    async def run(self):
+        while True:
+            timeout = self.scheduler.timeUntilNext()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self._changed.clear()
+            self.scheduler.runDue()
+
+    async def sleep(self, name, delay):
+        """Sleep for delay seconds, using a timer with the given name."""
+        done = asyncio.get_running_loop().create_future()
+
+        def wake():
+            if not done.done():
+                done.set_result(None)
+        self.scheduler.schedule(name, delay, wake)
+        try:
+            await done
+        finally:
+            self.scheduler.cancel(name)
+
+
+async def runWithTasks(main, *tasks):
+    """
+    Run the coroutine main while the given background coroutines run as
+    separate tasks. The background tasks are cancelled once main returns; if
+    one of them fails, main is cancelled and the error is raised.
+    """
+    background = [asyncio.ensure_future(task) for task in tasks]
+    mainTask = asyncio.ensure_future(main)
+    try:
+        done, _ = await asyncio.wait([mainTask] + background,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task is not mainTask:
+                task.result()  # Raises the error of the failed task
+                raise RuntimeError("Background task stopped: " + repr(task))
+        return mainTask.result()
+    finally:
+        for task in background + [mainTask]:
+            task.cancel()
+        await asyncio.gather(*background, mainTask, return_exceptions=True)
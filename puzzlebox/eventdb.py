@@ -0,0 +1,196 @@
+# SQLite event database for the puzzle box
+#Licensed under the MIT License#
+"""
+Stores the records of logIt() in an SQLite database instead of the data file,
+with LOG_FORMAT="sqlite". Every record is a row of the events table: the box
+ID, the event code, the day and times, the counters of LOG_COUNTERS (test,
+block, trial and failure counters), the LEDs as a bitmask (bit 0 left, bit 1
+right), push, correct, rew_cnt and the reaction time in milliseconds. Every
+session is a row of the sessions table, with its start time and seed. The
+events are indexed on (day, curr_test, curr_block). The day runs from noon to
+noon, like the days that reset curr_test and curr_block (see
+puzzlebox.archive.dayOf()), so a block never spans two days.
+
+The database is in WAL mode, so it can be queried while a box writes to it.
+The rows are inserted by the logger thread and committed in one transaction
+per flush of LOG_FLUSH_POLICY: every "record", at most every
+LOG_FLUSH_INTERVAL milliseconds ("interval"), or every "block".
+
+The databases of several boxes can be queried together; connect() attaches
+them and joins their events in the all_events view:
+
+    python -m puzzlebox.eventdb events_1031.sqlite events_129.sqlite --id 1031
+
+prints the accuracy of every block, and --sql runs any query on all_events.
+"""
+import argparse
+import datetime
+import sqlite3
+import sys
+
+from puzzlebox.archive import dayOf
+from puzzlebox.datalog import FLUSH_INTERVAL, DataLogger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    box TEXT NOT NULL,
+    start TEXT,
+    seed INTEGER
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions(id),
+    box TEXT NOT NULL,
+    event TEXT NOT NULL,
+    day TEXT NOT NULL,
+    time1 TEXT NOT NULL,
+    time2 TEXT NOT NULL,
+    curr_test INTEGER,
+    curr_block INTEGER,
+    trial_cnt INTEGER,
+    failed_current_trial INTEGER,
+    failed_trials INTEGER,
+    failed_blocks INTEGER,
+    reset_blocks INTEGER,
+    leds INTEGER,
+    push TEXT,
+    correct TEXT,
+    rew_cnt INTEGER,
+    reaction_ms REAL
+);
+CREATE INDEX IF NOT EXISTS events_day_test_block
+    ON events (day, curr_test, curr_block);
+"""
+# Columns of the events of every database, for all_events. reset_blocks is
+# only counted by Coyote.py and is NULL for Raccoon_Skunk.py.
+COMMON_COLUMNS = ("box", "event", "day", "time1", "time2", "curr_test",
+                  "curr_block", "trial_cnt", "failed_current_trial",
+                  "failed_trials", "failed_blocks", "reset_blocks", "leds",
+                  "push", "correct", "rew_cnt", "reaction_ms")
+# Trials per block, how many were a success and the accuracy
+ACCURACY = """
+SELECT box, day, curr_test, curr_block, COUNT(*) AS trials,
+       SUM(event = 'S') AS successes,
+       ROUND(AVG(event = 'S'), 3) AS accuracy
+FROM all_events
+WHERE event IN ('S', 'F') AND (:box IS NULL OR box = :box)
+GROUP BY box, day, curr_test, curr_block
+ORDER BY box, day, MIN(time1)
+"""
+
+
+class EventLogger(DataLogger):
+    """
+    A DataLogger that inserts the records into the database at path. A
+    record is a list of the fields of a CSV line after the ID, with the LEDs
+    as a bitmask: event, time1, time2, the counters, LEDs, push, correct,
+    rew_cnt and the reaction time text.
+    """
+    errors = (OSError, sqlite3.Error)
+
+    def __init__(self, path, animalId, counters, policy=FLUSH_INTERVAL,
+                 flushInterval=1000, maxQueued=1000):
+        self.animalId = str(animalId)
+        self.counters = list(counters)
+        self._session = None
+        super().__init__(path, policy, flushInterval, maxQueued)
+
+    def startSession(self, start, seed):
+        """Start a session; start is its 'YYYY-mm-dd HH:MM:SS' time."""
+        self.writeHeader({"start": start, "seed": seed})
+
+    def _open(self, path):
+        # Autocommit mode; the transactions are started by _write()
+        connection = sqlite3.connect(path, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Sync the WAL at every commit, like the data file at every flush
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.executescript(SCHEMA)
+        # Counters that are not in SCHEMA, if LOG_COUNTERS gets new ones
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(events)")}
+        for name in self.counters:
+            if name not in columns:
+                connection.execute("ALTER TABLE events ADD COLUMN %s INTEGER" % name)
+        names = (["session", "box", "event", "day", "time1", "time2"] +
+                 self.counters + ["leds", "push", "correct", "rew_cnt",
+                                  "reaction_ms"])
+        self._insert = "INSERT INTO events (%s) VALUES (%s)" % (
+            ", ".join(names), ", ".join("?" * len(names)))
+        return connection
+
+    def _newSession(self, start, seed):
+        cursor = self._file.execute(
+            "INSERT INTO sessions (box, start, seed) VALUES (?, ?, ?)",
+            (self.animalId, start, seed))
+        self._session = cursor.lastrowid
+
+    def _write(self, item):
+        if not self._file.in_transaction:
+            self._file.execute("BEGIN")
+        if isinstance(item, dict):
+            self._newSession(item["start"], item["seed"])
+            return
+        if self._session is None:
+            self._newSession(None, None)
+        event, time1, time2 = item[:3]
+        count = len(self.counters)
+        counts = item[3:3 + count]
+        leds, push, correct, rewards, reaction = item[3 + count:]
+        day = dayOf(datetime.datetime.strptime(time1, '%Y-%m-%d %H:%M:%S'))
+        self._file.execute(self._insert,
+                           [self._session, self.animalId, event,
+                            day.strftime('%Y-%m-%d'), time1, time2] + list(counts) +
+                           [leds, str(push), str(correct), rewards,
+                            float(reaction) if reaction else None])
+
+    def _sync(self):
+        if self._file.in_transaction:
+            self._file.execute("COMMIT")
+
+    def _close(self):
+        self._file.close()
+
+
+def connect(paths):
+    """
+    Open the databases at paths together, with the all_events view of the
+    COMMON_COLUMNS of all their events.
+    """
+    connection = sqlite3.connect(paths[0])
+    schemas = ["main"]
+    for number, path in enumerate(paths[1:], 1):
+        connection.execute("ATTACH DATABASE ? AS box%d" % number, (path,))
+        schemas.append("box%d" % number)
+    columns = ", ".join(COMMON_COLUMNS)
+    connection.execute("CREATE TEMP VIEW all_events AS " + " UNION ALL ".join(
+        "SELECT %s FROM %s.events" % (columns, schema) for schema in schemas))
+    return connection
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="python -m puzzlebox.eventdb",
+                                     description="Print the accuracy of every "
+                                                 "block in event databases.")
+    parser.add_argument("databases", nargs="+")
+    parser.add_argument("--id", help="only this box ID, e.g. 1031")
+    parser.add_argument("--sql", help="run this query on all_events instead")
+    args = parser.parse_args(args)
+    try:
+        connection = connect(args.databases)
+        if args.sql:
+            cursor = connection.execute(args.sql)
+        else:
+            cursor = connection.execute(ACCURACY, {"box": args.id})
+        print(",".join(column[0] for column in cursor.description))
+        for row in cursor:
+            print(",".join("" if value is None else str(value) for value in row))
+    except sqlite3.Error as err:
+        print("ERROR:", err)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,180 @@
+# Feeder worker for the puzzle box
+#Licensed under the MIT License#
+"""
+Turns the feeder motor from a worker thread of its own. Feed requests are put
+on a coalescing queue: a request made while another one is still waiting is
+merged into it, so a burst of requests gives one feed. The worker waits for
+the edges of the motor snap switch instead of polling it, so the motor stops
+as soon as the switch is released.
+
+For every feed the delay between the request and the start of the rotation
+and the duration of the rotation are recorded, to spot slow or jammed motors.
+The clock.monotonicNs() of the start and end of the last feed are kept in
+lastFeedNs, for the trial timestamps.
+"""
+import concurrent.futures
+
+from puzzlebox import clock
+
+
+class Feeder:
+    """
+    Feeds on a background thread. gpio is the RPi.GPIO module; the pins must
+    already be set up. A feed within minimumInterval seconds of the end of the
+    previous one is skipped. If the snap switch does not come round within
+    jamTimeout seconds, the motor is stopped and the feed counted as jammed.
+    """
+    def __init__(self, gpio, pinLeft, pinRight, pinSnap, minimumInterval=0.0,
+                 jamTimeout=10.0, edgeTimeout=0.5):
+        self.gpio = gpio
+        self.pinLeft = pinLeft
+        self.pinRight = pinRight
+        self.pinSnap = pinSnap
+        self.minimumInterval = minimumInterval
+        self.jamTimeout = jamTimeout
+        # The switch is read again after this long without an edge, in case
+        # an edge was missed
+        self.edgeTimeout = edgeTimeout
+        self.feeding = False
+        self.lastFeedEnd = None
+        self.lastFeedNs = None
+        self.feeds = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.jams = 0
+        self.rotationTotal = 0.0
+        self.rotationMax = 0.0
+        self.delayTotal = 0.0
+        self.delayMax = 0.0
+        self._pending = None
+        self._stopping = False
+        self._lock = clock.condition()
+        self._edge = clock.event()
+        self._thread = None
+
+    def start(self):
+        self.gpio.add_event_detect(self.pinSnap, self.gpio.BOTH,
+                                   callback=self._snapEdge)
+        self._thread = clock.startThread(self._run, "Feeder")
+
+    def stop(self, timeout=5):
+        """Finish the current feed, cancel a waiting request and stop the thread."""
+        with self._lock:
+            self._stopping = True
+            self._lock.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self.gpio.remove_event_detect(self.pinSnap)
+
+    def request(self, timePushed=None):
+        """
+        Ask for a feed. timePushed is the clock.monotonicNs() of the button
+        press being rewarded, if any, to report the press-to-reward latency.
+        Returns a concurrent.futures.Future that is set to True once fed, or
+        to False if the feed was skipped or the motor jammed.
+        """
+        with self._lock:
+            if self._pending is not None:
+                self.coalesced += 1
+                return self._pending[0]
+            future = concurrent.futures.Future()
+            self._pending = (future, clock.monotonic(), timePushed)
+            self._lock.notify()
+            return future
+
+    def sinceLastFeed(self):
+        """Seconds since the end of the last feed, or None."""
+        if self.lastFeedEnd is None:
+            return None
+        return clock.monotonic() - self.lastFeedEnd
+
+    def tooSoon(self):
+        """True within minimumInterval seconds of the end of the last feed."""
+        since = self.sinceLastFeed()
+        return since is not None and since < self.minimumInterval
+
+    def stats(self):
+        fed = max(self.feeds, 1)
+        return {"feeds": self.feeds, "skipped": self.skipped,
+                "coalesced": self.coalesced, "jams": self.jams,
+                "rotation_mean_ms": round(self.rotationTotal / fed * 1000, 1),
+                "rotation_max_ms": round(self.rotationMax * 1000, 1),
+                "delay_mean_ms": round(self.delayTotal / fed * 1000, 1),
+                "delay_max_ms": round(self.delayMax * 1000, 1)}
+
+    def _snapEdge(self, channel):
+        self._edge.set()
+
+    def _waitForSwitch(self, level, deadline):
+        # Returns False if the switch did not reach level before the deadline
+        while self.gpio.input(self.pinSnap) != level:
+            remaining = deadline - clock.monotonic()
+            if remaining <= 0:
+                return False
+            self._edge.wait(min(remaining, self.edgeTimeout))
+            self._edge.clear()
+        return True
+
+    def _motor(self, left):
+        self.gpio.output(self.pinRight, 0)
+        self.gpio.output(self.pinLeft, 1 if left else 0)
+
+    def _feed(self, requested, timePushed):
+        if self.tooSoon():
+            print("Attempting to feed too quickly, ignore request.", flush=True)
+            self.skipped += 1
+            return False
+        self.feeding = True
+        start = clock.monotonic()
+        print("feeding", flush=True)
+        self._edge.clear()
+        startNs = clock.monotonicNs()
+        self._motor(True)  # Turn left
+        if timePushed is not None:
+            print("Press-to-reward latency: %.2f ms" %
+                  ((startNs - timePushed) / 1e6), flush=True)
+        deadline = start + self.jamTimeout
+        # The switch closes and opens again once per rotation
+        fed = (self._waitForSwitch(1, deadline) and
+               self._waitForSwitch(0, deadline))
+        self._motor(False)
+        endNs = clock.monotonicNs()
+        end = clock.monotonic()
+        self.lastFeedEnd = end
+        self.feeding = False
+        rotation = end - start
+        delay = start - requested
+        if not fed:
+            self.jams += 1
+            print("ERROR: Feeder jammed, motor stopped after %.1f s" % rotation,
+                  flush=True)
+            return False
+        self.feeds += 1
+        self.lastFeedNs = (startNs, endNs)
+        self.rotationTotal += rotation
+        self.rotationMax = max(self.rotationMax, rotation)
+        self.delayTotal += delay
+        self.delayMax = max(self.delayMax, delay)
+        print("Feed: rotation %.0f ms, queued %.1f ms" %
+              (rotation * 1000, delay * 1000), flush=True)
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._pending is None and not self._stopping:
+                    self._lock.wait()
+                if self._stopping:
+                    if self._pending is not None:
+                        self._pending[0].cancel()
+                    return
+                future, requested, timePushed = self._pending
+                self._pending = None
+            if not future.set_running_or_notify_cancel():
+                continue  # Whoever asked no longer waits for the feed
+            try:
+                future.set_result(self._feed(requested, timePushed))
+            except Exception as err:
+                self._motor(False)
+                self.feeding = False
+                future.set_exception(err)
@@ -0,0 +1,121 @@
+# Session journal for the puzzle box
+#Licensed under the MIT License#
+"""
+Append-only journal of the session state, so a restart after a crash or power
+cut continues exactly where the previous run stopped.
+
+The journal is a text file with one JSON object per line. The first line is a
+snapshot of the full state; every following line holds the values that
+changed since the line before it. Every line is synced to the disk before
+record() returns. After snapshotEvery changes the journal is started over
+with a new snapshot, so it never takes long to replay.
+
+The state is a dict of sections (e.g. "par"), each a dict of values that can
+be stored as JSON.
+"""
+import hashlib
+import json
+import os
+
+from puzzlebox.persist import atomicWrite
+
+
+def fileHash(path):
+    """SHA-1 of a file's contents, or None if it does not exist."""
+    try:
+        with open(path, 'rb') as hashedFile:
+            return hashlib.sha1(hashedFile.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def replay(lines):
+    """
+    Rebuild the state from the lines of a journal. Returns the state and the
+    hash of the configuration file it belongs to, or (None, None) if the
+    journal holds no snapshot. A torn last line from a crash mid-write is
+    ignored.
+    """
+    state = None
+    configHash = None
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            break
+        if "snapshot" in entry:
+            state = entry["snapshot"]
+            configHash = entry["config"]
+        elif state is not None:
+            for section, values in entry["delta"].items():
+                state.setdefault(section, {}).update(values)
+    return state, configHash
+
+
+class Journal:
+    def __init__(self, path, snapshotEvery=100):
+        self.path = path
+        self.snapshotEvery = snapshotEvery
+        self.state = None
+        self.configHash = None
+        self.deltas = 0
+        self._fd = None
+
+    def recover(self, configHash):
+        """
+        Return the state saved in the journal, or None if there is no journal
+        or the configuration file was changed since it was written (in which
+        case the configuration file wins).
+        """
+        try:
+            with open(self.path, 'r') as journalFile:
+                lines = journalFile.read().split("\n")
+        except FileNotFoundError:
+            return None
+        state, journalHash = replay(lines)
+        if state is None:
+            return None
+        if journalHash != configHash:
+            print("Configuration file changed, ignoring journal", self.path,
+                  flush=True)
+            return None
+        return state
+
+    def snapshot(self, state, configHash):
+        """
+        Start the journal over with a copy of the full state. configHash
+        identifies the configuration file the state continues from.
+        """
+        self.close()
+        entry = {"snapshot": state, "config": configHash}
+        atomicWrite(self.path, json.dumps(entry) + "\n")
+        self.state = json.loads(json.dumps(state))
+        self.configHash = configHash
+        self.deltas = 0
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def record(self, state):
+        """Append the values that changed since the last record."""
+        delta = {}
+        for section, values in state.items():
+            old = self.state.get(section, {})
+            changed = {name: value for name, value in values.items()
+                       if name not in old or old[name] != value}
+            if changed:
+                delta[section] = changed
+        if not delta:
+            return
+        if self.deltas >= self.snapshotEvery:
+            self.snapshot(state, self.configHash)
+            return
+        line = json.dumps({"delta": delta}) + "\n"
+        os.write(self._fd, line.encode())
+        os.fsync(self._fd)
+        for section, values in json.loads(line)["delta"].items():
+            self.state.setdefault(section, {}).update(values)
+        self.deltas += 1
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
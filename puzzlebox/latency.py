@@ -0,0 +1,126 @@
+# Latency histograms for the puzzle box
+#Licensed under the MIT License#
+"""
+Fixed-size histograms of how long the stages of a trial take, in nanoseconds.
+Bucket i counts the samples of i bits, i.e. from 2**(i-1) up to 2**i - 1 ns,
+so recording a sample is one int.bit_length() and a few additions, well
+under a microsecond. Percentiles are given as the upper bound of their bucket,
+so they are at most a factor of two too high.
+
+Samples are recorded from the event loop thread only, so no locks are taken.
+dump() prints the histograms and appends them as a JSON line to a file, so
+boxes and USB sticks can be compared; installDumpSignal() makes a running box
+dump them on SIGUSR1 (kill -USR1 <pid>).
+"""
+import json
+import signal
+
+from puzzlebox import clock
+
+BUCKETS = 64
+
+
+class Histogram:
+    """Log-bucketed histogram of nanosecond durations."""
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        self.counts[ns.bit_length()] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, fraction):
+        """Upper bound in ns of the sample below which fraction of them fall."""
+        if self.count == 0:
+            return 0
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min((1 << bucket) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        """Count and times in microseconds, plus the non-empty buckets."""
+        mean = self.total / self.count if self.count else 0
+        return {"count": self.count,
+                "mean_us": round(mean / 1000, 1),
+                "p50_us": round(self.percentile(0.5) / 1000, 1),
+                "p90_us": round(self.percentile(0.9) / 1000, 1),
+                "p99_us": round(self.percentile(0.99) / 1000, 1),
+                "max_us": round(self.max / 1000, 1),
+                "buckets": {bucket: count for bucket, count
+                            in enumerate(self.counts) if count}}
+
+
+class Latencies:
+    """Histograms by name; a histogram is made on first use."""
+    def __init__(self, names=()):
+        self.histograms = {name: Histogram() for name in names}
+
+    def __getitem__(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def summary(self):
+        return {name: histogram.summary()
+                for name, histogram in self.histograms.items()}
+
+    def table(self):
+        """The histograms as a text table, in milliseconds."""
+        lines = ["%-16s %8s %9s %9s %9s %9s %9s" %
+                 ("latency (ms)", "count", "mean", "p50", "p90", "p99", "max")]
+        for name, summary in self.summary().items():
+            lines.append("%-16s %8d %9.3f %9.3f %9.3f %9.3f %9.3f" %
+                         (name, summary["count"], summary["mean_us"] / 1000,
+                          summary["p50_us"] / 1000, summary["p90_us"] / 1000,
+                          summary["p99_us"] / 1000, summary["max_us"] / 1000))
+        return "\n".join(lines)
+
+    def dump(self, path=None, **extra):
+        """
+        Print the table and, if path is given, append the histograms as one
+        JSON line (with the time and the extra fields) to it.
+        """
+        print(self.table(), flush=True)
+        if path is None:
+            return
+        line = dict(extra)
+        line["time"] = clock.now().isoformat(timespec="seconds")
+        line["latency"] = self.summary()
+        try:
+            with open(path, "a") as latencyFile:
+                latencyFile.write(json.dumps(line) + "\n")
+        except OSError as err:
+            print("ERROR: Could not write", path, ":", err, flush=True)
+
+
+def installDumpSignal(loop, dump):
+    """
+    Call dump() on SIGUSR1, where the system has it. The event loop runs it
+    between its callbacks, so it never interrupts the program in the middle
+    of a print or a write.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, dump)
+    except (NotImplementedError, RuntimeError) as err:
+        print("WARNING: Latencies are not dumped on SIGUSR1:", err, flush=True)
+
+
+def removeDumpSignal(loop):
+    """Stop calling dump() on SIGUSR1, at the end of the session."""
+    if hasattr(signal, "SIGUSR1"):
+        loop.remove_signal_handler(signal.SIGUSR1)
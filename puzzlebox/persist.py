@@ -0,0 +1,52 @@
+# Saving the puzzle box state
+#Licensed under the MIT License#
+"""
+Helpers for writing the configuration file safely and only when needed.
+"""
+import os
+
+
+def atomicWrite(path, text):
+    """
+    Replace the contents of a file. The text is written to a temporary file,
+    synced to the disk and renamed over the old file, so a power cut leaves
+    either the old or the new file, never a truncated one.
+    """
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as tmpFile:
+        tmpFile.write(text)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    os.replace(tmpPath, path)
+    # Sync the directory as well, so the rename itself survives a power cut
+    try:
+        dirFd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dirFd)
+    except OSError:
+        pass
+    finally:
+        os.close(dirFd)
+
+
+class ChangeTracker:
+    """
+    Remembers the values that were last saved and reports which have changed
+    since, so unchanged state never has to be written.
+    """
+    def __init__(self):
+        self.saved = None
+
+    def changed(self, values):
+        """Names of the values that differ from the saved ones."""
+        if self.saved is None:
+            return list(values)
+        return [name for name, value in values.items()
+                if name not in self.saved or self.saved[name] != value]
+
+    def markSaved(self, values):
+        # Copy lists, as they can be changed in place after saving
+        self.saved = {name: list(value) if isinstance(value, list) else value
+                      for name, value in values.items()}
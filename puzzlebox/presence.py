@@ -0,0 +1,111 @@
+# IR presence tracking for the puzzle box
+#Licensed under the MIT License#
+"""
+Samples the IR sensor from a background thread. Every sample powers the
+sensor and its 38 kHz LED pulses, waits for the sensor to warm up, reads the
+sensor until a number of readings agree and turns it off again. The sensor is
+only powered while sampling, so the interval between samples sets its duty
+cycle.
+
+The debounced presence is kept in PresenceTracker.present, so the trial loop
+can check it without waiting for the sensor, and every change is passed to
+the onChange callback (e.g. to wake the trial loop on a departure).
+"""
+from puzzlebox import clock
+
+
+class PresenceTracker:
+    """
+    Tracks whether an animal is present. gpio is the RPi.GPIO module and pwm
+    the PWM object driving the IR LED; the pins must already be set up. A
+    change is only published once it is seen in confirm samples in a row.
+    onChange(present) is called on the tracker thread.
+    """
+    def __init__(self, gpio, pwm, pinIn, pinPower, interval=0.2, confirm=1,
+                 onChange=None, warmUp=0.03, settle=0.01, agree=3):
+        self.gpio = gpio
+        self.pwm = pwm
+        self.pinIn = pinIn
+        self.pinPower = pinPower
+        self.interval = interval
+        self.confirm = confirm
+        self.onChange = onChange
+        self.warmUp = warmUp
+        self.settle = settle
+        self.agree = agree
+        self.present = False
+        self.samples = 0
+        self.changes = 0
+        self.poweredTime = 0.0
+        self._candidate = None
+        self._seen = 0
+        self._started = None
+        self._stopping = clock.event()
+        self._thread = None
+
+    def start(self):
+        # The first sample is taken right away, so present is valid on return
+        self._started = clock.monotonic()
+        self.present = self._sample()
+        self._thread = clock.startThread(self._run, "PresenceTracker")
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def dutyCycle(self):
+        """Fraction of the time the sensor was powered since start()."""
+        if self._started is None:
+            return 0.0
+        elapsed = clock.monotonic() - self._started
+        return self.poweredTime / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        return {"samples": self.samples, "changes": self.changes,
+                "duty_cycle": round(self.dutyCycle(), 3)}
+
+    def _sample(self):
+        # Read the sensor until agree readings in a row are the same
+        start = clock.monotonic()
+        self.pwm.ChangeDutyCycle(50)  # Start pulses
+        self.gpio.output(self.pinPower, 1)  # Turn sensor on
+        try:
+            clock.sleep(self.warmUp)
+            count = 0
+            previous = self.gpio.input(self.pinIn)
+            while count < self.agree:
+                reading = self.gpio.input(self.pinIn)
+                if reading == previous:
+                    count += 1
+                else:
+                    count = 0
+                previous = reading
+                clock.sleep(self.settle)
+        finally:
+            self.pwm.ChangeDutyCycle(0)  # Stop pulses
+            self.gpio.output(self.pinPower, 0)  # Turn sensor off
+            self.poweredTime += clock.monotonic() - start
+        self.samples += 1
+        # A break beam reads 1 while the beam is blocked
+        return reading == 1
+
+    def _update(self, present):
+        if present == self.present:
+            self._candidate = None
+            return
+        if present != self._candidate:
+            self._candidate = present
+            self._seen = 0
+        self._seen += 1
+        if self._seen < self.confirm:
+            return
+        self._candidate = None
+        self.present = present
+        self.changes += 1
+        if self.onChange is not None:
+            self.onChange(present)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self._update(self._sample())
@@ -0,0 +1,101 @@
+# Sampling profiler for the puzzle box
+#Licensed under the MIT License#
+"""
+A statistical profiler that is light enough to leave on for a whole session.
+A background thread looks at the stack of every other thread each interval
+seconds (sys._current_frames()) and counts the stacks it sees, so the cost
+does not depend on how many functions are called, unlike cProfile.
+
+The stacks are written in the collapsed format of flamegraph.pl, which
+speedscope and most other flame graph viewers also read: one line per stack,
+the thread name and the functions from the outermost to the innermost one
+separated by semicolons, then the number of samples.
+
+Stacks that end in a Python-level wait (a selector, threading.Event or
+Condition, or queue) are idle and only counted, unless includeIdle is set, so
+the flame graph shows where the CPU time goes. Waits in C functions such as
+time.sleep() have no frame of their own and cannot be told apart.
+
+The sampler sleeps on the real clock, also in a simulation.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+
+# Innermost functions of a thread that is waiting
+IDLE_FUNCTIONS = {("select", "selectors.py"), ("wait", "threading.py"),
+                  ("get", "queue.py")}
+
+
+def _frameName(frame):
+    code = frame.f_code
+    return "%s (%s)" % (code.co_name, os.path.basename(code.co_filename))
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads every interval seconds."""
+    def __init__(self, interval=0.01, includeIdle=False):
+        self.interval = interval
+        self.includeIdle = includeIdle
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.overhead = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="Profiler",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def sample(self):
+        """Count the current stack of every thread but this one."""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if (not self.includeIdle and
+                    (code.co_name, os.path.basename(code.co_filename)) in IDLE_FUNCTIONS):
+                self.idle += 1
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frameName(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-%d" % ident))
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            start = time.perf_counter()
+            self.sample()
+            self.overhead += time.perf_counter() - start
+
+    def collapsed(self):
+        """The stacks in the collapsed format, most frequent first."""
+        return "".join("%s %d\n" % (stack, count)
+                       for stack, count in self.stacks.most_common())
+
+    def write(self, path):
+        with open(path, "w") as profileFile:
+            profileFile.write(self.collapsed())
+
+    def stats(self):
+        return {"samples": self.samples, "stacks": len(self.stacks),
+                "idle": self.idle,
+                "overhead_ms_per_sample":
+                    round(self.overhead / max(self.samples, 1) * 1000, 3)}
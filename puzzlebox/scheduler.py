@@ -0,0 +1,104 @@
+# Timer scheduling for the puzzle box
+#Licensed under the MIT License#
+"""
+A heap of named deadlines on a monotonic clock. Instead of checking the time
+on every pass of a polling loop, the waiting code asks the scheduler how long
+it may sleep, sleeps exactly that long (or until an input event wakes it) and
+then lets the scheduler run the timers that are due.
+"""
+import heapq
+import itertools
+
+import puzzlebox.clock
+
+
+class Scheduler:
+    """
+    Named one-shot and periodic timers. Scheduling a timer with the name of a
+    pending timer replaces it. Callbacks run on the thread that calls
+    runDue(), so they can safely change the program state. If onChange is
+    set, it is called whenever a timer is scheduled, so a sleeping waiter can
+    look at the new deadline.
+    """
+    def __init__(self, clock=puzzlebox.clock.monotonic):
+        self.clock = clock
+        self.onChange = None
+        self._heap = []
+        self._timers = dict()
+        self._order = itertools.count()
+
+    def schedule(self, name, delay, callback, period=None):
+        """
+        Call callback after delay seconds. A periodic timer is due again
+        period seconds after its previous deadline, or after it ran if it
+        was overdue by more than a period.
+        """
+        return self.scheduleAt(name, self.clock() + delay, callback, period)
+
+    def scheduleAt(self, name, deadline, callback, period=None):
+        """Call callback once the clock reaches deadline."""
+        entry = (deadline, next(self._order), name)
+        self._timers[name] = (entry, callback, period)
+        heapq.heappush(self._heap, entry)
+        if self.onChange is not None:
+            self.onChange()
+        return deadline
+
+    def cancel(self, name):
+        # The heap entry is left behind and skipped once it comes up
+        self._timers.pop(name, None)
+
+    def pending(self, name):
+        return name in self._timers
+
+    def deadline(self, name):
+        """Deadline of a pending timer, or None."""
+        if name not in self._timers:
+            return None
+        return self._timers[name][0][0]
+
+    def timeUntilNext(self):
+        """Seconds until the next timer is due (0 if overdue), or None."""
+        self._dropCancelled()
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - self.clock(), 0)
+
+    def runDue(self):
+        """Run the callbacks of all timers that are due. Returns how many ran."""
+        ran = 0
+        now = self.clock()
+        while True:
+            self._dropCancelled()
+            if not self._heap or self._heap[0][0] > now:
+                return ran
+            entry = heapq.heappop(self._heap)
+            _, callback, period = self._timers.pop(entry[2])
+            if period is not None:
+                deadline = entry[0] + period
+                if deadline <= now:
+                    deadline = now + period
+                self.scheduleAt(entry[2], deadline, callback, period)
+            callback()
+            ran += 1
+
+    def runUntil(self, done, wait=puzzlebox.clock.sleep):
+        """
+        Run timers until done() returns True. Between timers, wait(timeout) is
+        called to sleep until the next one is due; it may return early.
+        """
+        while not done():
+            timeout = self.timeUntilNext()
+            if timeout is None:
+                raise RuntimeError("Waiting without any timers scheduled.")
+            if timeout > 0:
+                wait(timeout)
+            self.runDue()
+
+    def _dropCancelled(self):
+        heap = self._heap
+        while heap:
+            timer = self._timers.get(heap[0][2])
+            if timer is not None and timer[0] is heap[0]:
+                return
+            heapq.heappop(heap)
@@ -0,0 +1,273 @@
+# Daily data file segments for the puzzle box
+#Licensed under the MIT License#
+"""
+Splits the data file into one segment per day, so the file that is being
+appended to stays small and old days can be compressed. Days run from noon to
+noon, like the days of startDay() and waitForAnimal(), and a segment is named
+after the date its day starts on: DATA_FILE 06282018_COY1031P.txt is written
+to 06282018_COY1031P_2018-06-28.txt, 06282018_COY1031P_2018-06-29.txt, ...
+
+When a day is over, its segment is closed and gzipped by a background thread
+at the lowest CPU priority (to 06282018_COY1031P_2018-06-28.txt.gz), and the
+plain file is removed. Every segment starts with the header of the session
+(see puzzlebox.binlog), so each one can be read on its own.
+
+The manifest (DATA_FILE plus MANIFEST_SUFFIX, JSON) lists the segments in
+order, with their day, file, state ("active", "closed" or "compressed"),
+number of records and sizes. Segments that were closed but not compressed
+when the program stopped are compressed at the next start.
+
+Print the manifest with: python -m puzzlebox.segments DATA_FILE
+"""
+import datetime
+import gzip
+import io
+import json
+import os
+import queue
+import sys
+import threading
+
+from puzzlebox import binlog, clock
+from puzzlebox.archive import INDEX_SUFFIX, dayOf
+from puzzlebox.datalog import FLUSH_INTERVAL, DataLogger
+from puzzlebox.persist import atomicWrite
+
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_VERSION = 1
+COMPRESSED_SUFFIX = ".gz"
+ACTIVE = "active"
+CLOSED = "closed"
+COMPRESSED = "compressed"
+
+
+def segmentPath(dataFile, day):
+    """The segment of dataFile for day (a date)."""
+    stem, extension = os.path.splitext(dataFile)
+    return stem + "_" + day.strftime('%Y-%m-%d') + extension
+
+
+def countRecords(data):
+    """The number of records in the contents of a CSV or binary data file."""
+    if data[:1] == b"\x00":
+        return sum(1 for record in binlog.records(io.BytesIO(data)))
+    return sum(1 for line in data.splitlines()
+               if line and not line.startswith(b"#"))
+
+
+def openSegment(path):
+    """Open a plain or gzipped data file for reading bytes."""
+    if path.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+class Manifest:
+    """The list of segments of a data file; thread safe."""
+    def __init__(self, dataFile):
+        self.path = dataFile + MANIFEST_SUFFIX
+        self.folder = os.path.dirname(os.path.abspath(dataFile))
+        self._lock = threading.Lock()
+        self.segments = []
+        try:
+            with open(self.path) as manifestFile:
+                manifest = json.load(manifestFile)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") == MANIFEST_VERSION:
+            self.segments = manifest["segments"]
+
+    def find(self, day):
+        """A copy of the entry of the segment of day (a date), or None."""
+        with self._lock:
+            segment = self._find(day)
+            return None if segment is None else dict(segment)
+
+    def _find(self, day):
+        # The entry itself; the lock must be held
+        dayText = day.strftime('%Y-%m-%d')
+        for segment in self.segments:
+            if segment["day"] == dayText:
+                return segment
+        return None
+
+    def update(self, day, **values):
+        """Change (or add) the entry of day and save the manifest."""
+        with self._lock:
+            segment = self._find(day)
+            if segment is None:
+                segment = {"day": day.strftime('%Y-%m-%d'), "records": None}
+                self.segments.append(segment)
+                self.segments.sort(key=lambda entry: entry["day"])
+            segment.update(values)
+            self._save()
+
+    def _save(self):
+        manifest = {"version": MANIFEST_VERSION, "segments": self.segments}
+        try:
+            atomicWrite(self.path, json.dumps(manifest, indent=1))
+        except OSError as err:
+            print("WARNING: Could not write manifest", self.path, ":", err,
+                  flush=True)
+
+    def files(self):
+        """The paths of the segments, in order."""
+        with self._lock:
+            return [os.path.join(self.folder, segment["file"])
+                    for segment in self.segments]
+
+
+class Compressor:
+    """
+    Gzips closed segments one at a time on a background thread, which runs
+    at the lowest CPU priority so it never delays a trial.
+    """
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="Compressor",
+                                        daemon=True)
+        self._thread.start()
+
+    def add(self, day, path):
+        """Compress the closed segment of day at path."""
+        self._queue.put((day, path))
+
+    def stop(self, timeout=5):
+        """
+        Finish the segment being compressed; the others stay closed and are
+        compressed at the next start.
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def compress(self, day, path):
+        # Gzip path next to it, then remove it. A segment that was compressed
+        # before (the program was restarted on a day that was already over)
+        # gets the new records as another gzip member.
+        with open(path, "rb") as plainFile:
+            data = plainFile.read()
+        gzPath = path + COMPRESSED_SUFFIX
+        tmpPath = gzPath + ".tmp"
+        segment = self.manifest.find(day) or {}
+        records = countRecords(data)
+        with open(tmpPath, "wb") as tmpFile:
+            if os.path.exists(gzPath):
+                with open(gzPath, "rb") as gzFile:
+                    tmpFile.write(gzFile.read())
+                records += segment.get("records") or 0
+            with gzip.GzipFile(os.path.basename(path), "wb", fileobj=tmpFile) as gz:
+                gz.write(data)
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.replace(tmpPath, gzPath)
+        self.manifest.update(day, file=os.path.basename(gzPath), state=COMPRESSED,
+                             records=records,
+                             bytes=len(data) + (segment.get("bytes") or 0),
+                             compressed_bytes=os.path.getsize(gzPath))
+        os.remove(path)
+        try:
+            # The index of puzzlebox.archive, if the segment was queried
+            os.remove(path + INDEX_SUFFIX)
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass  # Not on Linux; the thread mostly waits on the disk anyway
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self.compress(*item)
+            except (OSError, ValueError) as err:
+                print("WARNING: Could not compress", item[1], ":", err, flush=True)
+
+
+class SegmentedLogger(DataLogger):
+    """
+    A DataLogger that writes the records of every day to a segment of its
+    own, and has the segments of past days compressed.
+    """
+    def __init__(self, dataFile, policy=FLUSH_INTERVAL, flushInterval=1000,
+                 maxQueued=1000, compress=True):
+        self.dataFile = dataFile
+        self.day = dayOf(clock.now())
+        self.header = None
+        self.manifest = Manifest(dataFile)
+        super().__init__(segmentPath(dataFile, self.day), policy, flushInterval,
+                         maxQueued)
+        self.compressor = Compressor(self.manifest) if compress else None
+        # Close what the last run left open, and compress what it did not
+        for segment in list(self.manifest.segments):
+            day = datetime.datetime.strptime(segment["day"], '%Y-%m-%d').date()
+            path = os.path.join(self.manifest.folder, segment["file"])
+            if day != self.day and segment["state"] != COMPRESSED:
+                self.manifest.update(day, state=CLOSED)
+                if self.compressor and os.path.exists(path):
+                    self.compressor.add(day, path)
+        self.manifest.update(self.day, file=os.path.basename(self.path),
+                             state=ACTIVE)
+
+    def writeHeader(self, header):
+        """Write the header; it is repeated at the start of every segment."""
+        self.header = header
+        super().writeHeader(header)
+
+    def write(self, line, timeText=None):
+        """
+        Queue a line for the segment of the day of timeText, the time of the
+        record, or of now. A line of a day that is already over (the record
+        was delayed past noon) goes to the current segment.
+        """
+        if timeText is None:
+            moment = clock.now()
+        else:
+            moment = datetime.datetime.strptime(timeText, '%Y-%m-%d %H:%M:%S')
+        day = dayOf(moment)
+        if day > self.day:
+            self.startSegment(day)
+        super().write(line, timeText)
+
+    def startSegment(self, day):
+        """Close the segment of the current day and start the one of day."""
+        oldDay, self.day = self.day, day
+        path = segmentPath(self.dataFile, day)
+        self.manifest.update(oldDay, state=CLOSED)
+        self.manifest.update(day, file=os.path.basename(path), state=ACTIVE)
+
+        def closed(oldPath):
+            if self.compressor:
+                self.compressor.add(oldDay, oldPath)
+        self.reopen(path, closed)
+        if self.header is not None:
+            super().write(self.header)
+
+    def close(self, timeout=5):
+        """Write all queued lines; the segment of the day stays active."""
+        super().close(timeout)
+        if self.compressor:
+            self.compressor.stop(timeout)
+
+
+def main(args):
+    if len(args) != 1:
+        print("Usage: python -m puzzlebox.segments DATA_FILE")
+        return 2
+    manifest = Manifest(args[0])
+    if not manifest.segments:
+        print("ERROR: No manifest", manifest.path)
+        return 1
+    for segment in manifest.segments:
+        records = segment["records"]
+        print("%s  %-10s  %8s records  %s" % (
+            segment["day"], segment["state"],
+            "-" if records is None else records, segment["file"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
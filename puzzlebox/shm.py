@@ -0,0 +1,137 @@
+# Shared memory counters for the puzzle box
+#Licensed under the MIT License#
+"""
+Publishes the session counters in a memory-mapped file (under /dev/shm, so it
+never touches the disk) for dashboards and watchdogs. Readers map the file
+too and read the values without a system call or a socket round trip.
+
+The file has a fixed layout, little endian:
+
+    0   8 bytes  MAGIC
+    8   uint32   VERSION
+    12  uint32   number of values
+    16  uint64   sequence number
+    24  uint32   length of the names
+    28  uint32   (unused)
+    32  int64    the values, in the order of the names
+    ..  bytes    the names, as a JSON list
+
+The names are written once. The values are guarded by the sequence number
+like a seqlock: the writer makes it odd before and even again after changing
+the values, and a reader retries until it reads the same even number before
+and after copying them. There is one writer, the trial loop, so it takes no
+lock either. Python cannot place memory barriers, so on a weakly ordered CPU
+the check makes a mixed copy unlikely rather than impossible; a monitor can
+always read again.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"PZSHM\x00\x00\x00"
+VERSION = 1
+_HEADER = struct.Struct("<8sII")
+_SEQUENCE = struct.Struct("<Q")
+_NAMES = struct.Struct("<II")
+_SEQUENCE_AT = 16
+_NAMES_AT = 24
+_VALUES_AT = 32
+
+
+class SharedCounters:
+    """Writes the values of names to the memory-mapped file at path."""
+    def __init__(self, path, names):
+        self.path = path
+        self.names = list(names)
+        self._values = struct.Struct("<%dq" % len(self.names))
+        nameData = json.dumps(self.names).encode("utf-8")
+        size = _VALUES_AT + self._values.size + len(nameData)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._sequence = 0
+        self._map[_VALUES_AT + self._values.size:] = nameData
+        _NAMES.pack_into(self._map, _NAMES_AT, len(nameData), 0)
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_AT, 0)
+        # The magic number last, so a reader never sees a half-made file
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, len(self.names))
+
+    def publish(self, values):
+        """Replace the values; they must be ints (or bools), one per name."""
+        sequence = self._sequence + 1
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_AT, sequence)
+        self._values.pack_into(self._map, _VALUES_AT, *values)
+        self._sequence = sequence + 1
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_AT, self._sequence)
+
+    def close(self, remove=True):
+        self._map.close()
+        if remove:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class CounterReader:
+    """Reads the values published at path; keep it open to poll often."""
+    def __init__(self, path):
+        with open(path, "rb") as counterFile:
+            self._map = mmap.mmap(counterFile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(path + " is not a counter file")
+        if version != VERSION:
+            raise ValueError("Counter file version " + str(version) +
+                             " is not supported (expected " + str(VERSION) + ")")
+        self._values = struct.Struct("<%dq" % count)
+        length, unused = _NAMES.unpack_from(self._map, _NAMES_AT)
+        namesAt = _VALUES_AT + self._values.size
+        self.names = json.loads(self._map[namesAt:namesAt + length].decode("utf-8"))
+
+    def read(self, retries=10000):
+        """A consistent copy of the values, as a dict by name."""
+        for attempt in range(retries):
+            before = _SEQUENCE.unpack_from(self._map, _SEQUENCE_AT)[0]
+            if before & 1:
+                continue  # Being written
+            values = self._values.unpack_from(self._map, _VALUES_AT)
+            if _SEQUENCE.unpack_from(self._map, _SEQUENCE_AT)[0] == before:
+                return dict(zip(self.names, values))
+        raise TimeoutError("Counters kept changing while being read")
+
+    def sequence(self):
+        """The sequence number; it changes whenever the values do."""
+        return _SEQUENCE.unpack_from(self._map, _SEQUENCE_AT)[0]
+
+    def close(self):
+        self._map.close()
+
+
+def main(args):
+    if len(args) not in (1, 2):
+        print("Usage: python -m puzzlebox.shm COUNTER_FILE [INTERVAL]")
+        return 2
+    reader = CounterReader(args[0])
+    interval = float(args[1]) if len(args) == 2 else None
+    try:
+        while True:
+            print(json.dumps(reader.read()), flush=True)
+            if interval is None:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
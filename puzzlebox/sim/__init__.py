@@ -0,0 +1,204 @@
+# Simulation of the puzzle box
+#Licensed under the MIT License#
+"""
+Runs Coyote.py or Raccoon_Skunk.py without the hardware and faster than real
+time. install() puts the simulated GPIO (puzzlebox.sim.gpio) and a headless
+pygame (puzzlebox.sim.pygame) in place of the real modules, and the virtual
+clock (puzzlebox.sim.clock) in place of the real one. run() then runs main()
+of a program for some days of box time, with a simulated animal and feeder
+motor (puzzlebox.sim.world).
+
+Every run also checks the session journal: whenever it is started over and
+at the end of the run, the state replayed from its snapshot and deltas must
+equal the state the program last recorded, or run() raises a RuntimeError.
+
+Run with e.g.: python -m puzzlebox.sim Coyote.py --config config.txt --days 7
+"""
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+import types
+
+import puzzlebox.clock
+from puzzlebox import binlog, journal
+from puzzlebox.sim import gpio, pygame
+from puzzlebox.sim.clock import VirtualClock, VirtualEventLoopPolicy
+from puzzlebox.sim.world import Animal, FeederMotor
+
+
+def install(clock):
+    """Simulate the hardware and the clock for programs imported from now on."""
+    puzzlebox.clock.setClock(clock)
+    policy = VirtualEventLoopPolicy(clock)
+    asyncio.set_event_loop_policy(policy)
+    gpio.reset()
+    pygame.counts.clear()
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    sys.modules["pygame"] = pygame
+    return policy
+
+
+def loadProgram(path, name=None):
+    """Import a program such as Coyote.py as a module, without running it."""
+    if name is None:
+        name = "simulated_" + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _stopAfter(policy, seconds):
+    # Cancels the session once the simulation has run for long enough
+    puzzlebox.clock.sleep(seconds)
+    loop = policy.loop
+    if loop is not None:
+        loop.call_soon_threadsafe(_cancelAll, loop)
+
+
+def _cancelAll(loop):
+    for task in asyncio.all_tasks(loop):
+        task.cancel()
+
+
+class CheckedJournal(journal.Journal):
+    """
+    A Journal that checks that replaying it gives the state it last
+    recorded, before it is started over and when it is closed.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorded = None
+        self.checks = 0
+
+    def check(self):
+        if self.recorded is None:
+            return
+        with open(self.path) as journalFile:
+            state, configHash = journal.replay(journalFile.read().split("\n"))
+        if state != self.recorded:
+            live = self.recorded.get("par", {})
+            replayed = (state or {}).get("par", {})
+            names = sorted(name for name in set(live) | set(replayed)
+                           if live.get(name) != replayed.get(name))
+            raise RuntimeError("Replaying journal " + self.path + " does not "
+                               "give the recorded state; par differs in: " +
+                               str(names))
+        self.checks += 1
+
+    def snapshot(self, state, configHash):
+        self.check()
+        super().snapshot(state, configHash)
+        self.recorded = json.loads(json.dumps(state))
+
+    def record(self, state):
+        super().record(state)
+        if self._fd is not None:
+            self.recorded = json.loads(json.dumps(state))
+
+    def close(self):
+        if self._fd is not None:
+            self.check()
+        super().close()
+
+
+def run(program, config, days=7.0, folder="simulation", seed=0, start=None,
+        accuracy=0.8, visitGap=3600.0, visitLength=900.0, pushGap=20.0,
+        quiet=True, settings=None, prepare=None, animal=True):
+    """
+    Run main() of program (a path such as "Coyote.py") for days of box time
+    and return a summary. The configuration file config is copied to folder,
+    where the program also writes its data file, error log and journal. If
+    config does not exist, the program writes its default configuration.
+    settings overrides constants of the program, e.g. {"IR_SAMPLE_INTERVAL":
+    1.0}, and prepare is called with the program module just before main(),
+    e.g. to instrument it. Without animal, nobody pushes the buttons unless
+    prepare arranges it. Returns a dict with the results.
+    """
+    clock = VirtualClock(start)
+    policy = install(clock)
+    random.seed(seed)
+    os.makedirs(folder, exist_ok=True)
+    module = loadProgram(program)
+    module.FOLDER = os.path.join(folder, "")
+    module.CONFIG_FILE = os.path.join(folder, os.path.basename(config))
+    module.DATA_FILE = os.path.join(folder, "data.txt")
+    module.ERROR_LOG = os.path.join(folder, "error.txt")
+    module.JOURNAL_FILE = module.CONFIG_FILE + ".journal"
+    module.LATENCY_FILE = os.path.join(folder, "latency.txt")
+    module.CONTROL_SOCKET = ""
+    module.SHM_FILE = os.path.join(folder, "counters.shm")
+    module.SEED = seed
+    module.Journal = CheckedJournal
+    module.SEGMENT_DATA = False  # One data file, to count the records
+    module.DATABASE_FILE = os.path.join(folder, "events.sqlite")
+    for name, value in (settings or {}).items():
+        setattr(module, name, value)
+    if os.path.exists(config):
+        if os.path.abspath(config) != os.path.abspath(module.CONFIG_FILE):
+            shutil.copyfile(config, module.CONFIG_FILE)
+    elif not os.path.exists(module.CONFIG_FILE):
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            try:
+                module.getParams()  # Writes the default configuration
+            except SystemExit:
+                pass
+
+    pins = {"left": module.PIN_JOY_LEFT, "right": module.PIN_JOY_RIGHT,
+            "ledLeft": module.PIN_LED_LEFT, "ledRight": module.PIN_LED_RIGHT}
+    if hasattr(module, "PIN_IR_IN"):
+        pins["ir"] = module.PIN_IR_IN
+    motor = FeederMotor(gpio, module.PIN_MOTOR_LEFT, module.PIN_MOTOR_SNAP)
+    if animal:
+        animal = Animal(gpio, pins, random.Random(seed), accuracy, visitGap,
+                        visitLength, pushGap)
+        animal.start()
+    puzzlebox.clock.startThread(lambda: _stopAfter(policy, days * 86400),
+                                "Simulation end")
+
+    if prepare is not None:
+        prepare(module)
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    output = open(os.devnull, "w") if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        try:
+            module.main()
+        except asyncio.CancelledError:
+            module.cleanup()
+    if quiet:
+        output.close()
+    records = 0
+    if getattr(module, "LOG_FORMAT", "csv") == "sqlite":
+        with contextlib.closing(sqlite3.connect(module.DATABASE_FILE)) as database:
+            records = database.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    elif os.path.exists(module.DATA_FILE):
+        if getattr(module, "LOG_FORMAT", "csv") == "binary":
+            with open(module.DATA_FILE, "rb") as dataFile:
+                records = sum(1 for record in binlog.records(dataFile))
+        else:
+            with open(module.DATA_FILE) as dataFile:
+                records = sum(1 for line in dataFile
+                              if not line.startswith(binlog.SESSION_PREFIX))
+    return {"program": os.path.basename(program),
+            "days": days,
+            "wall_seconds": round(time.perf_counter() - wallStart, 3),
+            "cpu_seconds": round(time.process_time() - cpuStart, 3),
+            "box_seconds": round(clock.monotonic(), 3),
+            "records": records,
+            "visits": animal.visits if animal else 0,
+            "pushes": animal.pushes if animal else 0,
+            "rotations": motor.rotations,
+            "journal_checks": module.journal.checks if module.journal else 0,
+            "data_file": module.DATA_FILE}
@@ -0,0 +1,59 @@
+# Command line for the puzzle box simulation
+#Licensed under the MIT License#
+"""
+Simulate a program for some days of box time, e.g.:
+
+    python -m puzzlebox.sim Coyote.py --config config.txt --days 7
+"""
+import argparse
+import ast
+import datetime
+import json
+
+from puzzlebox.sim import run
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m puzzlebox.sim",
+                                     description="Simulate the puzzle box.")
+    parser.add_argument("program", help="Coyote.py or Raccoon_Skunk.py")
+    parser.add_argument("--config", default="config.txt",
+                        help="configuration file; the default one is written "
+                             "if it does not exist")
+    parser.add_argument("--days", type=float, default=7.0)
+    parser.add_argument("--folder", default="simulation",
+                        help="folder for the data file, journal and error log")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", default=None,
+                        help="box date and time to start at, e.g. "
+                             "2020-06-01T08:00 (default: now)")
+    parser.add_argument("--accuracy", type=float, default=0.8,
+                        help="chance that the animal pushes the lit side")
+    parser.add_argument("--visit-gap", type=float, default=3600.0,
+                        help="mean seconds between visits")
+    parser.add_argument("--visit-length", type=float, default=900.0,
+                        help="mean seconds a visit lasts")
+    parser.add_argument("--push-gap", type=float, default=20.0,
+                        help="mean seconds between button pushes")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="override a constant of the program, e.g. "
+                             "IR_SAMPLE_INTERVAL=1.0 (repeatable)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the program")
+    args = parser.parse_args()
+    settings = {}
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        settings[name] = ast.literal_eval(value)
+    start = None
+    if args.start:
+        start = datetime.datetime.fromisoformat(args.start)
+    result = run(args.program, args.config, args.days, args.folder, args.seed,
+                 start, args.accuracy, args.visit_gap, args.visit_length,
+                 args.push_gap, not args.verbose, settings)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# Virtual clock for simulating the puzzle box
+#Licensed under the MIT License#
+"""
+A clock that jumps ahead instead of waiting. Every thread that takes part in
+the simulation (the main thread and the threads started with startThread())
+waits through the clock: with sleep(), or with the events and conditions it
+makes. Once all of them wait, the clock moves to the earliest deadline and
+wakes the threads waiting for it, so a simulation runs as fast as the code
+allows, in the same order as it would in real time.
+
+VirtualEventLoop is an asyncio event loop on this clock. Threads waking it with
+call_soon_threadsafe() (as puzzlebox.engine.InputChannel does) count as
+events, like in a real loop.
+"""
+import asyncio
+import datetime
+import heapq
+import itertools
+import selectors
+import threading
+
+
+class SimulationStalled(RuntimeError):
+    """Every thread waits, and none of them for a deadline."""
+    pass
+
+
+class _Waiter:
+    # A thread waiting on the clock; gate is released to wake it
+    __slots__ = ("woken", "gate")
+
+    def __init__(self):
+        self.woken = False
+        self.gate = threading.Lock()
+        self.gate.acquire()
+
+
+class VirtualClock:
+    """
+    Simulated time, starting at the date and time start. The thread that
+    makes the clock takes part in the simulation.
+    """
+    def __init__(self, start=None):
+        if start is None:
+            start = datetime.datetime.now().replace(microsecond=0)
+        self.start = start
+        self.stalled = False
+        self._now = 0.0
+        self._lock = threading.Lock()
+        self._active = 1
+        self._deadlines = []
+        self._waiting = set()
+        self._order = itertools.count()
+
+    def monotonic(self):
+        return self._now
+
+    def monotonicNs(self):
+        return round(self._now * 1e9)
+
+    def perfCounter(self):
+        return self._now
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self._now)
+
+    def sleep(self, seconds):
+        with self._lock:
+            self._block(_Waiter(), max(seconds, 0))
+
+    def event(self):
+        return VirtualEvent(self)
+
+    def condition(self):
+        return VirtualCondition(self)
+
+    def startThread(self, target, name):
+        thread = VirtualThread(self, target, name)
+        with self._lock:
+            self._active += 1
+        thread.start()
+        return thread
+
+    def _threadDone(self):
+        with self._lock:
+            self._active -= 1
+            self._advance()
+
+    def _block(self, waiter, timeout):
+        # Called with _lock held; returns with it held once waiter is woken
+        self._active -= 1
+        if not waiter.woken:
+            self._waiting.add(waiter)
+            if timeout is not None:
+                heapq.heappush(self._deadlines,
+                               (self._now + timeout, next(self._order), waiter))
+        self._advance()
+        if not waiter.woken:
+            self._lock.release()
+            waiter.gate.acquire()
+            self._lock.acquire()
+        if self.stalled:
+            raise SimulationStalled("Simulation stalled: every thread waits "
+                                    "without a deadline.")
+
+    def _wake(self, waiter):
+        # Called with _lock held
+        if not waiter.woken:
+            waiter.woken = True
+            self._waiting.discard(waiter)
+            self._active += 1
+            waiter.gate.release()
+
+    def _advance(self):
+        # Called with _lock held: move time on while no thread is running
+        deadlines = self._deadlines
+        while self._active == 0:
+            while deadlines and deadlines[0][2].woken:
+                heapq.heappop(deadlines)
+            if not deadlines:
+                if self._waiting:
+                    self.stalled = True
+                    for waiter in list(self._waiting):
+                        self._wake(waiter)
+                return
+            self._now = max(self._now, deadlines[0][0])
+            while deadlines and deadlines[0][0] <= self._now:
+                self._wake(heapq.heappop(deadlines)[2])
+
+
+class VirtualEvent:
+    """threading.Event on a VirtualClock."""
+    def __init__(self, clock):
+        self._clock = clock
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        with self._clock._lock:
+            self._flag = True
+            for waiter in self._waiters:
+                self._clock._wake(waiter)
+            self._waiters = []
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self, timeout=None):
+        with self._clock._lock:
+            if self._flag:
+                return True
+            if timeout is not None and timeout <= 0:
+                return False
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+            self._clock._block(waiter, timeout)
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            return self._flag
+
+
+class VirtualCondition:
+    """threading.Condition on a VirtualClock."""
+    def __init__(self, clock):
+        self._clock = clock
+        self._mutex = threading.Lock()
+        self._waiters = []
+
+    def __enter__(self):
+        self._mutex.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._mutex.release()
+
+    def wait(self, timeout=None):
+        """Returns False if the timeout passed without a notify()."""
+        waiter = _Waiter()
+        with self._clock._lock:
+            self._waiters.append(waiter)
+        self._mutex.release()
+        try:
+            with self._clock._lock:
+                self._clock._block(waiter, timeout)
+                notified = waiter not in self._waiters
+                if not notified:
+                    self._waiters.remove(waiter)
+                return notified
+        finally:
+            self._mutex.acquire()
+
+    def notify(self, n=1):
+        with self._clock._lock:
+            for waiter in self._waiters[:n]:
+                self._clock._wake(waiter)
+            del self._waiters[:n]
+
+    def notify_all(self):
+        self.notify(len(self._waiters))
+
+
+class VirtualThread(threading.Thread):
+    """A daemon thread taking part in the simulation; join() waits virtually."""
+    def __init__(self, clock, target, name):
+        super().__init__(name=name, daemon=True)
+        self._clock = clock
+        self._simTarget = target
+        self._finished = clock.event()
+
+    def run(self):
+        try:
+            self._simTarget()
+        finally:
+            self._finished.set()
+            self._clock._threadDone()
+
+    def join(self, timeout=None):
+        self._finished.wait(timeout)
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    # Polls the real selector, but waits for events on the virtual clock
+    def __init__(self, wake):
+        super().__init__()
+        self._wake = wake
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or (timeout is not None and timeout <= 0):
+            return ready
+        self._wake.wait(timeout)
+        self._wake.clear()
+        return super().select(0)
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """An asyncio event loop whose time is a VirtualClock."""
+    def __init__(self, clock):
+        self._clock = clock
+        self._wake = clock.event()
+        super().__init__(_VirtualSelector(self._wake))
+
+    def time(self):
+        return self._clock.monotonic()
+
+    def call_soon_threadsafe(self, callback, *args, context=None):
+        handle = super().call_soon_threadsafe(callback, *args, context=context)
+        self._wake.set()
+        return handle
+
+
+class VirtualEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    """Makes asyncio.run() use a VirtualEventLoop; keeps the last loop made."""
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+        self.loop = None
+
+    def new_event_loop(self):
+        self.loop = VirtualEventLoop(self._clock)
+        return self.loop
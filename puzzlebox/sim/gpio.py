@@ -0,0 +1,166 @@
+# Simulated RPi.GPIO for the puzzle box
+#Licensed under the MIT License#
+"""
+An in-process stand-in for the RPi.GPIO module. puzzlebox.sim.install() puts
+it in place of RPi.GPIO, so the programs run unchanged.
+
+Inputs are driven by the simulation with setInput(), which calls the edge
+callbacks like the GPIO library does, or with scheduleInput() to change an
+input later on the simulation clock. Outputs are kept in outputs, and
+onOutput() lets the simulation react to them (e.g. turning the feeder motor).
+"""
+import heapq
+import itertools
+
+from puzzlebox import clock
+
+BCM = 11
+BOARD = 10
+IN = 1
+OUT = 0
+PUD_UP = 22
+PUD_DOWN = 21
+PUD_OFF = 20
+RISING = 31
+FALLING = 32
+BOTH = 33
+HIGH = 1
+LOW = 0
+
+inputs = dict()
+outputs = dict()
+_detectors = dict()
+_outputHooks = dict()
+_timeline = None
+
+
+def setmode(mode):
+    pass
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    if direction == IN:
+        inputs.setdefault(channel, 1 if pull_up_down == PUD_UP else 0)
+    else:
+        outputs[channel] = initial if initial is not None else 0
+
+
+def input(channel):
+    if channel in inputs:
+        return inputs[channel]
+    return outputs.get(channel, 0)
+
+
+def output(channel, value):
+    value = 1 if value else 0
+    outputs[channel] = value
+    hook = _outputHooks.get(channel)
+    if hook is not None:
+        hook(value)
+
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    if channel in _detectors:
+        raise RuntimeError("Conflicting edge detection already enabled for "
+                           "this GPIO channel")
+    _detectors[channel] = [edge, callback, (bouncetime or 0) / 1000, None]
+
+
+def remove_event_detect(channel):
+    _detectors.pop(channel, None)
+
+
+def cleanup(channel=None):
+    _detectors.clear()
+    _outputHooks.clear()
+
+
+def reset():
+    """Forget all pins, e.g. before the next simulation in the same process."""
+    global _timeline
+    cleanup()
+    inputs.clear()
+    outputs.clear()
+    _timeline = None
+
+
+class PWM:
+    """PWM output; the duty cycle is kept in dutyCycle."""
+    def __init__(self, channel, frequency):
+        self.channel = channel
+        self.frequency = frequency
+        self.dutyCycle = 0
+
+    def start(self, dutyCycle):
+        self.dutyCycle = dutyCycle
+
+    def ChangeDutyCycle(self, dutyCycle):
+        self.dutyCycle = dutyCycle
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.dutyCycle = 0
+
+
+def setInput(channel, level):
+    """Drive an input; calls its edge callback on the calling thread."""
+    level = 1 if level else 0
+    previous = inputs.get(channel)
+    inputs[channel] = level
+    detector = _detectors.get(channel)
+    if detector is None or previous == level:
+        return
+    edge, callback, bouncetime, lastEdge = detector
+    if edge != BOTH and edge != (RISING if level else FALLING):
+        return
+    now = clock.monotonic()
+    if lastEdge is not None and now - lastEdge < bouncetime:
+        return
+    detector[3] = now
+    if callback is not None:
+        callback(channel)
+
+
+def scheduleInput(channel, level, delay):
+    """Drive an input delay seconds from now."""
+    global _timeline
+    if _timeline is None:
+        _timeline = _Timeline()
+    _timeline.after(delay, setInput, channel, level)
+
+
+def onOutput(channel, hook):
+    """Call hook(value) whenever the output is written."""
+    _outputHooks[channel] = hook
+
+
+class _Timeline:
+    # Runs scheduled input changes on a simulation thread
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = clock.condition()
+        clock.startThread(self._run, "GPIO timeline")
+
+    def after(self, delay, function, *args):
+        with self._condition:
+            heapq.heappush(self._heap, (clock.monotonic() + delay,
+                                        next(self._order), function, args))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > clock.monotonic():
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - clock.monotonic()
+                    self._condition.wait(timeout)
+                _, _, function, args = heapq.heappop(self._heap)
+            function(*args)
@@ -0,0 +1,574 @@
+# Vectorized simulation of virtual learners for the puzzle box
+#Licensed under the MIT License#
+"""
+Estimates how many days, trials and rewards a sequence of tests takes before
+it is tried on animals. Thousands of virtual learners go through the protocol
+at once, held in NumPy arrays with one element per learner, so a population
+is simulated in seconds rather than with one Python loop per animal.
+
+The protocol is the one of the programs, step by step:
+
+* training() rewards pushes until push_reward_e rewards were given (at most
+  push_reward_r and push_reward_l of them for one side), then test 1 starts;
+  Raccoon_Skunk.py first gives entry_reward entry rewards
+* testing() picks the trials of random, shuffle and fixed tests the same way,
+  resolves the S and O answers from the previous input, repeats failed trials
+  fail_trial_repeat times and decides on the block with the configured block
+  criterion (puzzlebox.criteria)
+* blockSuccess() moves on to the next test after blocks_to_pass passed
+  blocks, and back to loop_test after the last one
+* no more trials are made after rew_max rewards in a day, and startDay()
+  resets the counters and goes back to training every day
+
+Only the trials are simulated, not the time between them, so fail_delay and
+the timeouts after failed trials or blocks only reset their counters. A
+learner makes at most trialsPerDay pushes a day. Departures and the reset
+timeout of Coyote.py are not simulated.
+
+The learners are simple models of an animal (see RescorlaWagner and
+WinStayLoseShift); every parameter is a number or an array with a value per
+learner, to simulate a population of different animals.
+
+Run with e.g.: python -m puzzlebox.sim.population Coyote.py --config
+config.txt --learner rw --alpha 0.1:0.4 --beta 5 --learners 5000 --days 30
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from puzzlebox.criteria import createCriterion, Binomial, SlidingWindow, Streak
+from puzzlebox.sim import install, loadProgram
+from puzzlebox.sim.clock import VirtualClock
+from puzzlebox.trials import ANSWER_CODES, LED_CODES, LED_NAMES
+
+# Sides are the codes of the L and R answers
+LEFT = ANSWER_CODES["L"]
+RIGHT = ANSWER_CODES["R"]
+EITHER = ANSWER_CODES["E"]
+ANY = ANSWER_CODES["I"]
+SAME = ANSWER_CODES["S"]
+OPPOSITE = ANSWER_CODES["O"]
+# The previous answer before there was one ("X" in the programs)
+NO_ANSWER = -1
+# Both LEDs are on during training
+TRAINING_LEDS = LED_CODES["B"]
+# The parameters the simulation uses; the others are counters of the box
+PARAMETERS = ("entry_reward", "push_reward_e", "push_reward_r", "push_reward_l",
+              "trials_in_block", "loop_test", "block_suc_thresh",
+              "blocks_to_pass", "rew_max", "max_failed_blocks",
+              "max_failed_trails", "fail_trial_repeat", "consecutive_block",
+              "block_criterion", "criterion_alpha")
+
+
+def _perLearner(value, count):
+    # A parameter as an array with one value per learner
+    return np.broadcast_to(np.asarray(value, dtype=float), (count,)).copy()
+
+
+class RescorlaWagner:
+    """
+    Learns the value of pushing each side for each LED configuration with the
+    Rescorla-Wagner rule (the value moves alpha of the way to the reward) and
+    pushes the right side with the softmax probability of the values, with
+    inverse temperature beta. lapse is the chance of a push at random.
+    """
+    name = "rw"
+
+    def __init__(self, alpha=0.2, beta=5.0, lapse=0.0, initial=0.5):
+        self.alpha = alpha
+        self.beta = beta
+        self.lapse = lapse
+        self.initial = initial
+
+    def reset(self, count):
+        self.values = np.empty((count, len(LED_NAMES), 2))
+        self.values[:] = _perLearner(self.initial, count)[:, None, None]
+        self._alpha = _perLearner(self.alpha, count)
+        self._beta = _perLearner(self.beta, count)
+        self._lapse = _perLearner(self.lapse, count)
+
+    def choose(self, rng, learners, leds):
+        values = self.values[learners, leds]
+        difference = values[:, RIGHT] - values[:, LEFT]
+        right = 1.0 / (1.0 + np.exp(-self._beta[learners] * difference))
+        lapse = self._lapse[learners]
+        right = lapse * 0.5 + (1.0 - lapse) * right
+        return np.where(rng.random(len(learners)) < right, RIGHT, LEFT)
+
+    def learn(self, learners, leds, sides, rewards):
+        values = self.values[learners, leds, sides]
+        self.values[learners, leds, sides] = (
+            values + self._alpha[learners] * (rewards - values))
+
+
+class WinStayLoseShift:
+    """
+    Pushes the same side again after a reward with chance winStay and the
+    other side after a push without one with chance loseShift, whatever the
+    LEDs show. The first push is at random.
+    """
+    name = "wsls"
+
+    def __init__(self, winStay=0.9, loseShift=0.9):
+        self.winStay = winStay
+        self.loseShift = loseShift
+
+    def reset(self, count):
+        self.last = np.full(count, NO_ANSWER)
+        self.won = np.zeros(count, dtype=bool)
+        self._winStay = _perLearner(self.winStay, count)
+        self._loseShift = _perLearner(self.loseShift, count)
+
+    def choose(self, rng, learners, leds):
+        last = self.last[learners]
+        stay = np.where(self.won[learners], self._winStay[learners],
+                        1.0 - self._loseShift[learners])
+        draws = rng.random(len(learners))
+        sides = np.where(draws < stay, last, 1 - last)
+        first = last == NO_ANSWER
+        sides[first] = np.where(draws[first] < 0.5, RIGHT, LEFT)
+        return sides
+
+    def learn(self, learners, leds, sides, rewards):
+        self.last[learners] = sides
+        self.won[learners] = rewards > 0
+
+
+LEARNERS = {learner.name: learner for learner in (RescorlaWagner, WinStayLoseShift)}
+
+
+class Protocol:
+    """
+    The parameters, tests and compiled trial tables of a configuration file,
+    as read by getParams(). entryRewards is whether the program gives entry
+    rewards at the start of training (Raccoon_Skunk.py does).
+    """
+    def __init__(self, par, tests, trialTables, entryRewards=False):
+        self.par = dict(par)
+        self.tests = list(tests)
+        self.trialTables = {test: tuple(trialTables[test]) for test in self.tests}
+        self.tables = [np.array(trialTables[test], dtype=np.int64).reshape(-1, 2)
+                       for test in self.tests]
+        self.entryRewards = entryRewards
+        name = self.par['block_criterion']
+        if not name:
+            name = "sliding" if self.par['consecutive_block'] else "fixed"
+        self.criterion = createCriterion(name, self.par['trials_in_block'],
+                                         self.par['block_suc_thresh'],
+                                         self.par['criterion_alpha'])
+
+    def description(self):
+        """Everything the simulation uses, as a dict that can be stored as JSON."""
+        return {"parameters": {name: self.par[name] for name in PARAMETERS},
+                "tests": self.tests,
+                "trials": {test: [list(trial) for trial in table]
+                           for test, table in self.trialTables.items()},
+                "entryRewards": self.entryRewards}
+
+    def withParameters(self, changes):
+        """A copy with some of the parameters changed."""
+        par = dict(self.par)
+        par.update(changes)
+        return Protocol(par, self.tests, self.trialTables, self.entryRewards)
+
+    @classmethod
+    def fromConfig(cls, program, config):
+        """
+        Read the configuration file config the way program (e.g. "Coyote.py")
+        reads it. Raises a ValueError if the program rejects it.
+        """
+        if not os.path.exists(config):
+            raise FileNotFoundError("Configuration file " + config + " not found")
+        install(VirtualClock())
+        module = loadProgram(program, "population_config")
+        module.CONFIG_FILE = config
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                module.getParams()
+        except SystemExit:
+            lines = output.getvalue().strip().splitlines()
+            message = lines[-1] if lines else "Invalid configuration file"
+            raise ValueError(message.replace("ERROR: ", "", 1))
+        finally:
+            del sys.modules["population_config"]
+        return cls(module.par, module.tests, module.trialTables,
+                   hasattr(module, "waitForAnimal"))
+
+
+class Results:
+    """
+    What each learner needed to pass each test the first time: arrays of
+    learners by tests of the days (counting the first one as 1), and of the
+    trials, blocks and rewards of the test up to then, over all days. They
+    are -1 where the learner did not pass the test.
+    """
+    def __init__(self, tests, days, trials, blocks, rewards, simulatedDays,
+                 seconds):
+        self.tests = tests
+        self.days = days
+        self.trials = trials
+        self.blocks = blocks
+        self.rewards = rewards
+        self.simulatedDays = simulatedDays
+        self.seconds = seconds
+
+    def summary(self, percentiles=(10, 50, 90)):
+        """Share of learners that passed and percentiles, for every test."""
+        tests = []
+        for index, test in enumerate(self.tests):
+            passed = self.days[:, index] >= 0
+            line = {"test": index + 1, "name": test,
+                    "passed": round(float(passed.mean()), 4)}
+            for name in ("days", "trials", "blocks", "rewards"):
+                values = getattr(self, name)[passed, index]
+                if values.size == 0:
+                    continue
+                line[name] = {"p%d" % p: float(v) for p, v in
+                              zip(percentiles, np.percentile(values, percentiles))}
+                line[name]["mean"] = round(float(values.mean()), 2)
+            tests.append(line)
+        return {"learners": len(self.days), "days": self.simulatedDays,
+                "seconds": round(self.seconds, 3), "tests": tests}
+
+    def save(self, path):
+        """Save the arrays with numpy.savez, e.g. for plotting."""
+        np.savez(path, tests=np.array(self.tests), days=self.days,
+                 trials=self.trials, blocks=self.blocks, rewards=self.rewards)
+
+
+class Population:
+    """
+    count copies of learner going through protocol, each with counters of
+    its own; the arrays are named after the parameters they stand for.
+    """
+    def __init__(self, protocol, learner, count=1000, seed=0, trialsPerDay=100,
+                 resetDaily=True):
+        self.protocol = protocol
+        self.learner = learner
+        self.count = count
+        self.rng = np.random.default_rng(seed)
+        self.trialsPerDay = trialsPerDay
+        self.resetDaily = resetDaily
+        learner.reset(count)
+        tests = len(protocol.tests)
+        longest = max([len(table) for table in protocol.tables] + [1])
+        zeros = lambda: np.zeros(count, dtype=np.int64)
+        # The counters of par, by learner
+        self.test = zeros()
+        self.trial = zeros()
+        self.successes = zeros()
+        self.failedCurrent = zeros()
+        self.failedTrials = zeros()
+        self.failedBlocks = zeros()
+        self.blockSuccesses = zeros()
+        self.rewardCount = zeros()
+        self.pushes = zeros()
+        self.pushesLeft = zeros()
+        self.pushesRight = zeros()
+        self.previous = np.full(count, NO_ANSWER)
+        self.shuffled = np.zeros((count, longest, 2), dtype=np.int64)
+        self.shuffledLength = zeros()
+        # The state of the block criterion
+        size = max(protocol.par['trials_in_block'], 1)
+        self.window = np.zeros((count, size), dtype=np.int64)
+        self.windowTotal = zeros()
+        self.streak = zeros()
+        # Spent in each test so far, and what it took to pass it
+        self.spentTrials = np.zeros((count, tests), dtype=np.int64)
+        self.spentBlocks = np.zeros((count, tests), dtype=np.int64)
+        self.spentRewards = np.zeros((count, tests), dtype=np.int64)
+        self.passDays = np.full((count, tests), -1, dtype=np.int64)
+        self.passTrials = np.full((count, tests), -1, dtype=np.int64)
+        self.passBlocks = np.full((count, tests), -1, dtype=np.int64)
+        self.passRewards = np.full((count, tests), -1, dtype=np.int64)
+        self.day = 0
+
+    def run(self, days):
+        """Simulate days more days and return the Results."""
+        started = time.perf_counter()
+        for _ in range(days):
+            self.startDay()
+            for _ in range(self.trialsPerDay):
+                if not self.step():
+                    break
+            self.day += 1
+            if self.protocol.tests and np.all(self.passDays >= 0):
+                break  # Every learner passed every test
+        return Results(self.protocol.tests, self.passDays, self.passTrials,
+                       self.passBlocks, self.passRewards, self.day,
+                       time.perf_counter() - started)
+
+    def startDay(self):
+        par = self.protocol.par
+        if self.resetDaily or self.day == 0:
+            for counter in (self.test, self.trial, self.successes,
+                            self.failedCurrent, self.failedTrials,
+                            self.failedBlocks, self.blockSuccesses,
+                            self.pushes, self.pushesLeft, self.pushesRight):
+                counter[:] = 0
+            self._resetCriterion(slice(None))
+        self.rewardCount[:] = 0
+        if self.protocol.entryRewards:
+            self.rewardCount[:] = min(par['entry_reward'], par['rew_max'])
+
+    def step(self):
+        """Every learner that may still push pushes once; False if none may."""
+        par = self.protocol.par
+        tests = len(self.protocol.tests)
+        # Training ends once its rewards were given
+        self.test[(self.test == 0) & (self.pushes >= par['push_reward_e'])] = 1
+        active = (self.rewardCount < par['rew_max']) & (self.test <= tests)
+        learners = np.flatnonzero(active)
+        if learners.size == 0:
+            return False
+        training = self.test[learners] == 0
+        if training.any():
+            self._training(learners[training])
+        if not training.all():
+            self._testing(learners[~training])
+        return True
+
+    def _training(self, learners):
+        par = self.protocol.par
+        leds = np.full(len(learners), TRAINING_LEDS)
+        sides = self.learner.choose(self.rng, learners, leds)
+        right = sides == RIGHT
+        forSide = np.where(right, self.pushesRight[learners] < par['push_reward_r'],
+                           self.pushesLeft[learners] < par['push_reward_l'])
+        claimed = (self.pushes[learners] - self.pushesRight[learners] -
+                   self.pushesLeft[learners])
+        either = claimed < par['push_reward_e'] - par['push_reward_r'] - par['push_reward_l']
+        rewarded = forSide | either
+        self.pushesRight[learners[forSide & right]] += 1
+        self.pushesLeft[learners[forSide & ~right]] += 1
+        self.pushes[learners[rewarded]] += 1
+        self.rewardCount[learners[rewarded]] += 1
+        self.learner.learn(learners, leds, sides, rewarded.astype(float))
+
+    def _testing(self, learners):
+        par = self.protocol.par
+        rng = self.rng
+        answers, leds = self._selectTrials(learners)
+        # Answers that depend on the previous input
+        previous = self.previous[learners]
+        same = answers == SAME
+        answers[same] = previous[same]
+        opposite = answers == OPPOSITE
+        answers[opposite] = np.where(previous[opposite] == NO_ANSWER, NO_ANSWER,
+                                     1 - previous[opposite])
+        answers[answers == NO_ANSWER] = ANY
+
+        sides = self.learner.choose(rng, learners, leds)
+        correct = (sides == answers) | (answers == EITHER) | (answers == ANY)
+        self.learner.learn(learners, leds, sides, correct.astype(float))
+        tests = self.test[learners] - 1
+        self.spentTrials[learners, tests] += 1
+        self._record(learners, correct)
+
+        passed = learners[correct]
+        self.successes[passed] += 1
+        self.rewardCount[passed] += 1
+        self.spentRewards[passed, tests[correct]] += 1
+        self.failedCurrent[passed] = 0
+        anyAnswer = correct & (answers == ANY)
+        self.previous[learners[anyAnswer]] = sides[anyAnswer]
+
+        failed = learners[~correct]
+        self.failedTrials[failed] += 1
+        self.failedCurrent[failed] += 1
+        repeat = par['fail_trial_repeat'] >= self.failedCurrent[failed]
+        self.trial[failed[repeat]] -= 1
+        self.failedCurrent[failed[~repeat]] = 0
+        if par['max_failed_trails'] > 0:
+            timedOut = self.failedTrials[failed] >= par['max_failed_trails']
+            self.failedTrials[failed[timedOut]] = 0
+
+        self.trial[learners] += 1
+        blockPassed, blockEnded = self._decide(learners)
+        self._blockSuccess(learners[blockPassed])
+        self._blockFail(learners[blockEnded & ~blockPassed])
+        self._endBlock(learners[blockEnded], tests[blockEnded])
+
+    def _selectTrials(self, learners):
+        # The answer and LED codes of the next trial, as in testing()
+        answers = np.empty(len(learners), dtype=np.int64)
+        leds = np.empty(len(learners), dtype=np.int64)
+        tests = self.test[learners]
+        for index, (test, table) in enumerate(zip(self.protocol.tests,
+                                                  self.protocol.tables)):
+            selected = np.flatnonzero(tests == index + 1)
+            if selected.size == 0:
+                continue
+            who = learners[selected]
+            size = len(table)
+            if test.startswith("random"):
+                trials = table[self.rng.integers(size, size=len(who))]
+            elif test.startswith("shuffle"):
+                reshuffle = (((self.trial[who] % size == 0) &
+                              (self.failedCurrent[who] == 0)) |
+                             (self.shuffledLength[who] == 0))
+                shuffle = who[reshuffle]
+                if shuffle.size:
+                    order = np.argsort(self.rng.random((len(shuffle), size)), axis=1)
+                    self.shuffled[shuffle, :size] = table[order]
+                    self.shuffledLength[shuffle] = size
+                position = np.where(reshuffle, 0, self.trial[who] %
+                                    np.maximum(self.shuffledLength[who], 1))
+                trials = self.shuffled[who, position]
+            else:
+                trials = table[self.trial[who] % size]
+            answers[selected] = trials[:, 0]
+            leds[selected] = trials[:, 1]
+        return answers, leds
+
+    def _record(self, learners, correct):
+        # criterion.record() with the trial count before it is advanced
+        criterion = self.protocol.criterion
+        if isinstance(criterion, SlidingWindow):
+            slots = self.trial[learners] % criterion.trialsInBlock
+            values = correct.astype(np.int64)
+            self.windowTotal[learners] += values - self.window[learners, slots]
+            self.window[learners, slots] = values
+        elif isinstance(criterion, Streak):
+            self.streak[learners] = np.where(correct, self.streak[learners] + 1, 0)
+
+    def _decide(self, learners):
+        # criterion.decide(): whether the block was passed, and whether it ended
+        criterion = self.protocol.criterion
+        if isinstance(criterion, SlidingWindow):
+            passed = self.windowTotal[learners] >= criterion.threshold
+            return passed, passed
+        if isinstance(criterion, Streak):
+            passed = self.streak[learners] >= criterion.threshold
+            return passed, passed
+        needed = (criterion.needed if isinstance(criterion, Binomial)
+                  else criterion.threshold)
+        ended = self.trial[learners] >= criterion.trialsInBlock
+        return ended & (self.successes[learners] >= needed), ended
+
+    def _blockSuccess(self, learners):
+        par = self.protocol.par
+        tests = len(self.protocol.tests)
+        self.blockSuccesses[learners] += 1
+        advancing = learners[self.blockSuccesses[learners] >= par['blocks_to_pass']]
+        if advancing.size == 0:
+            return
+        index = self.test[advancing] - 1
+        # The block that is ending is counted by _endBlock(), after this
+        first = self.passDays[advancing, index] < 0
+        who, index = advancing[first], index[first]
+        self.passDays[who, index] = self.day + 1
+        self.passTrials[who, index] = self.spentTrials[who, index]
+        self.passBlocks[who, index] = self.spentBlocks[who, index] + 1
+        self.passRewards[who, index] = self.spentRewards[who, index]
+        self.test[advancing] += 1
+        self.blockSuccesses[advancing] = 0
+        if par['loop_test'] > 0:
+            looping = advancing[self.test[advancing] > tests]
+            self.test[looping] = par['loop_test']
+
+    def _blockFail(self, learners):
+        par = self.protocol.par
+        self.failedBlocks[learners] += 1
+        if par['max_failed_blocks'] > 0:
+            timedOut = learners[self.failedBlocks[learners] >= par['max_failed_blocks']]
+            self.failedBlocks[timedOut] = 0
+
+    def _endBlock(self, learners, tests):
+        # tests are the indices of the tests the blocks were in
+        self.spentBlocks[learners, tests] += 1
+        self.trial[learners] = 0
+        self.failedTrials[learners] = 0
+        self.successes[learners] = 0
+        self._resetCriterion(learners)
+
+    def _resetCriterion(self, learners):
+        self.window[learners] = 0
+        self.windowTotal[learners] = 0
+        self.streak[learners] = 0
+
+
+def parameter(text, count, rng):
+    """A number, or LOW:HIGH for values drawn uniformly for every learner."""
+    if ":" in text:
+        low, high = (float(value) for value in text.split(":", 1))
+        return rng.uniform(low, high, count)
+    return float(text)
+
+
+def createLearner(spec, count, seed):
+    """
+    Make the learner described by spec, a dict with its name and its
+    parameters as text (see parameter()), as made by learnerSpec().
+    """
+    rng = np.random.default_rng(seed + 1)
+    values = lambda name: parameter(spec[name], count, rng)
+    if spec["learner"] == RescorlaWagner.name:
+        return RescorlaWagner(values("alpha"), values("beta"), values("lapse"))
+    if spec["learner"] == WinStayLoseShift.name:
+        return WinStayLoseShift(values("win_stay"), values("lose_shift"))
+    raise ValueError("Learner " + repr(spec["learner"]) + " not known. "
+                     "Ensure it is in: " + str(list(LEARNERS)))
+
+
+def addArguments(parser):
+    """Add the options for the learners and the simulation to parser."""
+    parser.add_argument("--learner", choices=list(LEARNERS), default="rw",
+                        help="rw: Rescorla-Wagner, wsls: win-stay lose-shift")
+    parser.add_argument("--learners", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--trials-per-day", type=int, default=100,
+                        help="most pushes a learner makes in a day")
+    parser.add_argument("--no-daily-reset", action="store_true",
+                        help="keep the test and block counters over days")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alpha", default="0.2", help="rw learning rate")
+    parser.add_argument("--beta", default="5", help="rw inverse temperature")
+    parser.add_argument("--lapse", default="0", help="rw chance of a random push")
+    parser.add_argument("--win-stay", default="0.9", help="wsls")
+    parser.add_argument("--lose-shift", default="0.9", help="wsls")
+
+
+def learnerSpec(args):
+    """The learner chosen with the options of addArguments()."""
+    names = {RescorlaWagner.name: ("alpha", "beta", "lapse"),
+             WinStayLoseShift.name: ("win_stay", "lose_shift")}[args.learner]
+    spec = {"learner": args.learner}
+    spec.update((name, getattr(args, name)) for name in names)
+    return spec
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m puzzlebox.sim.population",
+                                     description="Simulate virtual learners "
+                                                 "going through the tests.")
+    parser.add_argument("program", help="Coyote.py or Raccoon_Skunk.py")
+    parser.add_argument("--config", default="config.txt",
+                        help="configuration file with the tests")
+    addArguments(parser)
+    parser.add_argument("--save", help="also save the arrays to this .npz file")
+    args = parser.parse_args()
+    learner = createLearner(learnerSpec(args), args.learners, args.seed)
+    try:
+        protocol = Protocol.fromConfig(args.program, args.config)
+    except (OSError, ValueError) as err:
+        print("ERROR:", err)
+        return 1
+    population = Population(protocol, learner, args.learners, args.seed,
+                            args.trials_per_day, not args.no_daily_reset)
+    results = population.run(args.days)
+    print(json.dumps(results.summary(), indent=2))
+    if args.save:
+        results.save(args.save)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# Headless pygame for simulating the puzzle box
+#Licensed under the MIT License#
+"""
+The parts of pygame the programs use, without a display or sound card.
+puzzlebox.sim.install() puts it in place of pygame. Images and sounds are not
+read from the disk; what was shown and played is counted instead. Key presses
+can be queued with postKey(), e.g. Escape to end Raccoon_Skunk.py.
+"""
+import collections
+import types
+
+KEYDOWN = 768
+KEYUP = 769
+QUIT = 256
+K_ESCAPE = 27
+FULLSCREEN = -2147483648
+
+class error(RuntimeError):
+    pass
+
+
+# What the program did, for checking a simulation
+counts = collections.Counter()
+_events = []
+
+
+class Surface:
+    def __init__(self, size=(1280, 768)):
+        self.size = size
+
+    def convert(self):
+        return self
+
+    def blit(self, source, dest):
+        counts["blit"] += 1
+
+    def get_size(self):
+        return self.size
+
+    def get_pitch(self):
+        return self.size[0] * 4
+
+    def get_height(self):
+        return self.size[1]
+
+
+class Sound:
+    def __init__(self, file):
+        self.file = file
+
+    def play(self):
+        counts["sound"] += 1
+
+    def get_length(self):
+        return 0.2
+
+
+def _setMode(size, flags=0):
+    return Surface(size)
+
+
+def _flip():
+    counts["flip"] += 1
+
+
+def _load(file):
+    return Surface()
+
+
+def _get():
+    events = list(_events)
+    del _events[:]
+    return events
+
+
+def _getInit():
+    return (22050, -16, 1)
+
+
+def postKey(key):
+    """Queue a key press for the next pygame.event.get()."""
+    _events.append(types.SimpleNamespace(type=KEYDOWN, key=key))
+
+
+def init():
+    pass
+
+
+def quit():
+    pass
+
+
+display = types.SimpleNamespace(init=init, quit=quit, set_mode=_setMode,
+                                flip=_flip, update=_flip)
+image = types.SimpleNamespace(load=_load)
+mixer = types.SimpleNamespace(pre_init=lambda *args, **kwargs: None,
+                              init=init, quit=quit, get_init=_getInit,
+                              Sound=Sound)
+event = types.SimpleNamespace(pump=lambda: None, get=_get)
@@ -0,0 +1,354 @@
+# Replay of recorded sessions for the puzzle box
+#Licensed under the MIT License#
+"""
+Replays the button pushes of a data file through a program in the simulation
+and checks that the program logs the same records again: the event and the
+curr_test, curr_block, trial_cnt and rew_cnt of every record. A change to the
+protocol that changes what an animal would have been asked, or when it would
+have passed a block or a test, shows up as the first record that differs.
+
+Every session of the data file is run from its start time, with the seed of
+its random trial selection, on the virtual clock and as fast as it goes. The
+replay stands in for the animal: pushWait() returns the push of the next
+record at the time it was logged, and for Raccoon_Skunk.py the IR sensor
+reports the arrivals and departures the records show. Everything else, from
+the trial selection to the day rollovers, is the program's own code.
+
+The sessions are replayed one after the other in one folder, starting from
+the configuration file the first one started with, so every session starts
+from the configuration and journal the previous one left, as on the box.
+Sessions recorded before the seed was logged only replay if their tests do
+not choose trials at random. The daily segments of puzzlebox.segments are
+replayed by passing them all in order, compressed or not; the header that
+starts every segment continues the session of the segment before.
+
+Run with: python -m puzzlebox.sim.replay Coyote.py DATA_FILE... --config config.txt
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from puzzlebox import binlog, clock
+from puzzlebox.segments import openSegment
+from puzzlebox.sim import _cancelAll, run
+
+# Fields of a record
+EVENT = 1
+TIME1 = 2
+TIME2 = 3
+# Counters checked in every record, besides the event and rew_cnt
+CHECKED = ("curr_test", "curr_block", "trial_cnt")
+# Records that end a wait for a push or an animal; the program logs the
+# others (entry rewards) by itself
+INPUT_EVENTS = frozenset("SFPXMDT")
+
+
+def _time(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S')
+
+
+class ReplayPresence:
+    """Stands in for the PresenceTracker of Raccoon_Skunk.py."""
+    def __init__(self, *args, **kwargs):
+        self.present = False
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=5):
+        pass
+
+    def stats(self):
+        return {"replayed": True}
+
+
+class Replayer:
+    """
+    Replays records (lists of the fields of the CSV lines) through a program;
+    install() is the prepare function for puzzlebox.sim.run(). After the run,
+    mismatch describes the first record that was logged differently, if any.
+    """
+    def __init__(self, records):
+        self.records = records
+        self.input = 0  # The next record to replay
+        self.logged = 0  # The next record the program should log
+        self.mismatch = None
+        self.presence = None
+        self._waits = 0
+
+    def install(self, module):
+        self.module = module
+        counters = list(module.LOG_COUNTERS)
+        self._fields = {name: 4 + counters.index(name) for name in CHECKED}
+        self._fields["rew_cnt"] = 7 + len(counters)
+        self._pushField = 5 + len(counters)
+        self._logIt = module.logIt
+        module.logIt = self.logIt
+        module.pushWait = self.pushWait
+        module.outOfRewardWait = self.outOfRewardWait
+        if hasattr(module, "waitForAnimal"):
+            self.presence = ReplayPresence()
+            module.PresenceTracker = lambda *args, **kwargs: self.presence
+            self._waitForAnimal = module.waitForAnimal
+            module.waitForAnimal = self.waitForAnimal
+            self._timeout = module.timeout
+            module.timeout = self.timeout
+
+    def _nextInput(self):
+        while (self.input < len(self.records) and
+               self.records[self.input][EVENT] not in INPUT_EVENTS):
+            self.input += 1
+        if self.input == len(self.records):
+            return None
+        return self.records[self.input]
+
+    async def _sleepUntil(self, timeText):
+        delay = (_time(timeText) - clock.now()).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _finish(self):
+        # Nothing left to replay: end the session like a key press would
+        _cancelAll(asyncio.get_running_loop())
+        await asyncio.Event().wait()
+
+    def _fail(self, expected, actual):
+        self.mismatch = {"record": self.logged + 1, "expected": expected,
+                         "actual": actual}
+        _cancelAll(asyncio.get_running_loop())
+
+    def _leave(self):
+        self.presence.present = False
+        self.module.irChanged(False)
+
+    async def _waitUntil(self, timeText):
+        # Sleep like _sleepUntil(), but as a wait for a push that the timers
+        # of the program can end, as Coyote.py does at the start of a day.
+        # Returns True if they did.
+        module = self.module
+        module.push = 0
+        module.pushChanged.clear()
+        module.listen = 1
+        module.waitingOutOfReward = True
+        delay = (_time(timeText) - clock.now()).total_seconds()
+        try:
+            await asyncio.wait_for(module.pushChanged.wait(), max(delay, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            module.listen = 0
+            module.waitingOutOfReward = False
+
+    async def outOfRewardWait(self):
+        # The program waits for the animal to push (M) or leave; a departure
+        # has no record, so the wait ends when the next record is due
+        module = self.module
+        record = self._nextInput()
+        if record is None:
+            await self._finish()
+        if record[EVENT] == "M":
+            self._waits = 0
+            if not await self._waitUntil(record[TIME2]):
+                self.input += 1
+                self._push(record)
+            return
+        self._waits += 1
+        if self._waits > 2:
+            self._fail({"event": record[EVENT]}, {"event": "out of reward"})
+            await self._finish()
+        if await self._waitUntil(record[TIME1]):
+            return
+        if self.presence:
+            self.presence.present = False
+        module.push = "D"
+
+    def _push(self, record):
+        module = self.module
+        module.push = record[self._pushField]
+        module.pushTime = clock.monotonicNs()
+        module.trialTimes.pushed(module.pushTime)
+
+    async def pushWait(self):
+        module = self.module
+        record = self._nextInput()
+        if record is None:
+            await self._finish()
+        self._waits = 0
+        self.input += 1
+        await self._sleepUntil(record[TIME2])
+        if record[EVENT] in ("D", "T"):
+            if record[EVENT] == "D" and self.presence:
+                self.presence.present = False
+            module.push = record[EVENT]
+        else:
+            self._push(record)
+
+    async def waitForAnimal(self):
+        record = self._nextInput()
+        if record is None:
+            await self._finish()
+        await self._sleepUntil(record[TIME1])
+        self.presence.present = True
+        return await self._waitForAnimal()
+
+    async def timeout(self, length):
+        # A departure during a timeout is logged by the timeout itself
+        record = self._nextInput()
+        if record is not None and record[EVENT] == "D" and length > 0:
+            delay = (_time(record[TIME2]) - clock.now()).total_seconds()
+            if delay < length:
+                self.input += 1
+                asyncio.get_running_loop().call_later(max(delay, 0), self._leave)
+        await self._timeout(length)
+
+    def logIt(self, AnimalID, event, time1, time2, push, correct):
+        self._logIt(AnimalID, event, time1, time2, push, correct)
+        if self.mismatch is not None:
+            return
+        par = self.module.par
+        actual = {"event": event, "time": time2}
+        actual.update((name, par[name]) for name in self._fields)
+        if self.logged == len(self.records):
+            self._fail(None, actual)
+            return
+        record = self.records[self.logged]
+        expected = {"event": record[EVENT], "time": record[TIME2]}
+        expected.update((name, int(record[field]))
+                        for name, field in self._fields.items())
+        # The times are only reported; delays of the program may shift them
+        if {**expected, "time": None} != {**actual, "time": None}:
+            self._fail(expected, actual)
+            return
+        self.logged += 1
+
+
+def readSessions(paths):
+    """
+    The sessions of CSV or binary data files (a path or a list of them, in
+    order; gzipped segments too), as dicts with their start time, seed (None
+    if it was not logged) and records (lists of the fields of the CSV lines).
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    sessions = []
+
+    def startSession(start, seed):
+        # A segment of puzzlebox.segments repeats the header of its session
+        if (start is not None and sessions and
+                (sessions[-1]["start"], sessions[-1]["seed"]) == (start, seed)):
+            return
+        sessions.append({"start": start, "seed": seed, "records": []})
+
+    for path in paths:
+        with openSegment(path) as dataFile:
+            if dataFile.peek(1)[:1] == b"\x00":
+                for description, fields in binlog.records(dataFile, headers=True):
+                    if fields is None:
+                        startSession(description.get("start"),
+                                     description.get("seed"))
+                    else:
+                        line = binlog.csvLine(description, fields)
+                        sessions[-1]["records"].append(line.split(","))
+                continue
+            for line in io.TextIOWrapper(dataFile, encoding="utf-8"):
+                session = binlog.parseSessionLine(line)
+                if session is not None:
+                    startSession(session.get("start"), session.get("seed"))
+                    continue
+                fields = line.rstrip("\r\n").split(",")
+                if len(fields) < 8:
+                    continue  # Not a record
+                if not sessions:
+                    startSession(None, None)
+                sessions[-1]["records"].append(fields)
+    for session in sessions:
+        if session["start"] is None and session["records"]:
+            session["start"] = session["records"][0][TIME1]
+    return [session for session in sessions if session["start"] is not None]
+
+
+def replay(program, config, dataPath, folder=None, quiet=True):
+    """
+    Replay the sessions of the data file dataPath (or a list of its segments)
+    through program, starting from the configuration file config, in folder
+    (by default a temporary folder, which is removed afterwards). Returns a
+    dict with the results; "mismatch" describes the first record that was
+    logged differently, or is None.
+    """
+    if folder is None:
+        with tempfile.TemporaryDirectory(prefix="replay_") as temporary:
+            results = replay(program, config, dataPath, temporary, quiet)
+        results["folder"] = None
+        return results
+    os.makedirs(folder, exist_ok=True)
+    configCopy = os.path.join(folder, os.path.basename(config))
+    for path in (configCopy, configCopy + ".journal",
+                 os.path.join(folder, "data.txt")):
+        if os.path.exists(path) and os.path.abspath(path) != os.path.abspath(config):
+            os.remove(path)
+    sessions = readSessions(dataPath)
+    results = {"sessions": len(sessions), "unseeded": 0,
+               "records": sum(len(session["records"]) for session in sessions),
+               "replayed": 0, "mismatch": None, "folder": folder}
+    before = 0  # Records of the sessions before
+    wallStart = time.perf_counter()
+    for index, session in enumerate(sessions):
+        records = session["records"]
+        start = _time(session["start"])
+        end = _time(records[-1][TIME2]) if records else start
+        if session["seed"] is None:
+            results["unseeded"] += 1
+        replayer = Replayer(records)
+        run(program, config if index == 0 else configCopy,
+            days=(end - start).total_seconds() / 86400 + 1, folder=folder,
+            seed=session["seed"] or 0, start=start, quiet=quiet,
+            settings={"LOG_FORMAT": "csv", "DISPLAY_INTERVAL": 3600.0},
+            prepare=replayer.install, animal=False)
+        results["replayed"] += replayer.logged
+        if replayer.mismatch is None and replayer.logged < len(records):
+            replayer.mismatch = {"record": replayer.logged + 1,
+                                 "expected": {"event": records[replayer.logged][EVENT],
+                                              "time": records[replayer.logged][TIME2]},
+                                 "actual": None}
+        if replayer.mismatch is not None:
+            # Number the records from the start of the data file
+            replayer.mismatch["record"] += before
+            replayer.mismatch["session"] = index + 1
+            results["mismatch"] = replayer.mismatch
+            break
+        before += len(records)
+    results["wall_seconds"] = round(time.perf_counter() - wallStart, 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m puzzlebox.sim.replay",
+                                     description="Replay a data file and check "
+                                                 "that the program logs it again.")
+    parser.add_argument("program", help="Coyote.py or Raccoon_Skunk.py")
+    parser.add_argument("data", nargs="+",
+                        help="the data file (CSV or binary), or its segments "
+                             "in order")
+    parser.add_argument("--config", required=True,
+                        help="the configuration file the first session started with")
+    parser.add_argument("--folder", default=None,
+                        help="keep the replayed files in this folder (default: "
+                             "a temporary folder that is removed)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the program")
+    args = parser.parse_args()
+    results = replay(args.program, args.config, args.data, args.folder,
+                     not args.verbose)
+    print(json.dumps(results, indent=2))
+    return 1 if results["mismatch"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+# Parameter sweeps for the puzzle box
+#Licensed under the MIT License#
+"""
+Tries every combination of some protocol parameters on a population of
+virtual learners (see puzzlebox.sim.population), to compare designs of a
+protocol before they are tried at the boxes, e.g.:
+
+    python -m puzzlebox.sim.sweep Coyote.py --config config.txt
+        --vary trials_in_block=10,12,14 --vary block_suc_thresh=8:11
+        --vary consecutive_block=False,True
+
+The values of a parameter are a comma separated list or a range FIRST:LAST
+or FIRST:LAST:STEP, which includes LAST. The other parameters and the tests
+are those of the configuration file.
+
+Every combination is checked like the program checks its configuration file;
+one the program would reject is reported as such in the results and not
+simulated. The combinations are simulated in a pool of processes, one per
+core, and one whose simulation fails is reported with its error. Every
+result is cached in the cache folder, in a file named after a hash of the
+protocol, the learners and the seed, so running a sweep again only simulates
+the combinations that are new.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+from puzzlebox.persist import atomicWrite
+from puzzlebox.sim.population import (Population, Protocol, addArguments,
+                                      createLearner, learnerSpec)
+
+# Part of every cache key; change it when the simulation changes its results
+CACHE_VERSION = 1
+
+
+def parseValues(name, text, current):
+    """
+    The values of parameter name from text, of the type of its current
+    value. Raises a ValueError if they cannot be read.
+    """
+    if isinstance(current, bool):
+        values = []
+        for word in text.split(","):
+            word = word.strip().lower()
+            if word not in ("true", "false", "1", "0"):
+                raise ValueError("Value " + repr(word) + " of " + name +
+                                 " is not True or False")
+            values.append(word in ("true", "1"))
+        return values
+    if ":" in text and isinstance(current, int):
+        bounds = [int(word) for word in text.split(":")]
+        if len(bounds) not in (2, 3):
+            raise ValueError("Range " + repr(text) + " of " + name +
+                             " is not FIRST:LAST or FIRST:LAST:STEP")
+        step = bounds[2] if len(bounds) == 3 else 1
+        return list(range(bounds[0], bounds[1] + (1 if step > 0 else -1), step))
+    return [type(current)(word.strip()) for word in text.split(",")]
+
+
+def cacheKey(task):
+    """A hash of everything that decides the result of a task."""
+    description = dict(task, protocol=task["protocol"].description(),
+                       version=CACHE_VERSION)
+    del description["changes"]  # Already in the protocol
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def simulate(task):
+    """Run one task in a worker process and return the summary."""
+    learner = createLearner(task["learner"], task["learners"], task["seed"])
+    population = Population(task["protocol"], learner, task["learners"],
+                            task["seed"], task["trialsPerDay"],
+                            task["resetDaily"])
+    return population.run(task["days"]).summary()
+
+
+def table(rows, names, tests):
+    """
+    The results as a text table: passed share, median trials and days, or
+    why the combination has no results.
+    """
+    header = "".join("%-20s" % name for name in names)
+    for test in tests:
+        header += " %-22s" % (test + " pass/trials/days")
+    lines = [header]
+    for row in rows:
+        line = "".join("%-20s" % row["changes"][name] for name in names)
+        if "error" in row:
+            lines.append(line + " ERROR: " + row["error"])
+            continue
+        for test in row["summary"]["tests"]:
+            line += " %-22s" % ("%.2f/%s/%s" % (
+                test["passed"], test.get("trials", {}).get("p50", "-"),
+                test.get("days", {}).get("p50", "-")))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m puzzlebox.sim.sweep",
+                                     description="Simulate every combination "
+                                                 "of some parameters.")
+    parser.add_argument("program", help="Coyote.py or Raccoon_Skunk.py")
+    parser.add_argument("--config", default="config.txt",
+                        help="configuration file with the tests")
+    parser.add_argument("--vary", action="append", default=[],
+                        metavar="NAME=VALUES",
+                        help="values of a parameter, e.g. trials_in_block=10,12 "
+                             "or block_suc_thresh=8:11 (repeatable)")
+    addArguments(parser)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="number of processes (default: one per core)")
+    parser.add_argument("--cache", default="sweep_cache",
+                        help="folder for the cached results")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    try:
+        protocol = Protocol.fromConfig(args.program, args.config)
+        names = []
+        choices = []
+        for vary in args.vary:
+            name, text = vary.split("=", 1)
+            if name not in protocol.par or name in names:
+                raise ValueError("Parameter " + repr(name) + " not known or "
+                                 "given twice")
+            names.append(name)
+            choices.append(parseValues(name, text, protocol.par[name]))
+    except (OSError, ValueError) as err:
+        print("ERROR:", err)
+        return 1
+
+    tasks = []
+    errors = {}  # Why combinations have no results, by index in tasks
+    for values in itertools.product(*choices):
+        changes = dict(zip(names, values))
+        try:
+            changed = protocol.withParameters(changes)
+        except ValueError as err:
+            errors[len(tasks)] = str(err)
+            tasks.append({"changes": changes})
+            continue
+        tasks.append({"protocol": changed,
+                      "changes": changes, "learner": learnerSpec(args),
+                      "learners": args.learners, "days": args.days,
+                      "trialsPerDay": args.trials_per_day,
+                      "resetDaily": not args.no_daily_reset, "seed": args.seed})
+    os.makedirs(args.cache, exist_ok=True)
+    summaries = {}
+    pending = {}
+    for index, task in enumerate(tasks):
+        if index in errors:
+            continue
+        key = cacheKey(task)
+        path = os.path.join(args.cache, key + ".json")
+        if os.path.exists(path):
+            with open(path) as cacheFile:
+                summaries[key] = json.load(cacheFile)
+        else:
+            pending[key] = task
+    print(len(tasks), "combinations,", len(errors), "invalid,", len(summaries),
+          "cached,", len(pending), "to simulate", flush=True)
+
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(max(args.jobs or 1, 1)) as pool:
+            futures = {pool.submit(simulate, task): key for key, task in pending.items()}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                key = futures[future]
+                try:
+                    summaries[key] = future.result()
+                except Exception as err:
+                    # Reported in its row; the other combinations go on
+                    summaries[key] = {"error": type(err).__name__ + ": " + str(err)}
+                    print("Simulation failed:", summaries[key]["error"], flush=True)
+                    continue
+                atomicWrite(os.path.join(args.cache, key + ".json"),
+                            json.dumps(summaries[key]))
+                print("Simulated", done, "of", len(pending), flush=True)
+
+    rows = []
+    for index, task in enumerate(tasks):
+        if index in errors:
+            rows.append({"changes": task["changes"], "error": errors[index]})
+            continue
+        summary = summaries[cacheKey(task)]
+        if "error" in summary:
+            rows.append({"changes": task["changes"], "error": summary["error"]})
+        else:
+            rows.append({"changes": task["changes"], "summary": summary})
+    print(table(rows, names, protocol.tests))
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump({"program": args.program, "config": args.config,
+                       "learner": learnerSpec(args), "seed": args.seed,
+                       "results": rows}, outputFile, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Simulated animal and feeder motor for the puzzle box
+#Licensed under the MIT License#
+"""
+The world around the box in a simulation. FeederMotor closes and opens the
+snap switch when the motor turns, and Animal visits the box and pushes the
+buttons. Both act through the simulated GPIO (puzzlebox.sim.gpio) on the
+simulation clock.
+"""
+from puzzlebox import clock
+
+
+class FeederMotor:
+    """
+    Closes the snap switch part way through a rotation of rotation seconds
+    and opens it again at the end, once the motor is turned on.
+    """
+    def __init__(self, gpio, pinLeft, pinSnap, rotation=0.6):
+        self.gpio = gpio
+        self.pinSnap = pinSnap
+        self.rotation = rotation
+        self.rotations = 0
+        self._turning = False
+        gpio.onOutput(pinLeft, self._motor)
+
+    def _motor(self, on):
+        if on and not self._turning:
+            self._turning = True
+            self.rotations += 1
+            self.gpio.scheduleInput(self.pinSnap, 1, self.rotation / 2)
+            self.gpio.scheduleInput(self.pinSnap, 0, self.rotation)
+        elif not on:
+            self._turning = False
+
+
+class Animal:
+    """
+    An animal that visits the box every visitGap seconds on average, stays
+    for visitLength seconds on average and pushes a button every pushGap
+    seconds on average while it is there. When one LED is lit it pushes that
+    side with the chance accuracy, otherwise it picks a side at random.
+
+    pins holds the pin numbers: "left" and "right" for the buttons,
+    "ledLeft" and "ledRight" for the LEDs and, if the box has one, "ir" for
+    the IR sensor (a break beam, which reads 1 while the animal is there).
+    """
+    def __init__(self, gpio, pins, rng, accuracy=0.8, visitGap=3600.0,
+                 visitLength=900.0, pushGap=20.0, pushLength=0.1):
+        self.gpio = gpio
+        self.pins = pins
+        self.rng = rng
+        self.accuracy = accuracy
+        self.visitGap = visitGap
+        self.visitLength = visitLength
+        self.pushGap = pushGap
+        self.pushLength = pushLength
+        self.visits = 0
+        self.pushes = 0
+
+    def start(self):
+        clock.startThread(self._run, "Animal")
+
+    def choose(self):
+        left = self.gpio.input(self.pins["ledLeft"])
+        right = self.gpio.input(self.pins["ledRight"])
+        if left != right:
+            lit = "left" if left else "right"
+            other = "right" if left else "left"
+            return lit if self.rng.random() < self.accuracy else other
+        return self.rng.choice(("left", "right"))
+
+    def push(self, side):
+        pin = self.pins[side]
+        self.pushes += 1
+        self.gpio.setInput(pin, 0)
+        clock.sleep(self.pushLength)
+        self.gpio.setInput(pin, 1)
+
+    def _run(self):
+        ir = self.pins.get("ir")
+        while True:
+            clock.sleep(self.rng.expovariate(1 / self.visitGap))
+            self.visits += 1
+            if ir is not None:
+                self.gpio.setInput(ir, 1)
+            leave = clock.monotonic() + self.rng.expovariate(1 / self.visitLength)
+            while True:
+                clock.sleep(self.rng.expovariate(1 / self.pushGap))
+                if clock.monotonic() >= leave:
+                    break
+                self.push(self.choose())
+            if ir is not None:
+                self.gpio.setInput(ir, 0)
@@ -0,0 +1,53 @@
+# Trial timestamps for the puzzle box
+#Licensed under the MIT License#
+"""
+High resolution timestamps of a trial, in clock.monotonicNs() nanoseconds:
+the stimulus onset (the last write to the LEDs), the edge of the button push
+(taken by the GPIO callback), and the start and end of the feeder rotation.
+The reaction time written to the data file is the time from the onset to the
+edge, in milliseconds.
+"""
+from puzzlebox import clock
+
+# Written for timestamps that were not taken, e.g. in the binary data file
+MISSING = -1
+
+
+def reactionText(onset, edge):
+    """The reaction time column: milliseconds from onset to edge, or empty."""
+    if onset == MISSING or edge == MISSING or edge < onset:
+        return ""
+    return "%.3f" % ((edge - onset) / 1e6)
+
+
+class TrialTimes:
+    """
+    The timestamps of the current trial. The edge and feeder times are
+    cleared once the trial is logged; the onset stays until the LEDs change.
+    """
+    __slots__ = ("onset", "edge", "feedStart", "feedEnd")
+
+    def __init__(self):
+        self.onset = MISSING
+        self.clear()
+
+    def clear(self):
+        self.edge = MISSING
+        self.feedStart = MISSING
+        self.feedEnd = MISSING
+
+    def stimulus(self):
+        self.onset = clock.monotonicNs()
+
+    def pushed(self, edge):
+        self.edge = edge
+
+    def fed(self, start, end):
+        self.feedStart = start
+        self.feedEnd = end
+
+    def reactionText(self):
+        return reactionText(self.onset, self.edge)
+
+    def values(self):
+        return (self.onset, self.edge, self.feedStart, self.feedEnd)
@@ -0,0 +1,54 @@
+# Compiled trial tables for the puzzle box
+#Licensed under the MIT License#
+"""
+Trials are written in the configuration file as answer-LED pairs such as
+"L-L" or "O-B". They are checked and compiled once, when the configuration is
+read, into tuples of small integer codes, so selecting a trial during a
+session is only an index lookup.
+"""
+
+# All answers and LED configurations; a code is the index in these tuples
+ANSWER_NAMES = ("L", "R", "E", "I", "S", "O")
+LED_NAMES = ("L", "R", "E", "B", "N")
+ANSWER_CODES = {name: code for code, name in enumerate(ANSWER_NAMES)}
+LED_CODES = {name: code for code, name in enumerate(LED_NAMES)}
+
+# Answers that depend on the previous input; resolved during the session
+PREVIOUS_ANSWERS = ("S", "O")
+
+# The configuration file form of every possible trial
+TRIAL_NAMES = {(answer, led): ANSWER_NAMES[answer] + "-" + LED_NAMES[led]
+               for answer in range(len(ANSWER_NAMES))
+               for led in range(len(LED_NAMES))}
+
+
+def compileTrial(trial, legalAnswers):
+    """
+    Compile a trial such as "L-R" into an (answer, LED) code pair. Raises a
+    ValueError if the trial is malformed or uses an unknown answer or LED
+    configuration.
+    """
+    parts = trial.split('-')
+    if len(parts) != 2:
+        raise ValueError("Trial " + repr(trial) + " is not an answer-LED pair "
+                         "such as L-L.")
+    answer, ledConfig = parts
+    if answer not in legalAnswers and answer not in PREVIOUS_ANSWERS:
+        raise ValueError("Answer " + repr(answer) + " in trial " + repr(trial) +
+                         " not a legal answer. Ensure the answer is in: " +
+                         str(list(legalAnswers) + list(PREVIOUS_ANSWERS)))
+    if ledConfig not in LED_CODES:
+        raise ValueError("LED configuration " + repr(ledConfig) + " in trial " +
+                         repr(trial) + " not known. Ensure it is in: " +
+                         str(list(LED_NAMES)))
+    return (ANSWER_CODES[answer], LED_CODES[ledConfig])
+
+
+def compileTrials(trials, legalAnswers):
+    """Compile a list of trial strings into an immutable table."""
+    return tuple(compileTrial(trial, legalAnswers) for trial in trials)
+
+
+def trialName(trial):
+    """The configuration file form of a compiled trial, e.g. "L-L"."""
+    return TRIAL_NAMES[trial]